@@ -0,0 +1,81 @@
+"""Compares utils.compress_to_gz with the previous single-threaded gzip.open/writelines implementation.
+
+Pass uncompressed NIfTI volumes, e.g. a 1 mm and a 0.7 mm T1w, on the command line. Compressed volumes are
+decompressed to a temporary file first.
+
+    python benchmarks/bench_compress.py sub-01_T1w.nii sub-02_acq-07mm_T1w.nii.gz -l 1 6 -t 1 4 8
+"""
+
+import argparse
+import gzip
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+import utils
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark gzip compression of NIfTI volumes.')
+    parser.add_argument('volumes', nargs='+', type=Path, help='NIfTI volumes to compress.')
+    parser.add_argument('-l', '--levels', nargs='+', type=int, default=[utils.GZIP_LEVEL],
+                        help='Compression levels to benchmark.')
+    parser.add_argument('-t', '--threads', nargs='+', type=int, default=[1, 4, 8],
+                        help='Thread counts to benchmark the parallel writer with.')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='Number of timed runs; the fastest is reported.')
+    return parser.parse_args()
+
+
+def legacy_compress_to_gz(input_file, output_file, level):
+    with open(input_file, 'rb') as f_input:
+        with gzip.open(output_file, 'wb', compresslevel=level) as f_output:
+            f_output.writelines(f_input)
+
+
+def best_time(func, output_file, repeats):
+    times = []
+    for _ in range(repeats):
+        output_file.unlink(missing_ok=True)
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    args = get_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        print(f"{'volume':<40}{'method':<22}{'level':>6}{'seconds':>10}{'MB/s':>10}{'ratio':>8}")
+        for volume in args.volumes:
+            if volume.name.endswith('.gz'):
+                raw = tmpdir / volume.name[:-3]
+                with gzip.open(volume, 'rb') as f_in, open(raw, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+            else:
+                raw = volume
+            raw_mb = raw.stat().st_size / 1e6
+            output_file = tmpdir / 'out.nii.gz'
+
+            for level in args.levels:
+                runs = [('gzip.open/writelines',
+                         lambda: legacy_compress_to_gz(raw, output_file, level))]
+                runs.extend((f'parallel, {n} thread(s)',
+                             lambda n=n: utils.compress_to_gz(raw, output_file, level=level, n_threads=n))
+                            for n in args.threads)
+
+                for method, func in runs:
+                    seconds = best_time(func, output_file, args.repeats)
+                    with gzip.open(output_file, 'rb') as f:
+                        if f.read() != raw.read_bytes():
+                            raise RuntimeError(f"{method} produced a corrupt stream for {volume}")
+                    ratio = raw.stat().st_size / output_file.stat().st_size
+                    print(f"{volume.name:<40}{method:<22}{level:>6}{seconds:>10.2f}{raw_mb / seconds:>10.1f}"
+                          f"{ratio:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Times generate_mappings.crawl against the previous single-threaded glob-based crawler on a synthetic tree.
+
+    python benchmarks/bench_crawl.py -s 2000 -e 2 -t 1 8 16 32
+"""
+
+import argparse
+import json
+import logging
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+import generate_mappings
+import layout_index
+import synthetic_bids
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the primary-to-others mapping crawler.')
+    parser.add_argument('-s', '--subjects', type=int, default=1000, help='Number of subjects.')
+    parser.add_argument('-e', '--sessions', type=int, default=2, help='Number of sessions per subject.')
+    parser.add_argument('-a', '--scans-per-anat', type=int, default=4, help='Number of scans per anat directory.')
+    parser.add_argument('-t', '--threads', nargs='+', type=int, default=[1, 8, 16, 32],
+                        help='Thread counts to benchmark the crawler with.')
+    parser.add_argument('--bids-dir', type=Path, default=None,
+                        help='Crawl this dataset instead of generating a synthetic one, e.g. one on a network '
+                             'filesystem.')
+    return parser.parse_args()
+
+
+def legacy_crawl(input_dir, logger):
+    """The crawler as it was before it used os.scandir and a thread pool."""
+    mapping_dict = defaultdict(dict)
+    for subj_dir in list(input_dir.glob('sub-*')):
+        anat_dirs, sess_exist = generate_mappings.get_anat_dir_paths(subj_dir, logger)
+        for anat_dir in anat_dirs:
+            t1_sidecars = list(anat_dir.glob('*T1w.json'))
+            mapping_dict = generate_mappings.update_mapping_dict(mapping_dict, anat_dir, sess_exist, t1_sidecars,
+                                                                 logger)
+    return mapping_dict
+
+
+def normalized(mapping_dict):
+    """Sorts "others" lists, whose order the legacy crawler took from the filesystem."""
+    def sort_others(obj):
+        return {k: sorted(v) if k == 'others' else sort_others(v) if isinstance(v, dict) else v
+                for k, v in obj.items()}
+    return sort_others(json.loads(json.dumps(mapping_dict)))
+
+
+def main():
+    args = get_args()
+    logger = logging.getLogger('bench_crawl')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        bids_dir = args.bids_dir
+        if bids_dir is None:
+            bids_dir = tmpdir / 'bids'
+            start = time.perf_counter()
+            synthetic_bids.make_dataset(bids_dir, args.subjects, args.sessions, args.scans_per_anat,
+                                        shape=(2, 2, 2), fill='zeros', with_func=False)
+            print(f"Generated {args.subjects} subjects x {args.sessions} sessions in "
+                  f"{time.perf_counter() - start:.1f} s")
+
+        start = time.perf_counter()
+        expected = normalized(legacy_crawl(bids_dir, logger))
+        print(f"{'legacy glob crawler':<28}{time.perf_counter() - start:>8.2f} s")
+
+        for n_threads in args.threads:
+            start = time.perf_counter()
+            mapping_dict = generate_mappings.crawl(bids_dir, tmpdir / 'out', logger, n_threads=n_threads)
+            seconds = time.perf_counter() - start
+            same = 'same mapping' if normalized(mapping_dict) == expected else 'MAPPING DIFFERS'
+            print(f"{f'scandir, {n_threads} thread(s)':<28}{seconds:>8.2f} s   {same}")
+
+        # the second run with the layout index only stats directories, none of them having changed
+        index_path = tmpdir / layout_index.INDEX_FILENAME
+        n_threads = max(args.threads)
+        for label in ['cold', 'warm']:
+            start = time.perf_counter()
+            mapping_dict = generate_mappings.crawl(bids_dir, tmpdir / 'out', logger, n_threads=n_threads,
+                                                   index_path=index_path)
+            seconds = time.perf_counter() - start
+            same = 'same mapping' if normalized(mapping_dict) == expected else 'MAPPING DIFFERS'
+            print(f"{f'layout index, {label}':<28}{seconds:>8.2f} s   {same}")
+
+
+if __name__ == "__main__":
+    main()
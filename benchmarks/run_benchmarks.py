@@ -0,0 +1,196 @@
+"""End-to-end benchmark of the pipeline's Python orchestration against stub AFNI/FSL tools.
+
+A synthetic BIDS dataset is generated, then main.py is run on it with the stub tools in benchmarks/stubs first on
+PATH, once per --n-cpus value, followed by prepare_to_share.py. Timings are taken from main.py's --trace output:
+
+    crawl        generate_mappings.crawl and saving the layout index
+    startup      from launching main.py to the first subject/session starting, crawl included
+    tools        time spent in the stub tools, i.e. their delays plus process startup
+    io           gzip, defacemask generation, native masking, QC prep symlinks and cleanup
+    reorganize   reorganize_into_bids, excluding the stages above that it contains
+    sched idle   worker time left idle between the first unit starting and the last one finishing
+    teardown     from the last unit finishing to main.py exiting
+
+    python benchmarks/run_benchmarks.py -s 20 -e 2 -a 4 --shape 64 64 48 -n 1 4 --refacer-delay 0.5 --json base.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import synthetic_bids
+
+BENCH_DIR = Path(__file__).resolve().parent
+SRC_DIR = BENCH_DIR.parent / 'src'
+sys.path.insert(0, str(SRC_DIR))
+
+import utils
+IO_STAGES = ['gzip', 'preprocess_facemask', 'apply_mask_native', 'vqcdeface_prep', 'cleanup', 'cleanup_afni_workdir']
+COLUMNS = ['n_cpus', 'wall', 'crawl', 'startup', 'tools', 'io', 'reorganize', 'sched_idle', 'teardown',
+           'units_per_min', 'scans_per_min', 'prepare_to_share']
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the defacing pipeline with stub AFNI/FSL tools.')
+    parser.add_argument('-s', '--subjects', type=int, default=10, help='Number of subjects.')
+    parser.add_argument('-e', '--sessions', type=int, default=1,
+                        help='Number of sessions per subject; 0 for subjects without session directories.')
+    parser.add_argument('-a', '--scans-per-anat', type=int, default=3, help='Number of scans per anat directory.')
+    parser.add_argument('--acq-time-fraction', type=float, default=0.5,
+                        help='Fraction of T1w sidecars with an AcquisitionTime field.')
+    parser.add_argument('--shape', nargs='+', type=int, default=[32, 32, 24], help='Voxel dimensions of each scan.')
+    parser.add_argument('-n', '--n-cpus', nargs='+', type=int, default=[1], help='--n-cpus values to benchmark.')
+    parser.add_argument('--refacer-delay', type=float, default=0.0, help='Seconds each @afni_refacer_run takes.')
+    parser.add_argument('--flirt-delay', type=float, default=0.0, help='Seconds each flirt call takes.')
+    parser.add_argument('--fsl-delay', type=float, default=0.0, help='Seconds each fslroi and fslmaths call takes.')
+    parser.add_argument('--main-args', default='',
+                        help='Extra arguments for main.py, e.g. "--mask-backend fsl".')
+    parser.add_argument('--json', type=Path, default=None, help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', type=Path, default=None,
+                        help='Results of a previous run written with --json. Exits with status 1 if any '
+                             'orchestration timing got slower by more than --tolerance.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown relative to --baseline, as a fraction.')
+    parser.add_argument('--workdir', type=Path, default=None,
+                        help='Generate the dataset and outputs here and keep them, instead of a temporary directory.')
+    return parser.parse_args()
+
+
+def get_stub_env(workdir, args):
+    """Environment with the stub tools first on PATH and an FSLDIR that reports a version."""
+    fsldir = workdir / 'fsl'
+    (fsldir / 'etc').mkdir(parents=True, exist_ok=True)
+    (fsldir / 'etc' / 'fslversion').write_text('6.0.7:stub\n')
+
+    env = dict(os.environ)
+    env['PATH'] = f"{BENCH_DIR / 'stubs'}{os.pathsep}{env.get('PATH', '')}"
+    env['FSLDIR'] = str(fsldir)
+    env['STUB_REFACER_DELAY'] = str(args.refacer_delay)
+    env['STUB_FLIRT_DELAY'] = str(args.flirt_delay)
+    env['STUB_FSL_DELAY'] = str(args.fsl_delay)
+    return env
+
+
+def total(events, names):
+    return sum(e['dur'] for e in events if e['name'] in names) / 1e6
+
+
+def summarize_trace(trace_path, launched, finished, n_cpus, n_scans):
+    with open(trace_path, 'r') as f:
+        events = [e for e in json.load(f)['traceEvents'] if e['ph'] == 'X']
+    units = [e for e in events if e['name'] == 'unit']
+    if not units:
+        raise RuntimeError(f"No subject/session was defaced; see {trace_path.parent}")
+
+    first_start = min(u['ts'] for u in units) / 1e6
+    last_end = max(u['ts'] + u['dur'] for u in units) / 1e6
+    busy = sum(u['dur'] for u in units) / 1e6
+    wall = finished - launched
+    return {'n_cpus': n_cpus, 'wall': wall,
+            'crawl': total(events, ['crawl', 'layout_index_save']),
+            'startup': first_start - launched,
+            'tools': sum(e['dur'] for e in events if e['cat'] == 'command') / 1e6,
+            'io': total(events, IO_STAGES),
+            'reorganize': total(events, ['reorganize_into_bids']) - total(events, ['gzip', 'vqcdeface_prep',
+                                                                                    'cleanup']),
+            'sched_idle': n_cpus * (last_end - first_start) - busy,
+            'teardown': finished - last_end,
+            'units_per_min': len(units) * 60 / wall,
+            'scans_per_min': n_scans * 60 / wall}
+
+
+def run_pipeline(bids_dir, output_dir, n_cpus, env, main_args):
+    cmd = [sys.executable, str(SRC_DIR / 'main.py'), str(bids_dir), str(output_dir), '-n', str(n_cpus), '--trace',
+           '--no-cache'] + main_args.split()
+    log_path = output_dir.parent / f'{output_dir.name}.log'
+    with open(log_path, 'w') as log:
+        launched = time.time()
+        result = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+        finished = time.time()
+    if result.returncode != 0:
+        raise RuntimeError(f"main.py exited with {result.returncode}; see {log_path}")
+    return launched, finished
+
+
+def get_modes(main_args):
+    """The defacing modes main.py runs with the extra arguments given."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-m', '--mode', nargs='+', default=['regular'])
+    return parser.parse_known_args(main_args.split())[0].mode
+
+
+def run_prepare_to_share(bids_dir, output_dir, env, modes):
+    """Runs prepare_to_share.py on the bids_defaced tree of every mode, returning the seconds taken in all."""
+    start = time.perf_counter()
+    for mode_dir in utils.get_mode_output_dirs(output_dir, modes).values():
+        cmd = [sys.executable, str(SRC_DIR / 'prepare_to_share.py'), str(bids_dir), str(mode_dir / 'bids_defaced'),
+               '--layout-index', str(output_dir / 'layout_index.sqlite')]
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, env=env, check=True)
+    return time.perf_counter() - start
+
+
+def print_table(results):
+    widths = [max(len(c) + 2, 9) for c in COLUMNS]
+    print(''.join(f'{c:>{w}}' for c, w in zip(COLUMNS, widths)))
+    for r in results:
+        print(''.join(f'{r[c]:>{w}}' if c == 'n_cpus' else f'{r[c]:>{w}.2f}' for c, w in zip(COLUMNS, widths)))
+
+
+def compare(results, baseline_path, tolerance):
+    """Prints orchestration timings that got slower than in a previous --json run. Returns the number of them."""
+    with open(baseline_path, 'r') as f:
+        baseline = {r['n_cpus']: r for r in json.load(f)['results']}
+    regressions = 0
+    for r in results:
+        base = baseline.get(r['n_cpus'])
+        if base is None:
+            continue
+        for c in ['wall', 'crawl', 'startup', 'io', 'reorganize', 'sched_idle', 'teardown', 'prepare_to_share']:
+            # sub-100 ms differences are noise
+            if r[c] > base[c] * (1 + tolerance) and r[c] - base[c] > 0.1:
+                print(f"REGRESSION n_cpus={r['n_cpus']} {c}: {base[c]:.2f} s -> {r[c]:.2f} s")
+                regressions += 1
+    return regressions
+
+
+def main():
+    args = get_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = args.workdir or Path(tmpdir)
+        workdir.mkdir(parents=True, exist_ok=True)
+        bids_dir = workdir / 'bids'
+
+        start = time.perf_counter()
+        niftis = synthetic_bids.make_dataset(bids_dir, args.subjects, args.sessions, args.scans_per_anat,
+                                             args.acq_time_fraction, tuple(args.shape))
+        print(f"Generated {len(niftis)} scans of {args.subjects} subject(s) x {max(args.sessions, 1)} session(s) in "
+              f"{time.perf_counter() - start:.1f} s")
+
+        env = get_stub_env(workdir, args)
+        results = []
+        for n_cpus in args.n_cpus:
+            output_dir = workdir / f'out_n{n_cpus}'
+            shutil.rmtree(output_dir, ignore_errors=True)
+            launched, finished = run_pipeline(bids_dir, output_dir, n_cpus, env, args.main_args)
+            result = summarize_trace(output_dir / 'logs' / 'trace.json', launched, finished, n_cpus,
+                                     len(niftis))
+            result['prepare_to_share'] = run_prepare_to_share(bids_dir, output_dir, env, get_modes(args.main_args))
+            results.append(result)
+
+        print_table(results)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'args': {k: str(v) for k, v in vars(args).items()}, 'results': results}, f, indent=4)
+
+        if args.baseline and compare(results, args.baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Stand-ins for the AFNI and FSL commands the pipeline calls, for benchmarking without AFNI, FSL or real data.
+
+Each stub parses the arguments the pipeline passes, sleeps for a tunable delay and writes outputs with the shape the
+real tool would produce, using the NIfTI writer in synthetic_bids.py. The executables in benchmarks/stubs call into
+this module; put that directory first on PATH to use them. Delays in seconds are read from the environment:
+
+    STUB_REFACER_DELAY   @afni_refacer_run
+    STUB_FLIRT_DELAY     flirt, both registration and applying a transform
+    STUB_FSL_DELAY       fslroi and fslmaths
+"""
+
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import synthetic_bids
+
+DELAY_ENV = {'@afni_refacer_run': 'STUB_REFACER_DELAY', 'flirt': 'STUB_FLIRT_DELAY', 'fslroi': 'STUB_FSL_DELAY',
+             'fslmaths': 'STUB_FSL_DELAY'}
+
+
+def sleep(tool):
+    time.sleep(float(os.environ.get(DELAY_ENV[tool], 0)))
+
+
+def get_option(argv, flag):
+    return argv[argv.index(flag) + 1]
+
+
+def fsl_output(path):
+    """FSL tools add the .nii.gz extension to outputs named without one."""
+    return Path(path if path.endswith(('.nii', '.nii.gz')) else path + '.nii.gz')
+
+
+def fsl_input(path):
+    for candidate in [path, path + '.nii.gz', path + '.nii']:
+        if Path(candidate).exists():
+            return Path(candidate)
+    raise FileNotFoundError(f"Image {path} not found")
+
+
+def afni_refacer_run(argv):
+    """Writes the defaced primary scan, the work directory the pipeline expects and a QC directory."""
+    sleep('@afni_refacer_run')
+    input_scan = Path(get_option(argv, '-input'))
+    prefix = Path(get_option(argv, '-prefix'))
+    shape, datatype = synthetic_bids.read_nifti_shape(input_scan)
+
+    synthetic_bids.write_nifti(prefix.parent / f'{prefix.name}.nii.gz', shape, datatype)
+    if '-no_clean' in argv:
+        workdir = prefix.parent / f'__work_refacer.{prefix.name}.{random.randrange(16 ** 5):05x}'
+        workdir.mkdir(parents=True, exist_ok=True)
+        synthetic_bids.write_nifti(workdir / 'tmp.05.sh_t2a_thr.nii', tuple(shape[:3]) + (2,), 'uint8', 'zeros')
+        synthetic_bids.write_nifti(workdir / 'tmp.99.result.deface.nii', shape, datatype)
+        (workdir / 'tmp.02.aff12.1D').write_text('1 0 0 0 0 1 0 0 0 0 1 0\n')
+    qc_dir = prefix.parent / f'{prefix.name}_QC'
+    qc_dir.mkdir(parents=True, exist_ok=True)
+    (qc_dir / 'QC_img.jpg').write_bytes(b'\xff\xd8\xff\xd9')
+
+
+def flirt(argv):
+    """Writes the registered image, and the transform matrix unless a transform is being applied."""
+    sleep('flirt')
+    shape, datatype = synthetic_bids.read_nifti_shape(fsl_input(get_option(argv, '-ref')))
+    if '-applyxfm' not in argv:
+        with open(get_option(argv, '-omat'), 'w') as f:
+            f.write('1 0 0 0\n0 1 0 0\n0 0 1 0\n0 0 0 1\n')
+    if '-applyxfm' in argv:
+        # nearest neighbour resampling of a mask stays binary
+        synthetic_bids.write_nifti(fsl_output(get_option(argv, '-out')), shape[:3], 'uint8', 'zeros')
+    else:
+        synthetic_bids.write_nifti(fsl_output(get_option(argv, '-out')), shape[:3], datatype)
+
+
+def fslroi(argv):
+    """fslroi <input> <output> <tmin> <tsize>"""
+    sleep('fslroi')
+    shape, datatype = synthetic_bids.read_nifti_shape(fsl_input(argv[0]))
+    tsize = int(argv[3])
+    out_shape = tuple(shape[:3]) + ((tsize,) if tsize > 1 else ())
+    synthetic_bids.write_nifti(fsl_output(argv[1]), out_shape, datatype, 'zeros')
+
+
+def fslmaths(argv):
+    """fslmaths <input> [operations ...] <output>"""
+    sleep('fslmaths')
+    shape, datatype = synthetic_bids.read_nifti_shape(fsl_input(argv[0]))
+    synthetic_bids.write_nifti(fsl_output(argv[-1]), shape, datatype)
+
+
+def allineate(argv):
+    """Writes the shell moved into the master's space, a 2-volume mask like the refacer's."""
+    shape, _ = synthetic_bids.read_nifti_shape(fsl_input(get_option(argv, '-master')))
+    synthetic_bids.write_nifti(Path(get_option(argv, '-prefix')), tuple(shape[:3]) + (2,), 'uint8', 'zeros')
+
+
+def find_afni_dset_path(argv):
+    print(Path(__file__).resolve().parent / 'stubs')
+
+
+def afni(argv):
+    print('Precompiled binary linux_stub: Jan  1 2024 (Version AFNI_24.0.00 \'stub\')')
+
+
+TOOLS = {'@afni_refacer_run': afni_refacer_run, 'flirt': flirt, 'fslroi': fslroi, 'fslmaths': fslmaths,
+         'afni': afni, '3dAllineate': allineate, '@FindAfniDsetPath': find_afni_dset_path}
+
+
+def main(tool):
+    TOOLS[tool](sys.argv[1:])
@@ -0,0 +1,144 @@
+"""Generates synthetic BIDS datasets for benchmarking the pipeline.
+
+Only the standard library is used, so datasets can be generated on machines without nibabel.
+
+    python benchmarks/synthetic_bids.py /tmp/synthetic_bids -s 100 -e 2 -a 4 --shape 64 64 48
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import struct
+from pathlib import Path
+
+NIFTI_HEADER_FORMAT = '<i10s18sihcc8h3fhhhh8ffffhccffffii80s24shh6f12f16s4s'
+NIFTI_DATATYPES = {'int16': (4, 16), 'float32': (16, 32), 'uint8': (2, 8)}
+LOW_ENTROPY = bytes(i & 0x3f for i in range(256))
+OTHER_SUFFIXES = ['T2w', 'FLAIR', 'PDw', 'T2starw', 'inplaneT2', 'angio']
+
+
+def nifti_header(shape, datatype='int16', pixdim=(1.0, 1.0, 1.0)):
+    """Packs a single-file NIfTI-1 header, followed by the empty extension flag, for an image of the given shape."""
+    code, bitpix = NIFTI_DATATYPES[datatype]
+    dim = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    pix = [1.0] + list(pixdim) + [1.0] * (7 - len(pixdim))
+    srow = [pixdim[0], 0, 0, 0, 0, pixdim[1], 0, 0, 0, 0, pixdim[2], 0]
+    header = struct.pack(NIFTI_HEADER_FORMAT, 348, b'', b'', 0, 0, b'r', b'\x00', *dim, 0, 0, 0, 0, code, bitpix, 0,
+                         *pix, 352.0, 1.0, 0.0, 0, b'\x00', b'\x0a', 0, 0, 0, 0, 0, 0, b'', b'', 1, 1,
+                         0, 0, 0, 0, 0, 0, *srow, b'', b'n+1\x00')
+    return header + b'\x00' * 4
+
+
+def read_nifti_shape(nifti_path):
+    """Returns the shape and datatype name of a NIfTI-1 image, reading only its header."""
+    opener = gzip.open if str(nifti_path).endswith('.gz') else open
+    with opener(nifti_path, 'rb') as f:
+        fields = struct.unpack(NIFTI_HEADER_FORMAT, f.read(348))
+    dim = fields[7:15]
+    code = fields[19]
+    datatype = next(name for name, (c, _) in NIFTI_DATATYPES.items() if c == code)
+    return tuple(dim[1:dim[0] + 1]), datatype
+
+
+def write_nifti(nifti_path, shape, datatype='int16', fill='noise', level=1):
+    """Writes a NIfTI-1 image. fill is 'noise' for compressible random data or 'zeros'."""
+    _, bitpix = NIFTI_DATATYPES[datatype]
+    n_bytes = bitpix // 8
+    for size in shape:
+        n_bytes *= size
+
+    opener = (lambda p: gzip.open(p, 'wb', compresslevel=level)) if str(nifti_path).endswith('.gz') else \
+        (lambda p: open(p, 'wb'))
+    with opener(nifti_path) as f:
+        f.write(nifti_header(shape, datatype))
+        chunk = 1024 * 1024
+        written = 0
+        while written < n_bytes:
+            size = min(chunk, n_bytes - written)
+            if fill == 'noise':
+                # low-entropy noise compresses roughly as well as anatomical images do
+                f.write(os.urandom(size).translate(LOW_ENTROPY))
+            else:
+                f.write(b'\x00' * size)
+            written += size
+
+
+def write_sidecar(sidecar_path, acq_time=None):
+    sidecar = {'Modality': 'MR', 'MagneticFieldStrength': 3, 'Manufacturer': 'Synthetic', 'RepetitionTime': 2.3,
+               'EchoTime': 0.003}
+    if acq_time is not None:
+        sidecar['AcquisitionTime'] = acq_time
+    with open(sidecar_path, 'w') as f:
+        json.dump(sidecar, f, indent=4)
+
+
+def make_dataset(bids_dir, n_subjects=10, n_sessions=1, scans_per_anat=3, acq_time_fraction=1.0, shape=(16, 16, 16),
+                 datatype='int16', fill='noise', with_func=True, seed=0):
+    """Creates a synthetic BIDS dataset.
+
+    Each anat directory has two T1w runs when scans_per_anat is two or more, followed by other contrasts. A fraction
+    of the T1w sidecars carry an "AcquisitionTime" field. With n_sessions set to 0 subjects have no session
+    directories.
+
+    :return list: Paths to every NIfTI file created.
+    """
+    rng = random.Random(seed)
+    bids_dir = Path(bids_dir)
+    bids_dir.mkdir(parents=True, exist_ok=True)
+    with open(bids_dir / 'dataset_description.json', 'w') as f:
+        json.dump({'Name': 'Synthetic defacing benchmark', 'BIDSVersion': '1.8.0'}, f, indent=4)
+
+    niftis = []
+    for subj_idx in range(1, n_subjects + 1):
+        subj_id = f'sub-{subj_idx:05d}'
+        sessions = [f'ses-{sess_idx:02d}' for sess_idx in range(1, n_sessions + 1)] or [None]
+        for sess_id in sessions:
+            prefix = '_'.join(e for e in [subj_id, sess_id] if e)
+            parent = bids_dir / subj_id / sess_id if sess_id else bids_dir / subj_id
+
+            anat_dir = parent / 'anat'
+            anat_dir.mkdir(parents=True, exist_ok=True)
+            n_t1w = min(2, scans_per_anat)
+            scan_names = [f'{prefix}_run-{run}_T1w' for run in range(1, n_t1w + 1)]
+            scan_names += [f'{prefix}_{OTHER_SUFFIXES[i % len(OTHER_SUFFIXES)]}'
+                           for i in range(scans_per_anat - n_t1w)]
+            for scan_name in scan_names:
+                write_nifti(anat_dir / f'{scan_name}.nii.gz', shape, datatype, fill)
+                acq_time = None
+                if scan_name.endswith('T1w') and rng.random() < acq_time_fraction:
+                    acq_time = f'{rng.randint(8, 17):02d}:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d}.000000'
+                write_sidecar(anat_dir / f'{scan_name}.json', acq_time)
+                niftis.append(anat_dir / f'{scan_name}.nii.gz')
+
+            if with_func:
+                func_dir = parent / 'func'
+                func_dir.mkdir(parents=True, exist_ok=True)
+                write_nifti(func_dir / f'{prefix}_task-rest_bold.nii.gz', tuple(shape) + (4,), datatype, fill)
+                write_sidecar(func_dir / f'{prefix}_task-rest_bold.json', '09:00:00.000000')
+
+    return niftis
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Generate a synthetic BIDS dataset.')
+    parser.add_argument('bids_dir', type=Path, help='Directory to create the dataset in.')
+    parser.add_argument('-s', '--subjects', type=int, default=10, help='Number of subjects.')
+    parser.add_argument('-e', '--sessions', type=int, default=1,
+                        help='Number of sessions per subject; 0 for subjects without session directories.')
+    parser.add_argument('-a', '--scans-per-anat', type=int, default=3, help='Number of scans per anat directory.')
+    parser.add_argument('--acq-time-fraction', type=float, default=1.0,
+                        help='Fraction of T1w sidecars with an AcquisitionTime field.')
+    parser.add_argument('--shape', nargs='+', type=int, default=[16, 16, 16], help='Voxel dimensions of each scan.')
+    parser.add_argument('--datatype', choices=list(NIFTI_DATATYPES), default='int16', help='Voxel datatype.')
+    parser.add_argument('--no-func', dest='with_func', action='store_false', default=True,
+                        help='Do not create func directories.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for acquisition times.')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    make_dataset(args.bids_dir, args.subjects, args.sessions, args.scans_per_anat, args.acq_time_fraction,
+                 tuple(args.shape), args.datatype, with_func=args.with_func, seed=args.seed)
@@ -0,0 +1,196 @@
+"""Content-addressed cache of per-session defacing results.
+
+A session's cache key is derived from the SHA-256 hashes of its input NIfTI files, the defacing mode and the versions
+of the AFNI and FSL tools, queried after the same 'module load' as the pipeline's commands. When a session's key
+matches the one recorded after its last successful run and all outputs recorded with it are still present, the
+session is not defaced again. If either version can't be found, the cache is off for the run.
+
+Scan digests are shared with deduplication and the transform store through hash_scans, which only reads a scan again
+once its size or mtime changed, and keeps digests in the layout index across runs once configure_hash_index is called.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import layout_index
+import utils
+
+CACHE_FILENAME = 'defacing_cache.json'
+HASH_INDEX_ENV = 'DEFACING_HASH_INDEX'
+HASH_THREADS = 8
+# run after the same 'module load' as the pipeline's tools, so that the versions are those of the tools it runs
+VERSION_COMMANDS = {'afni': "module load afni 2>/dev/null; afni -ver",
+                    'fsl': 'module load fsl 2>/dev/null; cat "$FSLDIR/etc/fslversion"'}
+
+
+def hash_file(filepath, chunk_size=1024 * 1024):
+    """Computes the SHA-256 hex digest of a file, reading it in chunks.
+
+    :param Path filepath: Absolute path to the file.
+    :param int chunk_size: Number of bytes read at a time.
+    :return str: Hex digest of the file contents.
+    """
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+_digests = {}  # SHA-256 hex digests keyed by (path, size, mtime_ns), for this process
+
+
+def configure_hash_index(index_path):
+    """Keeps scan digests in the layout index at index_path across runs; exported in the environment so that worker
+    processes and array tasks use it too."""
+    os.environ[HASH_INDEX_ENV] = str(index_path)
+
+
+def get_hash_index():
+    index_path = os.environ.get(HASH_INDEX_ENV)
+    return Path(index_path) if index_path else None
+
+
+def hash_scans(filepaths, n_threads=HASH_THREADS):
+    """Computes the SHA-256 hex digests of files, reading only those that changed since they were last hashed.
+
+    A digest is reused for as long as the file's path, size and mtime are unchanged, whether it was computed in this
+    process or, once configure_hash_index was called, in an earlier run. The other files are hashed on a thread pool.
+
+    :param list filepaths: Paths to the files.
+    :param int n_threads: Number of files hashed at the same time.
+    :return dict: Hex digest keyed by each path of filepaths.
+    """
+    stats = {}
+    for f in filepaths:
+        stat = os.stat(f)
+        stats[f] = (str(f), stat.st_size, stat.st_mtime_ns)
+    missing = list(dict.fromkeys(s for s in stats.values() if s not in _digests))
+
+    index_path = get_hash_index()
+    if missing and index_path is not None:
+        _digests.update(layout_index.load_digests(index_path, missing))
+        missing = [s for s in missing if s not in _digests]
+    if missing:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            new = dict(zip(missing, executor.map(lambda s: hash_file(s[0]), missing)))
+        _digests.update(new)
+        if index_path is not None:
+            try:
+                layout_index.save_digests(index_path, new)
+            except sqlite3.OperationalError:
+                pass  # the index stayed locked; these files are hashed again by the next run
+    return {f: _digests[stat] for f, stat in stats.items()}
+
+
+def hash_scan(filepath):
+    """SHA-256 hex digest of one file; see hash_scans."""
+    return hash_scans([filepath], n_threads=1)[filepath]
+
+
+@functools.lru_cache(maxsize=None)
+def get_tool_versions():
+    """Returns the AFNI and FSL versions of the tools the pipeline runs, queried once per process.
+
+    :return dict: Version keyed by tool; empty for a tool whose version couldn't be found.
+    """
+    versions = {}
+    for tool, cmd in VERSION_COMMANDS.items():
+        out, err = utils.run_command(cmd)
+        versions[tool] = '' if err or not out else out.strip()
+    return versions
+
+
+def get_session_outputs(output_dir, subj_id, sess_id, modes=None):
+    """Lists every file a subject or session contributed to the 'bids_defaced' and 'defacing_QC' trees of every mode.
+
+    :return list: Paths relative to output_dir.
+    """
+    outputs = []
+    for mode_dir in utils.get_mode_output_dirs(output_dir, modes).values() if modes else [output_dir]:
+        for tree in ['bids_defaced', 'defacing_QC']:
+            unit_dir = mode_dir.joinpath(tree, subj_id, sess_id)
+            if unit_dir.exists():
+                outputs.extend([str(f.relative_to(output_dir)) for f in unit_dir.rglob('*') if not f.is_dir()])
+    return sorted(outputs)
+
+
+def make_entry(input_files, mode, tool_versions):
+    """Builds the cache entry describing a session's inputs, without its outputs."""
+    inputs = {f.name: digest for f, digest in hash_scans(input_files).items()}
+    key_material = json.dumps({'inputs': inputs, 'mode': mode, 'tool_versions': tool_versions}, sort_keys=True)
+    return {
+        'key': hashlib.sha256(key_material.encode('utf8')).hexdigest(),
+        'inputs': inputs,
+        'mode': mode,
+        'tool_versions': tool_versions,
+        'outputs': []
+    }
+
+
+def load_cache(cache_path):
+    if cache_path.exists():
+        with open(cache_path, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def save_cache(cache, cache_path):
+    """Writes the cache atomically so an interrupted run cannot leave a truncated file behind."""
+    tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f, indent=4)
+    os.replace(tmp_path, cache_path)
+
+
+def lookup(cache, unit_id, entry, output_dir):
+    """Checks whether a session can reuse its cached outputs.
+
+    :param dict cache: Cache loaded with load_cache.
+    :param str unit_id: Subject or subject/session identifier.
+    :param dict entry: Entry for the current inputs as returned by make_entry.
+    :param Path output_dir: The pipeline's output directory.
+    :return tuple: (hit, reason) where hit is a boolean and reason a short human-readable explanation.
+    """
+    cached = cache.get(unit_id)
+    if cached is None:
+        return False, "no cached result"
+    if cached['key'] != entry['key']:
+        if cached['inputs'] != entry['inputs']:
+            return False, "input scans changed"
+        if cached['mode'] != entry['mode']:
+            return False, "mode changed"
+        return False, "tool versions changed"
+    if not cached['outputs'] or not all(output_dir.joinpath(o).exists() for o in cached['outputs']):
+        return False, "cached outputs missing"
+    return True, "inputs, mode and tool versions unchanged"
+
+
+def record(cache, unit_id, entry, output_dir, subj_id, sess_id, modes=None):
+    """Stores a successfully defaced session's entry along with the outputs it produced."""
+    entry = dict(entry, outputs=get_session_outputs(output_dir, subj_id, sess_id, modes))
+    cache[unit_id] = entry
+    return entry
+
+
+def report(cache_stats, logger):
+    """Logs cache hits and misses, grouped by reason, at the end of a run.
+
+    :param dict cache_stats: Maps unit ids to (hit, reason) tuples.
+    :param logger: Logger object from main.py module.
+    """
+    if not cache_stats:
+        return
+    hits = [u for u, (hit, _) in cache_stats.items() if hit]
+    reasons = Counter(reason for hit, reason in cache_stats.values() if not hit)
+    logger.info(f"Result cache: {len(hits)} hit(s), {len(cache_stats) - len(hits)} miss(es).")
+    for reason, count in reasons.most_common():
+        logger.info(f"\t{count} miss(es): {reason}")
+    for unit_id, (hit, reason) in sorted(cache_stats.items()):
+        logger.debug(f"\t{unit_id}: {'hit' if hit else 'miss'} ({reason})")
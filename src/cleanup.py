@@ -0,0 +1,132 @@
+"""Deletes intermediate files in the background, off the critical path of each subject/session.
+
+Paths handed to discard are first renamed into a trash directory on the same filesystem, which is quick even on
+GPFS and frees their names at once, and then deleted by a small pool of threads while the process moves on to its
+next unit. Deleting a refacer work directory on a parallel filesystem takes tens of seconds that no CPU-bound work
+would otherwise overlap.
+
+Each process has its own service. Deletions still queued when a process exits are waited for by a multiprocessing
+finalizer, which runs at interpreter exit and when a pool worker shuts down after Pool.close(); a terminated pool
+worker is killed without running it, so the leftovers are removed with empty_trash at the start of the next run.
+"""
+
+import itertools
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from multiprocessing import util
+from pathlib import Path
+
+TRASH_DIRNAME = '.trash'
+DEFAULT_WORKERS = 4
+
+
+class CleanupService:
+    """Deletes files and directory trees on a bounded pool of threads.
+
+    :param int max_workers: Number of deletions running at the same time.
+    """
+
+    def __init__(self, max_workers=DEFAULT_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='cleanup')
+        self._futures = set()
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+    def discard(self, paths, trash_dir, logger=None):
+        """Moves paths into trash_dir and queues their deletion.
+
+        A path that can't be renamed into trash_dir, e.g. because it's on another filesystem, is deleted where it is.
+
+        :param list paths: Files and directories to delete; missing ones are skipped.
+        :param Path trash_dir: Directory on the same filesystem as the paths; created if needed.
+        :param logger: optional, Logger that deletion errors are reported to.
+        """
+        trash_dir = Path(trash_dir)
+        trash_dir.mkdir(parents=True, exist_ok=True)
+        moved = []
+        for path in map(Path, paths):
+            trashed = trash_dir / f'{os.getpid()}.{next(self._counter)}.{path.name}'
+            try:
+                os.rename(path, trashed)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                trashed = path
+            moved.append(trashed)
+        if moved:
+            self.submit(moved, logger)
+
+    def submit(self, paths, logger=None):
+        """Queues the deletion of paths where they are."""
+        future = self._executor.submit(delete, paths, logger)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def flush(self):
+        """Blocks until every queued deletion has finished."""
+        with self._lock:
+            pending = list(self._futures)
+        wait(pending)
+
+    def shutdown(self):
+        self.flush()
+        self._executor.shutdown()
+
+
+def delete(paths, logger=None):
+    """Deletes files and directory trees, reporting failures instead of raising them. Entries that are already gone,
+    e.g. removed by a deletion of an enclosing directory, are skipped."""
+    def report(_, path, exc_info):
+        if logger and not isinstance(exc_info[1], FileNotFoundError):
+            logger.error(f"Error in removing intermediate files: {exc_info[1]}")
+
+    for path in paths:
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(path, onerror=report)
+        else:
+            try:
+                path.unlink(missing_ok=True)
+            except OSError as err:
+                report(None, path, (type(err), err, None))
+
+
+_service = None
+_service_pid = None
+
+
+def get_service():
+    """The cleanup service of this process, flushed when the process exits.
+
+    The service is made per process: a forked pool worker inherits its parent's service but not its threads.
+    """
+    global _service, _service_pid
+    if _service is None or _service_pid != os.getpid():
+        _service = CleanupService()
+        _service_pid = os.getpid()
+        util.Finalize(_service, _service.shutdown, exitpriority=10)
+    return _service
+
+
+def discard(paths, trash_dir, logger=None):
+    """Moves paths into trash_dir and deletes them in the background; see CleanupService.discard."""
+    get_service().discard(paths, trash_dir, logger)
+
+
+def empty_trash(trash_dir, logger=None):
+    """Queues the deletion of whatever an earlier, interrupted run left in trash_dir."""
+    trash_dir = Path(trash_dir)
+    if trash_dir.is_dir():
+        get_service().submit(list(trash_dir.iterdir()), logger)
+
+
+def flush():
+    """Blocks until every deletion queued by this process has finished."""
+    if _service is not None and _service_pid == os.getpid():
+        _service.flush()
@@ -0,0 +1,265 @@
+"""Fans subjects/sessions out over a cluster as the tasks of a job array.
+
+Units are split into batches of --sessions-per-task. Each batch becomes one array task that runs
+``python cluster.py <manifest> <task index>`` and defaces its units one after another. Every finished unit leaves a
+JSON marker file with its outcome. The submitting process polls the markers and hands each outcome to the same result
+handling as a local run. Units without a marker once the array has finished were lost, e.g. to a node failure or a
+job time limit. They are reported with the failed units in one failure report. A failed squeue poll doesn't end the
+wait: the end of the job is confirmed with sacct, and polls whose outcome is unknown are retried with backoff.
+
+Submitters are pluggable: SlurmSubmitter submits through ``sbatch --array`` and LocalSubmitter runs the tasks as local
+processes, which is useful for testing the backend without a scheduler.
+"""
+
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+CLUSTER_DIRNAME = 'cluster'
+MANIFEST_FILENAME = 'manifest.json'
+FAILURE_REPORT_FILENAME = 'failure_report.json'
+EXECUTORS = ['pool', 'slurm', 'local']
+# sacct states of array tasks that have ended
+TERMINAL_STATES = {'BOOT_FAIL', 'CANCELLED', 'COMPLETED', 'DEADLINE', 'FAILED', 'NODE_FAIL', 'OUT_OF_MEMORY',
+                   'PREEMPTED', 'REVOKED', 'TIMEOUT'}
+# polls in a row the job's state may be unknown, with the interval doubling up to MAX_BACKOFF times, before the
+# units without a marker are reported as lost
+MAX_UNKNOWN_POLLS = 8
+MAX_BACKOFF = 8
+
+
+def get_marker_path(markers_dir, unit_id):
+    return markers_dir / f"{unit_id.replace('/', '_')}.json"
+
+
+def write_marker(markers_dir, unit_id, missing_refacer_out, error):
+    """Writes a unit's outcome atomically, so the submitting process never reads half a marker."""
+    marker = get_marker_path(markers_dir, unit_id)
+    tmp = marker.with_name(f'.{marker.name}.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump({'unit': unit_id, 'missing_refacer_outputs': missing_refacer_out, 'error': error}, f)
+    os.replace(tmp, marker)
+
+
+def read_marker(markers_dir, unit_id):
+    marker = get_marker_path(markers_dir, unit_id)
+    if not marker.exists():
+        return None
+    with open(marker, 'r') as f:
+        return json.load(f)
+
+
+class SlurmSubmitter:
+    """Submits the tasks as a SLURM job array with sbatch.
+
+    :param str sbatch_args: optional, Extra sbatch options, e.g. '--mem=16g --time=8:00:00 --partition=norm'.
+    :param int max_parallel: optional, Maximum number of array tasks running at once.
+    """
+
+    def __init__(self, sbatch_args='', max_parallel=None):
+        self.sbatch_args = sbatch_args
+        self.max_parallel = max_parallel
+
+    def submit(self, manifest_path, n_tasks, log_dir):
+        if n_tasks < 1:
+            raise ValueError(f"Cannot submit a job array of {n_tasks} tasks.")
+        array = f'0-{n_tasks - 1}' + (f'%{self.max_parallel}' if self.max_parallel else '')
+        script = log_dir / 'array_job.sh'
+        with open(script, 'w') as f:
+            f.write('#!/bin/bash\n'
+                    f'#SBATCH --job-name=dsst_defacing\n'
+                    f'#SBATCH --array={array}\n'
+                    f'#SBATCH --output={log_dir}/task_%a.log\n'
+                    f'{shlex.quote(sys.executable)} {shlex.quote(str(Path(__file__).resolve()))} '
+                    f'{shlex.quote(str(manifest_path))} "$SLURM_ARRAY_TASK_ID"\n')
+        result = subprocess.run(['sbatch', '--parsable'] + shlex.split(self.sbatch_args) + [str(script)],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf8')
+        if result.returncode != 0:
+            raise RuntimeError(f"sbatch failed: {result.stdout}")
+        return result.stdout.strip().split(';')[0]
+
+    def is_running(self, job_id):
+        """True while any task of the job is queued or running, False once all have ended and None if that can't be
+        told, e.g. while the controller doesn't respond."""
+        squeue = subprocess.run(['squeue', '--noheader', '--jobs', job_id], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, encoding='utf8')
+        if squeue.returncode == 0 and squeue.stdout.strip():
+            return True
+        # squeue fails for jobs that left the queue a while ago as well as on a timeout, so the end of the job is
+        # confirmed with the accounting records
+        sacct = subprocess.run(['sacct', '--noheader', '--allocations', '--jobs', job_id, '--format', 'State'],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, encoding='utf8')
+        states = {line.split()[0].rstrip('+') for line in sacct.stdout.splitlines() if line.strip()}
+        if sacct.returncode != 0 or not states:
+            # without accounting, an empty listing from a successful squeue is the best evidence there is
+            return False if squeue.returncode == 0 else None
+        return not states <= TERMINAL_STATES
+
+
+class LocalSubmitter:
+    """Runs the tasks as local processes, up to max_parallel at a time, in place of a cluster scheduler."""
+
+    def __init__(self, max_parallel=1):
+        self.max_parallel = max(1, max_parallel or 1)
+        self.threads = {}
+
+    def submit(self, manifest_path, n_tasks, log_dir):
+        def run_task(task_index):
+            with open(log_dir / f'task_{task_index}.log', 'w') as log:
+                subprocess.run([sys.executable, str(Path(__file__).resolve()), str(manifest_path), str(task_index)],
+                               stdout=log, stderr=subprocess.STDOUT)
+
+        def run_all():
+            with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+                list(executor.map(run_task, range(n_tasks)))
+
+        job_id = f'local-{len(self.threads)}'
+        self.threads[job_id] = threading.Thread(target=run_all, daemon=True)
+        self.threads[job_id].start()
+        return job_id
+
+    def is_running(self, job_id):
+        return self.threads[job_id].is_alive()
+
+
+def get_submitter(executor, sbatch_args='', max_parallel=None):
+    if executor == 'slurm':
+        return SlurmSubmitter(sbatch_args, max_parallel)
+    if executor == 'local':
+        return LocalSubmitter(max_parallel)
+    raise ValueError(f"Unknown executor: {executor}")
+
+
+def run_array(units, config, output_dir, submitter, sessions_per_task, on_result, logger, poll_interval=30):
+    """Submits units as a job array and waits for them, handing each outcome to on_result as its marker appears.
+
+    :param list units: (unit_id, subject name, session name) tuples.
+    :param dict config: Settings shared by all units: bids_input_dir, output_dir, mapping_path, index_path,
+        journal_path, modes, no_clean, reg_threads and mask_backend. Paths must be absolute.
+    :param Path output_dir: Absolute path to the output directory.
+    :param submitter: A SlurmSubmitter or LocalSubmitter.
+    :param int sessions_per_task: Number of units each array task defaces.
+    :param on_result: Called with (unit_id, missing refacer outputs, traceback) like scheduler.run_longest_first.
+    :param logger: Logger object imported from main.py module.
+    :param float poll_interval: Seconds between checks of the marker files.
+    :return dict: The failure report; see write_failure_report.
+    """
+    if not units:
+        logger.info("No subject/session left to deface; nothing submitted to the cluster.")
+        return {'finished': 0, 'failed': {}, 'lost': {}}
+
+    cluster_dir = output_dir / CLUSTER_DIRNAME
+    markers_dir = cluster_dir / 'markers'
+    log_dir = cluster_dir / 'logs'
+    markers_dir.mkdir(parents=True, exist_ok=True)
+    log_dir.mkdir(parents=True, exist_ok=True)
+    for unit_id, _, _ in units:
+        get_marker_path(markers_dir, unit_id).unlink(missing_ok=True)
+
+    batches = [units[i:i + sessions_per_task] for i in range(0, len(units), sessions_per_task)]
+    manifest_path = cluster_dir / MANIFEST_FILENAME
+    with open(manifest_path, 'w') as f:
+        json.dump({'config': {k: str(v) if isinstance(v, Path) else v for k, v in config.items()},
+                   'markers_dir': str(markers_dir),
+                   'batches': [[list(u) for u in batch] for batch in batches]}, f, indent=4)
+
+    job_id = submitter.submit(manifest_path, len(batches), log_dir)
+    logger.info(f"Submitted {len(units)} subject(s)/session(s) as {len(batches)} array task(s), job {job_id}. "
+                f"Task logs at {log_dir}")
+
+    task_of = {unit_id: idx for idx, batch in enumerate(batches) for unit_id, _, _ in batch}
+    outstanding = set(task_of)
+    results = {}
+    unknown_polls = 0
+    while outstanding:
+        running = submitter.is_running(job_id)
+        for unit_id in sorted(outstanding):
+            marker = read_marker(markers_dir, unit_id)
+            if marker is not None:
+                outstanding.discard(unit_id)
+                results[unit_id] = marker
+                on_result(unit_id, marker['missing_refacer_outputs'], marker['error'])
+        if running is False:
+            break  # markers written before the job left the queue have been read above
+        if running is None:
+            unknown_polls += 1
+            if unknown_polls > MAX_UNKNOWN_POLLS:
+                logger.error(f"Could not get the state of job {job_id} in {MAX_UNKNOWN_POLLS} tries; reporting "
+                             f"the {len(outstanding)} subject(s)/session(s) without a marker as lost.")
+                break
+            logger.warning(f"Could not get the state of job {job_id}; retrying ({unknown_polls}/{MAX_UNKNOWN_POLLS})")
+        else:
+            unknown_polls = 0
+        if outstanding:
+            time.sleep(poll_interval * min(2 ** unknown_polls, MAX_BACKOFF))
+
+    for unit_id in sorted(outstanding):
+        on_result(unit_id, None, f"Lost on the cluster; see {log_dir / f'task_{task_of[unit_id]}.log'}")
+    return write_failure_report(cluster_dir, results, outstanding, task_of, log_dir, logger)
+
+
+def write_failure_report(cluster_dir, results, lost, task_of, log_dir, logger):
+    """Gathers failed and lost units, with the log of the task that ran them, into one report."""
+    failed = {unit_id: {'error': r['error'] or f"AFNI refacer outputs missing for "
+                                              f"{[m for m in r['missing_refacer_outputs'] if m]}",
+                        'task_log': str(log_dir / f'task_{task_of[unit_id]}.log')}
+              for unit_id, r in results.items() if r['error'] or any(r['missing_refacer_outputs'] or [])}
+    lost = {unit_id: {'error': 'no marker; the array task was killed or failed before finishing this unit',
+                      'task_log': str(log_dir / f'task_{task_of[unit_id]}.log')} for unit_id in sorted(lost)}
+    report = {'finished': len(results) - len(failed), 'failed': failed, 'lost': lost}
+    with open(cluster_dir / FAILURE_REPORT_FILENAME, 'w') as f:
+        json.dump(report, f, indent=4)
+
+    if failed or lost:
+        logger.error(f"{len(failed)} subject(s)/session(s) failed and {len(lost)} were lost on the cluster; see "
+                     f"{cluster_dir / FAILURE_REPORT_FILENAME}")
+        for unit_id, entry in lost.items():
+            logger.error(f"{unit_id} lost, task log at {entry['task_log']}")
+    else:
+        logger.info(f"All {report['finished']} subject(s)/session(s) finished on the cluster.")
+    return report
+
+
+def run_task(manifest_path, task_index):
+    """Defaces the units of one array task, writing a marker for each one."""
+    # imported here so that only the array tasks load the defacing modules
+    import layout_index
+    import scheduler
+
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    config = manifest['config']
+    markers_dir = Path(manifest['markers_dir'])
+    with open(config['mapping_path'], 'r') as f:
+        mapping_dict = json.load(f)
+
+    scheduler.init_worker({'input_index': layout_index.get_filename_index(Path(config['index_path']))})
+    for unit_id, subject, session in manifest['batches'][task_index]:
+        marker = read_marker(markers_dir, unit_id)
+        if marker is not None and not marker['error'] and not any(marker['missing_refacer_outputs'] or []):
+            continue  # finished by an earlier attempt of this task
+        args = (Path(config['bids_input_dir']), Path(subject), Path(session) if session else None, mapping_dict,
+                Path(config['output_dir']), config['modes'], config['no_clean'], Path(config['journal_path']),
+                config['reg_threads'], config['mask_backend'])
+        _, missing_refacer_out, error = scheduler.run_unit(unit_id, args)
+        write_marker(markers_dir, unit_id, missing_refacer_out, error)
+        print(f"{unit_id}: {'failed' if error or any(missing_refacer_out or []) else 'finished'}", flush=True)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Run one array task of a cluster defacing run.')
+    parser.add_argument('manifest', type=Path, help=f'The {MANIFEST_FILENAME} written by main.py.')
+    parser.add_argument('task_index', type=int, help='Index of the array task.')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    run_task(args.manifest, args.task_index)
@@ -0,0 +1,186 @@
+"""Asyncio engine for the external commands the pipeline runs.
+
+Commands run in their own process group. Their stdout and stderr are read separately as they arrive and streamed,
+line by line, to a log file or logger, so nothing but a short tail of stderr is held in memory unless stdout is
+captured. Each command can have a timeout, looked up by tool name. When it expires, the whole process group gets
+SIGTERM and then, after a grace period, SIGKILL. Exit codes are reported as they are.
+
+The process is reaped with wait4 in a thread, rather than by asyncio's child watcher, so that resources.py can still
+record its CPU time, peak RSS and I/O. Any number of commands can run concurrently from one event loop.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+import resources
+
+TIMEOUTS_ENV = 'DEFACING_TIMEOUTS'
+# seconds; generous enough for 0.5 mm scans, short enough that a hung tool doesn't hold a worker slot all night
+DEFAULT_TIMEOUTS = {'@afni_refacer_run': 4 * 3600, 'flirt': 2 * 3600, 'flirt_applyxfm': 3600, 'fslroi': 1800,
+                    'fslmaths': 1800, 'fslroi+fslmaths': 1800, 'default': None}
+KILL_GRACE_PERIOD = 10
+STDERR_TAIL_LINES = 20
+
+_wait_executor = None
+_wait_executor_pid = None
+
+
+class CommandResult(NamedTuple):
+    returncode: int
+    stdout: str
+    stderr_tail: str
+    timed_out: bool
+    wall: float
+
+
+def parse_timeout(value):
+    """Parses a 'TOOL=SECONDS' argument into (tool, seconds); 'default' sets the timeout of all other tools and 0 turns
+    a timeout off."""
+    tool, _, seconds = value.rpartition('=')
+    try:
+        if not tool:
+            raise ValueError
+        return tool, float(seconds) or None
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid timeout {value}; expected TOOL=SECONDS, e.g. flirt=3600")
+
+
+def configure(timeouts):
+    """Overrides default timeouts for this process and the worker processes it starts."""
+    os.environ[TIMEOUTS_ENV] = json.dumps(timeouts)
+
+
+def get_timeout(tool):
+    timeouts = dict(DEFAULT_TIMEOUTS)
+    timeouts.update(json.loads(os.environ.get(TIMEOUTS_ENV, '{}')))
+    return timeouts.get(tool, timeouts['default'])
+
+
+def get_wait_executor():
+    """Threads that wait for commands to exit, one per running command.
+
+    The executor is made per process: a forked pool worker inherits its parent's executor but not its threads.
+    """
+    global _wait_executor, _wait_executor_pid
+    if _wait_executor is None or _wait_executor_pid != os.getpid():
+        _wait_executor = ThreadPoolExecutor(max_workers=256, thread_name_prefix='command-wait')
+        _wait_executor_pid = os.getpid()
+    return _wait_executor
+
+
+def wait_and_account(pid):
+    """Blocks until the process exits, reads its I/O counters while it's a zombie, then reaps it with wait4."""
+    io_bytes = None
+    if hasattr(os, 'waitid'):
+        os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+        io_bytes = resources.read_proc_io(pid)
+    _, status, rusage = os.wait4(pid, 0)
+    return os.waitstatus_to_exitcode(status), rusage, io_bytes
+
+
+def kill_group(pgid, sig):
+    try:
+        os.killpg(pgid, sig)
+    except ProcessLookupError:
+        pass
+
+
+async def pump(stream, sink, keep):
+    """Copies lines from a stream to sink as they arrive, keeping some of them with keep."""
+    while True:
+        line = await stream.readline()
+        if not line:
+            return
+        text = line.decode('utf8', errors='replace')
+        sink(text)
+        keep(text)
+
+
+async def run(cmd_str, log_fileobj=None, logger=None, tool=None, scan=None, timeout=None, capture=False):
+    """Runs a shell command, streaming its output as it arrives.
+
+    :param str cmd_str: A shell command formatted as a string variable.
+    :param io.TextIOWrapper log_fileobj: optional, File object stdout and stderr lines are written to.
+    :param logger: optional, Logger stdout and stderr lines are logged to at debug level.
+    :param str tool: optional, Tool name used for timeouts and resource accounting; taken from the command by default.
+    :param scan: optional, Path or filename of the scan the command works on.
+    :param float timeout: optional, Seconds before the command is killed; looked up by tool name by default.
+    :param bool capture: If True, stdout is also returned.
+    :return CommandResult: Exit code, captured stdout, the last lines of stderr, whether it timed out and wall time.
+    """
+    tool = tool or resources.get_tool_name(cmd_str)
+    timeout = timeout if timeout is not None else get_timeout(tool)
+    loop = asyncio.get_running_loop()
+
+    start = time.time()
+    proc = subprocess.Popen(cmd_str, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, start_new_session=True)
+
+    readers = []
+    for pipe in [proc.stdout, proc.stderr]:
+        reader = asyncio.StreamReader(limit=2 ** 20)
+        await loop.connect_read_pipe(lambda r=reader: asyncio.StreamReaderProtocol(r), pipe)
+        readers.append(reader)
+
+    stdout, stderr_tail = [], deque(maxlen=STDERR_TAIL_LINES)
+
+    def sink(prefix):
+        def write(text):
+            if log_fileobj is not None:
+                log_fileobj.write(text)
+                log_fileobj.flush()
+            if logger is not None:
+                logger.debug(f"{tool}{prefix}: {text.rstrip()}")
+        return write
+
+    pumps = [asyncio.ensure_future(pump(readers[0], sink(''), stdout.append if capture else lambda _: None)),
+             asyncio.ensure_future(pump(readers[1], sink(' stderr'), stderr_tail.append))]
+    waiter = loop.run_in_executor(get_wait_executor(), wait_and_account, proc.pid)
+
+    timed_out = False
+    try:
+        await asyncio.wait_for(asyncio.shield(waiter), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        kill_group(proc.pid, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), KILL_GRACE_PERIOD)
+        except asyncio.TimeoutError:
+            kill_group(proc.pid, signal.SIGKILL)
+    returncode, rusage, io_bytes = await waiter
+    proc.returncode = returncode
+
+    # processes the command left behind may still hold the pipes open
+    done, still_reading = await asyncio.wait(pumps, timeout=KILL_GRACE_PERIOD)
+    for task in still_reading:
+        task.cancel()
+    if timed_out:
+        kill_group(proc.pid, signal.SIGKILL)
+    for pipe in [proc.stdout, proc.stderr]:
+        pipe.close()
+
+    wall = time.time() - start
+    resources.record(cmd_str, tool, scan, wall, rusage, io_bytes, returncode)
+    return CommandResult(returncode, ''.join(stdout), ''.join(stderr_tail), timed_out, wall)
+
+
+def run_sync(cmd_str, **kwargs):
+    """Runs a command from synchronous code; see run."""
+    return asyncio.run(run(cmd_str, **kwargs))
+
+
+def describe_failure(cmd_str, result):
+    """Error message for a failed command, or None if it succeeded."""
+    if result.timed_out:
+        return f"timed out after {result.wall:.1f} s and was killed: {cmd_str}\n{result.stderr_tail}"
+    if result.returncode != 0:
+        return f"exited with code {result.returncode}: {cmd_str}\n{result.stderr_tail}"
+    return None
@@ -0,0 +1,185 @@
+"""Finds byte-identical anatomical scans so that each one is defaced only once.
+
+Archives often hold the same NIfTI file under several run labels, or whole sessions copied under another label. Scans
+are fingerprinted in stages so that most are never read in full: only scans of the same size are compared, by a hash
+of a few sampled blocks, and only those that still match are hashed in full.
+
+Duplicates are folded into the mapping dictionary in two ways:
+
+    duplicate_of   a subject/session whose scans all duplicate those of another subject/session, primary scan
+                   included, isn't defaced; the other's outputs are placed at its scans' locations once it's done
+    duplicates     within a subject/session, a scan that duplicates the primary scan or another "other" scan is
+                   taken out of 'others' and gets the defaced image of the scan it duplicates
+
+Outputs are placed with materialize.py, so they are reflinked, hardlinked or copied. A subject/session that shares
+only some of its scans with another is defaced as usual, since its "other" scans are registered to its own primary.
+"""
+
+import hashlib
+import json
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+import utils
+
+DUPLICATES_FILENAME = 'duplicate_scans.json'
+SAMPLE_SIZE = 64 * 1024
+N_SAMPLES = 4
+
+
+def sample_hash(filepath):
+    """Hashes the size of a file and N_SAMPLES blocks spread evenly over it, from its first to its last block."""
+    size = os.stat(filepath).st_size
+    sha = hashlib.sha256(str(size).encode('utf8'))
+    with open(filepath, 'rb') as f:
+        for i in range(N_SAMPLES):
+            f.seek(max(0, size - SAMPLE_SIZE) * i // (N_SAMPLES - 1))
+            sha.update(f.read(SAMPLE_SIZE))
+    return sha.hexdigest()
+
+
+def split_groups(groups, key_func, executor):
+    """Splits groups of files by a key computed on a thread pool, dropping files that are left on their own."""
+    paths = [p for group in groups for p in group]
+    keys = dict(zip(paths, executor.map(key_func, paths)))
+    split = []
+    for group in groups:
+        by_key = defaultdict(list)
+        for p in group:
+            by_key[keys[p]].append(p)
+        split.extend(members for members in by_key.values() if len(members) > 1)
+    return split
+
+
+def find_duplicate_groups(scans, n_threads=16):
+    """Groups byte-identical files.
+
+    :param list scans: Absolute paths to the scans, as strings.
+    :param int n_threads: Number of files stat'ed and hashed at the same time.
+    :return tuple: (list of groups, each a sorted list of two or more paths; {path: size in bytes})
+    """
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        sizes = dict(zip(scans, executor.map(lambda s: os.stat(s).st_size, scans)))
+        by_size = defaultdict(list)
+        for scan, size in sizes.items():
+            by_size[size].append(scan)
+        groups = [members for members in by_size.values() if len(members) > 1]
+        groups = split_groups(groups, sample_hash, executor)
+        digests = cache.hash_scans([p for group in groups for p in group], n_threads)
+        groups = split_groups(groups, digests.get, executor)
+    return sorted(sorted(group) for group in groups), sizes
+
+
+def iter_units(mapping_dict):
+    """Yields (subject id, session id, mapping entry) of every subject/session; the session id is empty for subjects
+    without sessions."""
+    for subj_id, value in sorted(mapping_dict.items()):
+        if 'primary_t1' in value:
+            yield subj_id, "", value
+        else:
+            for sess_id, entry in sorted(value.items()):
+                yield subj_id, sess_id, entry
+
+
+def get_duplicate_of(mapping_dict, subj_id, sess_id):
+    """{'unit': unit id, 'scans': {scan: scan it duplicates}} if a subject/session duplicates another, else None."""
+    return utils.get_mapping_entry(mapping_dict, subj_id, sess_id).get('duplicate_of')
+
+
+def fold_into_mapping(mapping_dict, groups, sizes):
+    """Records duplicate subjects/sessions and duplicate scans in the mapping dictionary; see the module docstring.
+
+    :param dict mapping_dict: A dictionary with primary to others mapping information, updated in place.
+    :param list groups: Groups of identical scans from find_duplicate_groups.
+    :param dict sizes: Scan sizes from find_duplicate_groups.
+    :return dict: Summary of what won't be defaced, as written to DUPLICATES_FILENAME.
+    """
+    group_of = {scan: idx for idx, group in enumerate(groups) for scan in group}
+
+    def content_key(entry):
+        def key(scan):
+            return ('group', group_of[scan]) if scan in group_of else ('scan', scan)
+        primary = key(entry['primary_t1']) if entry['primary_t1'] else None
+        return primary, tuple(sorted(key(s) for s in entry['others']))
+
+    # subjects/sessions with the same scans as one seen earlier
+    sources, duplicate_units = {}, {}
+    for subj_id, sess_id, entry in iter_units(mapping_dict):
+        if not entry['primary_t1'] and not entry['others']:
+            continue
+        content = content_key(entry)
+        if content not in sources:
+            sources[content] = (utils.get_unit_id(subj_id, sess_id), entry)
+            continue
+        source_id, source = sources[content]
+        scans = {entry['primary_t1']: source['primary_t1']} if entry['primary_t1'] else {}
+        source_others = defaultdict(list)
+        for s in source['others']:
+            source_others[group_of[s]].append(s)
+        for s in entry['others']:
+            scans[s] = source_others[group_of[s]].pop(0)
+        entry['duplicate_of'] = {'unit': source_id, 'scans': scans}
+        duplicate_units[utils.get_unit_id(subj_id, sess_id)] = source_id
+
+    # scans duplicating another scan of their own subject/session; the primary scan is always the one kept
+    duplicate_scans = {}
+    for subj_id, sess_id, entry in iter_units(mapping_dict):
+        members = defaultdict(list)
+        for s in ([entry['primary_t1']] if entry['primary_t1'] else []) + entry['others']:
+            if s in group_of:
+                members[group_of[s]].append(s)
+        duplicates = {dup: scans[0] for scans in members.values() for dup in scans[1:]}
+        if duplicates:
+            entry['others'] = [s for s in entry['others'] if s not in duplicates]
+            entry['duplicates'] = duplicates
+            if utils.get_unit_id(subj_id, sess_id) not in duplicate_units:
+                duplicate_scans.update(duplicates)
+
+    not_defaced = [s for subj_id, sess_id, entry in iter_units(mapping_dict)
+                   if utils.get_unit_id(subj_id, sess_id) in duplicate_units
+                   for s in entry['duplicate_of']['scans']] + list(duplicate_scans)
+    return {'groups': groups, 'duplicate_units': duplicate_units, 'duplicate_scans': duplicate_scans,
+            'bytes_not_defaced': sum(sizes[s] for s in not_defaced)}
+
+
+def deduplicate(mapping_dict, output_dir, logger, n_threads=16):
+    """Finds identical scans among those in the mapping dictionary, records them in it and writes a summary to
+    DUPLICATES_FILENAME in the output directory.
+
+    :return dict: The summary; see fold_into_mapping.
+    """
+    scans = [s for _, _, entry in iter_units(mapping_dict)
+             for s in ([entry['primary_t1']] if entry['primary_t1'] else []) + entry['others']]
+    groups, sizes = find_duplicate_groups(scans, n_threads)
+    summary = fold_into_mapping(mapping_dict, groups, sizes)
+
+    with open(output_dir / DUPLICATES_FILENAME, 'w') as f:
+        json.dump(summary, f, indent=4)
+    if groups:
+        logger.info(f"Found {len(groups)} group(s) of byte-identical scans: {len(summary['duplicate_units'])} "
+                    f"subject(s)/session(s) duplicate another one and {len(summary['duplicate_scans'])} scan(s) "
+                    f"duplicate a scan of their own subject/session. {summary['bytes_not_defaced'] / 1e6:.1f} MB of "
+                    f"input won't be defaced again; see {output_dir / DUPLICATES_FILENAME}")
+    return summary
+
+
+def report(unit_ids, placed_units, duplicate_units, mapping_dict, logger):
+    """Logs the subjects/sessions and scans of a run that weren't defaced because they duplicate others.
+
+    :param list unit_ids: Ids of the subjects/sessions defaced in this run.
+    :param list placed_units: Ids of duplicate subjects/sessions whose outputs were placed in this run.
+    :param dict duplicate_units: Ids of the duplicate subjects/sessions of this run to the ids they duplicate.
+    """
+    def get_entry(unit_id):
+        subj_id, _, sess_id = unit_id.partition('/')
+        return utils.get_mapping_entry(mapping_dict, subj_id, sess_id)
+
+    n_scans = sum(len(get_entry(unit_id).get('duplicates', {})) for unit_id in unit_ids)
+    if not duplicate_units and not n_scans:
+        return
+    n_unit_scans = sum(len(get_entry(unit_id)['duplicate_of']['scans']) for unit_id in placed_units)
+    logger.info(f"Deduplication: placed the outputs of {len(placed_units)} of {len(duplicate_units)} duplicate "
+                f"subject(s)/session(s) ({n_unit_scans} scan(s)) instead of defacing them, and reused defaced images "
+                f"for {n_scans} duplicate scan(s) within the defaced subjects/sessions.")
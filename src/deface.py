@@ -1,13 +1,18 @@
-import gzip
 import re
 import shutil
-import subprocess
-from os import fspath
 from pathlib import Path
 import logging
 import logging.config
 import logging.handlers
+import cleanup
+import journal
+import materialize
+import mode_shells
+import qc_montage
 import register
+import render
+import staging
+import tracing
 import utils
 
 
@@ -15,6 +20,11 @@ def setup_logger(log_filepath):
     logger = logging.getLogger(__name__)
     logger.setLevel(logging.DEBUG)
 
+    # a worker defaces many subjects/sessions; drop the handlers of the previous one so its log file isn't appended to
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
     # setup formatters
     brief_formatter = logging.Formatter('%(levelname)s: %(message)s')
     precise_formatter = logging.Formatter(fmt='%(asctime)s line %(lineno)d: %(message)s',
@@ -36,17 +46,15 @@ def setup_logger(log_filepath):
     return logger
 
 
-def rename_afni_workdir(workdir_path, subj_logger):
+def rename_afni_workdir(workdir_path, trash_dir, subj_logger):
     subj_logger.info(f"Removing unwanted files and renaming AFNI workdirs\n")
     default_prefix = workdir_path.name.split('.')[1]
     required_file_suffixes = ('QC', 'defacing_pipeline.log')
     to_be_deleted_files = [
-        str(f) for f in list(workdir_path.parent.glob('*'))
+        f for f in list(workdir_path.parent.glob('*'))
         if not (f.name.startswith('__work') or f.name.endswith(required_file_suffixes))]
-    out, err = utils.run_command(f"rm -rf {' '.join(to_be_deleted_files)}")
-    if err:
-        subj_logger.error(f"Error in removing intermediate files: {err}")
-    subj_logger.info(f"Intermediate files removed.\n")
+    cleanup.discard(to_be_deleted_files, trash_dir, subj_logger)
+    subj_logger.info(f"Intermediate files queued for removal.\n")
 
     new_workdir_path = workdir_path.parent / f'workdir_{default_prefix}'
     workdir_path.rename(new_workdir_path)
@@ -81,36 +89,42 @@ def get_anat_dir_paths(subj_dir_path):
 
 
 def compress_to_gz(input_file, output_file):
-    if not output_file.exists():
-        with open(input_file, 'rb') as f_input:
-            with gzip.open(output_file, 'wb') as f_output:
-                f_output.writelines(f_input)
+    utils.compress_to_gz(input_file, output_file)
 
 
 def copy_over_sidecar(scan_filepath, input_anat_dir, output_anat_dir):
     prefix = '_'.join([i for i in re.split('_|\.', scan_filepath.name) if i not in ['defaced', 'nii', 'gz']])
     filename = prefix + '.json'
     json_sidecar = input_anat_dir / filename
-    shutil.copy2(json_sidecar, output_anat_dir / filename)
+    materialize.materialize(json_sidecar, output_anat_dir / filename)
 
 
-def generate_3d_renders(defaced_img, render_outdir):
-    rotations = [(45, 5, 10), (-45, 5, 10)]
-    for idx, rot in enumerate(rotations):
-        yaw, pitch, roll = rot[0], rot[1], rot[2]
-        outfile = render_outdir.joinpath('defaced_render_0' + str(idx) + '.png')
-        if not outfile.exists():
-            fsleyes_render_cmd = f"module load fsl; fsleyes render --scene 3d -rot {yaw} {pitch} {roll} --outfile {outfile} {defaced_img} --displayRange 20 250 --interpolation spline --cmap render1 --blendFactor 0.3 -r 100 --numSteps 500"
+def generate_3d_renders(defaced_img, render_outdir, logger=None):
+    """Renders the 3D views of one defaced image; see render.render_queue for rendering many images."""
+    with render.BatchRenderer(logger or logging.getLogger(__name__)) as renderer:
+        renderer.render(defaced_img, render_outdir)
 
-            print(fsleyes_render_cmd)
-            out, err = utils.run_command(fsleyes_render_cmd)
 
-            if err:
-                print(f"Error in rendering {defaced_img.name} with fsleyes.\n{err}")
-            print(f"Has the render been created? {outfile.exists()}")
+def find_original_scan(bids_input_dir, filename, input_index=None):
+    """Finds the input scan a defaced image was made from.
+
+    :param Path bids_input_dir: Absolute path to the input BIDS dataset.
+    :param str filename: Name of the defaced image.
+    :param dict input_index: optional, Filename to path index from layout_index.get_filename_index. Without it the
+        input dataset is searched recursively.
+    :return Path: Absolute path to the input scan.
+    """
+    # "other" scans are always written out as .nii.gz, even when the input was a .nii file
+    candidates = [filename, filename[:-len('.gz')]] if filename.endswith('.nii.gz') else [filename]
+    if input_index is None:
+        input_index = {c: p for c in candidates for p in bids_input_dir.rglob(c)}
+    for candidate in candidates:
+        if candidate in input_index:
+            return Path(input_index[candidate])
+    raise FileNotFoundError(f"Could not find {filename} in {bids_input_dir}.")
 
 
-def vqcdeface_prep(bids_input_dir, defaced_anat_dir, bids_defaced_outdir):
+def vqcdeface_prep(bids_input_dir, defaced_anat_dir, bids_defaced_outdir, input_index=None):
     defacing_qc_dir = bids_defaced_outdir.parent / 'defacing_QC'
     interested_files = [f for f in defaced_anat_dir.rglob('*.nii.gz') if
                         'work_dir' not in str(f).split('/')]
@@ -123,17 +137,62 @@ def vqcdeface_prep(bids_input_dir, defaced_anat_dir, bids_defaced_outdir):
         defaced_link = vqcd_subj_dir / 'defaced.nii.gz'
         if not defaced_link.is_symlink():
             defaced_link.symlink_to(defaced_img)
-        print(list(bids_input_dir.rglob(defaced_img.name)))
-        img = list(bids_input_dir.rglob(defaced_img.name))[0]
+        img = find_original_scan(bids_input_dir, defaced_img.name, input_index)
         img_link = vqcd_subj_dir / 'orig.nii.gz'
         if not img_link.is_symlink(): img_link.symlink_to(img)
 
+        # remade every time, since the image has just been defaced
+        if qc_montage.is_enabled():
+            with tracing.span('qc_montage'):
+                _, err = qc_montage.make_montage_safely(vqcd_subj_dir)
+            if err:
+                print(f"Error in making the QC montage of {vqcd_subj_dir}:\n{err}")
+
+
+def get_defaced_path(input_bids_dir, bids_defaced_outdir, scan):
+    """Path of the defaced image of an input scan in a 'bids_defaced' tree."""
+    defaced = bids_defaced_outdir / Path(scan).relative_to(input_bids_dir)
+    # "other" scans are always written out as .nii.gz, even when the input was a .nii file
+    if not defaced.exists() and defaced.name.endswith('.nii'):
+        defaced = defaced.with_name(defaced.name + '.gz')
+    return defaced
+
+
+def place_duplicates(input_bids_dir, duplicates, source_outdir, bids_defaced_outdir):
+    """Places the defaced image of the scan each duplicate scan is identical to, with the duplicate's own sidecar.
+
+    :param Path input_bids_dir: Absolute path to the input BIDS dataset.
+    :param dict duplicates: Absolute paths of duplicate scans to those of the scans they are identical to.
+    :param Path source_outdir: 'bids_defaced' tree with the defaced images of the scans duplicated.
+    :param Path bids_defaced_outdir: 'bids_defaced' tree the duplicates' defaced images are placed in.
+    """
+    for dup, scan in duplicates.items():
+        dup, defaced_img = Path(dup), get_defaced_path(input_bids_dir, source_outdir, scan)
+        dup_defaced = bids_defaced_outdir / dup.relative_to(input_bids_dir)
+        if defaced_img.name.endswith('.gz') and not dup_defaced.name.endswith('.gz'):
+            dup_defaced = dup_defaced.with_name(dup_defaced.name + '.gz')
+        dup_defaced.parent.mkdir(parents=True, exist_ok=True)
+        materialize.materialize(defaced_img, dup_defaced)
+        copy_over_sidecar(dup, dup.parent, dup_defaced.parent)
+
 
-def reorganize_into_bids(input_bids_dir, subj_id, sess_id, primary_scan, bids_defaced_outdir, no_clean, subj_logger):
+def get_unit_anat_dirs(bids_defaced_outdir, subj_id, sess_id):
     if sess_id:
-        anat_dirs = list(bids_defaced_outdir.joinpath(subj_id, sess_id).rglob('anat'))
-    else:
-        anat_dirs = list(bids_defaced_outdir.joinpath(subj_id).rglob('anat'))
+        return list(bids_defaced_outdir.joinpath(subj_id, sess_id).rglob('anat'))
+    return list(bids_defaced_outdir.joinpath(subj_id).rglob('anat'))
+
+
+def prepare_qc(input_bids_dir, subj_id, sess_id, bids_defaced_outdir, journal_path=None, input_index=None):
+    """Links the defaced images of a subject or session and their originals into the defacing_QC tree."""
+    for anat_dir in get_unit_anat_dirs(bids_defaced_outdir, subj_id, sess_id):
+        with journal.stage(journal_path, utils.get_unit_id(subj_id, sess_id), 'vqcdeface_prep'), \
+                tracing.span('vqcdeface_prep', subject=subj_id, session=sess_id):
+            vqcdeface_prep(input_bids_dir, anat_dir, bids_defaced_outdir, input_index)
+
+
+def reorganize_into_bids(input_bids_dir, subj_id, sess_id, primary_scan, bids_defaced_outdir, no_clean, subj_logger,
+                         journal_path=None, input_index=None, qc_prep=True, duplicates=None):
+    anat_dirs = get_unit_anat_dirs(bids_defaced_outdir, subj_id, sess_id)
 
     # make workdir for each session within anat dir
     for anat_dir in anat_dirs:
@@ -142,7 +201,8 @@ def reorganize_into_bids(input_bids_dir, subj_id, sess_id, primary_scan, bids_de
             if nii_filepath.name.startswith('tmp.99.result'):
                 # convert to nii.gz, rename and copy over to anat dir
                 gz_file = anat_dir / Path(primary_scan).name
-                utils.compress_to_gz(nii_filepath, gz_file)
+                with tracing.span('gzip', **tracing.scan_tags(primary_scan)):
+                    utils.compress_to_gz(nii_filepath, gz_file)
 
                 # copy over corresponding json sidecar
                 copy_over_sidecar(Path(primary_scan), input_bids_dir / anat_dir.relative_to(bids_defaced_outdir),
@@ -150,7 +210,7 @@ def reorganize_into_bids(input_bids_dir, subj_id, sess_id, primary_scan, bids_de
 
             elif nii_filepath.name.endswith('_defaced.nii.gz'):
                 new_filename = '_'.join(nii_filepath.name.split('_')[:-1]) + '.nii.gz'
-                shutil.copy2(nii_filepath, str(anat_dir / new_filename))
+                materialize.materialize(nii_filepath, anat_dir / new_filename)
 
                 copy_over_sidecar(nii_filepath, input_bids_dir / anat_dir.relative_to(bids_defaced_outdir), anat_dir)
 
@@ -164,15 +224,32 @@ def reorganize_into_bids(input_bids_dir, subj_id, sess_id, primary_scan, bids_de
             elif dirpath.name.endswith('QC'):
                 shutil.move(str(dirpath), str(intermediate_files_dir))
 
-        vqcdeface_prep(input_bids_dir, anat_dir, bids_defaced_outdir)
-
         if not no_clean:
-            shutil.rmtree(intermediate_files_dir)
+            with tracing.span('cleanup', subject=subj_id, session=sess_id):
+                cleanup.discard([intermediate_files_dir], bids_defaced_outdir.parent / cleanup.TRASH_DIRNAME,
+                                subj_logger)
 
+    if duplicates:
+        with tracing.span('place_duplicates', subject=subj_id, session=sess_id):
+            place_duplicates(input_bids_dir, duplicates, bids_defaced_outdir, bids_defaced_outdir)
 
-def run_afni_refacer(primary_t1, others, subj_input_dir, sess_id, output_dir, mode, subj_logger):
+    # QC links point at the final location of the defaced images, so a staged unit is linked once it is published
+    if qc_prep:
+        prepare_qc(input_bids_dir, subj_id, sess_id, bids_defaced_outdir, journal_path, input_index)
+
+
+def run_afni_refacer(primary_t1, others, subj_input_dir, sess_id, bids_output_dirs, subj_logger, journal_path=None,
+                     reg_threads=1, mask_backend='native'):
+    """Runs the AFNI refacer on the primary scan in the first mode and defaces it in the other modes with the same
+    alignment, see mode_shells.py, then registers the "other" scans to it once and applies the defacemask of every
+    mode to them.
+
+    :param dict bids_output_dirs: Absolute path to the 'bids_defaced' tree of each defacing mode.
+    :return str: Prefix of the primary scan if a refacer work directory is missing, otherwise an empty string.
+    """
     # constructing afni refacer command
     subj_id = subj_input_dir.name
+    unit_id = utils.get_unit_id(subj_id, sess_id)
 
     all_primaries = []
     if primary_t1:
@@ -194,80 +271,186 @@ def run_afni_refacer(primary_t1, others, subj_input_dir, sess_id, output_dir, mo
             else:
                 acq = ""
 
-        subj_output_dir = output_dir / subj_id / sess_id / 'anat' / acq
-        if not subj_output_dir.exists():
-            subj_output_dir.mkdir(parents=True, exist_ok=True)  # make output directories within subject directory
-
         prefix = primary.name.split('.')[0]  # filename without the extension
+        missing_refacer_out = ""
+        new_afni_workdirs = []
+        alignment = None  # matrix of the first mode's refacer run that the other modes reuse; see mode_shells.py
+        for mode_idx, (mode, output_dir) in enumerate(bids_output_dirs.items()):
+            subj_output_dir = output_dir / subj_id / sess_id / 'anat' / acq
+            if not subj_output_dir.exists():
+                subj_output_dir.mkdir(parents=True, exist_ok=True)  # make output directories within subject directory
+
+            # construct afni refacer commands
+            refacer_cmd = f"@afni_refacer_run -input {primary_t1} -mode_deface -no_clean -prefix {subj_output_dir / prefix}"
+            if mode == 'aggressive':
+                refacer_cmd = f"{refacer_cmd} -shell {mode_shells.SHELLS['aggressive']}"
+
+            # TODO remove module load afni
+            full_cmd = f"module load afni ;  {refacer_cmd}"
+
+            # TODO make log text less ugly; perhaps in a separate function
+            if sess_id:
+                log_filename = subj_output_dir / f'{subj_id}_{sess_id}_defacing_pipeline.log'
+            else:
+                log_filename = subj_output_dir / f'{subj_id}_defacing_pipeline.log'
+
+            log_fileobj = open(log_filename, 'w')
+
+            err = "no alignment to reuse"
+            if alignment is not None:
+                print(f"Defacing {primary.name} in {mode} mode with the alignment of the "
+                      f"{next(iter(bids_output_dirs))} mode")
+                with journal.stage(journal_path, unit_id, 'refacer'), \
+                        tracing.span('apply_refacer_shell', mode=mode, **tracing.scan_tags(primary)):
+                    err = mode_shells.deface_mode(alignment, primary, mode,
+                                                  subj_output_dir / f'__work_refacer.{prefix}.{mode}', subj_logger,
+                                                  log_fileobj)
+                if err:
+                    subj_logger.warning(f"Could not reuse the refacer alignment in {mode} mode, running "
+                                        f"@afni_refacer_run instead: {err}")
 
-        # construct afni refacer commands
-        refacer_cmd = f"@afni_refacer_run -input {primary_t1} -mode_deface -no_clean -prefix {subj_output_dir / prefix}"
-        if mode == 'aggressive':
-            refacer_cmd = f"{refacer_cmd} -shell afni_refacer_shell_sym_2.0.nii.gz"
-
-
-        # TODO remove module load afni
-        full_cmd = f"module load afni ;  {refacer_cmd}"
-
-        # TODO make log text less ugly; perhaps in a separate function
-        if sess_id:
-            log_filename = subj_output_dir / f'{subj_id}_{sess_id}_defacing_pipeline.log'
-        else:
-            log_filename = subj_output_dir / f'{subj_id}_defacing_pipeline.log'
-
-        log_fileobj = open(log_filename, 'w')
-        log_fileobj.write(
-            f"================================ afni_refacer_run command ================================\n"
-            f"{full_cmd}\n"
-            f"==========================================================================================\n")
-        log_fileobj.flush()  # clear file object buffer
-
-        # stdout text
-        print(f"Running @afni_refacer_run on {primary.name}\nCommand logs at {log_filename}")
-        run_command(full_cmd, log_fileobj)
-        print(f"@afni_refacer_run command completed on {primary.name}\n")
-
-        # rename afni workdirs
-        workdir_list = list(subj_output_dir.glob('*work_refacer*'))
-        if len(workdir_list) > 0:
-            missing_refacer_out = ""
-            new_afni_workdir = rename_afni_workdir(workdir_list[0], subj_logger)
+            if err:
+                log_fileobj.write(
+                    f"================================ afni_refacer_run command ================================\n"
+                    f"{full_cmd}\n"
+                    f"==========================================================================================\n")
+                log_fileobj.flush()  # clear file object buffer
+
+                # stdout text
+                print(f"Running @afni_refacer_run in {mode} mode on {primary.name}\nCommand logs at {log_filename}")
+                with journal.stage(journal_path, unit_id, 'refacer'), \
+                        tracing.span('afni_refacer_run', 'command', mode=mode, **tracing.scan_tags(primary)):
+                    _, err = utils.run_command(full_cmd, log_fileobj, tool='@afni_refacer_run', scan=primary)
+                    if err:
+                        subj_logger.error(f"@afni_refacer_run {err}")
+                        raise Exception(f"@afni_refacer_run failed on {primary.name}: {err}")
+                print(f"@afni_refacer_run command completed on {primary.name}\n")
+
+            # rename afni workdirs
+            workdir_list = list(subj_output_dir.glob('*work_refacer*'))
+            if len(workdir_list) > 0:
+                with tracing.span('cleanup_afni_workdir', **tracing.scan_tags(primary)):
+                    new_afni_workdirs.append(rename_afni_workdir(
+                        workdir_list[0], output_dir.parent / cleanup.TRASH_DIRNAME, subj_logger))
+                if mode_idx == 0 and len(bids_output_dirs) > 1:
+                    with tracing.span('find_refacer_alignment', **tracing.scan_tags(primary)):
+                        alignment = mode_shells.find_alignment(new_afni_workdirs[0], primary, mode, log_fileobj)
+                    if alignment is None:
+                        subj_logger.warning(f"No matrix in the refacer's work directory reproduces its shell mask; "
+                                            f"running @afni_refacer_run in every mode on {primary.name}.")
+            else:
+                subj_logger.error(
+                    f"AFNI refacer's work directory not found. Most probably because the refacer command failed.")
+                missing_refacer_out = prefix
 
+        if not missing_refacer_out:
             # register other scans to the primary scan
-            register.register_to_primary_scan(subj_input_dir, new_afni_workdir, primary, all_others, subj_logger)
-
-        else:
-            subj_logger.error(
-                f"AFNI refacer's work directory not found. Most probably because the refacer command failed.")
-            missing_refacer_out = prefix
+            with journal.stage(journal_path, unit_id, 'registration'), \
+                    tracing.span('register_to_primary_scan', **tracing.scan_tags(primary)):
+                register.register_to_primary_scan(subj_input_dir, new_afni_workdirs, primary, all_others,
+                                                  subj_logger, reg_threads, mask_backend)
 
         return missing_refacer_out
 
 
-def deface_primary_scan(input_bids_dir, subj_input_dir, sess_dir, mapping_dict, output_dir, mode, no_clean):
-    
+def deface_primary_scan(input_bids_dir, subj_input_dir, sess_dir, mapping_dict, output_dir, modes, no_clean,
+                        journal_path=None, reg_threads=1, mask_backend='native', input_index=None):
+    """Defaces one subject or session in every mode, writing each mode's results to its own output tree.
+
+    :param Path output_dir: Absolute path to the pipeline's output directory.
+    :param list modes: Defacing modes; see utils.get_mode_output_dirs for where their outputs go.
+    :return list: Prefixes of primary scans whose refacer outputs are missing.
+    """
+
     missing_refacer_outputs = []  # list to capture missing afni refacer workdirs
     
     subj_id = Path(subj_input_dir).name
     sess_id = Path(sess_dir).name if sess_dir else ""
-
-    if not sess_id:
-        log_filepath = bids_output_dir.parent / 'logs' / f'{subj_id}_defacing.log'
-        primary_t1 = mapping_dict[subj_id]['primary_t1']
-        others = [str(s) for s in mapping_dict[subj_id]['others'] if s != primary_t1]
-        missing_refacer_outputs.append(run_afni_refacer(primary_t1, others, subj_input_dir, "", output_dir, mode))
-        print(f"Reorganizing {subj_input_dir} with defaced images into BIDS tree...\n")
+    unit_id = utils.get_unit_id(subj_id, sess_id)
+    journal.record(journal_path, unit_id, 'unit', 'started')
+    staging_dir = None
+
+    try:
+        if not sess_id:
+            log_filepath = output_dir / 'logs' / f'{subj_id}_defacing.log'
+            primary_t1 = mapping_dict[subj_id]['primary_t1']
+            others = [str(s) for s in mapping_dict[subj_id]['others'] if s != primary_t1]
+        else:
+            log_filepath = output_dir / 'logs' / f'{subj_id}_{sess_id}_defacing.log'
+            primary_t1 = mapping_dict[subj_id][sess_id]['primary_t1']
+            others = [str(s) for s in mapping_dict[subj_id][sess_id]['others'] if s != primary_t1]
+
+        subj_level_logger = setup_logger(log_filepath)
+        subj_level_logger.info(f"Command logs at {log_filepath}\n")
+        materialize.reset_stats()
+        bids_output_dirs = {mode: mode_dir / 'bids_defaced'
+                            for mode, mode_dir in utils.get_mode_output_dirs(output_dir, modes).items()}
+
+        # with a scratch directory, the unit works in a copy of the output layout there and is published at the end
+        scratch_dir = staging.get_scratch_dir()
+        if scratch_dir is not None:
+            staging_dir = staging.make_unit_dir(scratch_dir, unit_id)
+            work_dirs = {mode: staging_dir / mode / 'bids_defaced' for mode in bids_output_dirs}
+            subj_level_logger.info(f"Staging intermediates in {staging_dir}\n")
+        else:
+            work_dirs = bids_output_dirs
+
+        missing_refacer_outputs.append(
+            run_afni_refacer(primary_t1, others, input_bids_dir / subj_id, sess_id, work_dirs,
+                             subj_level_logger, journal_path, reg_threads, mask_backend))
+
+        # reorganizing the directory with defaced images into BIDS tree
+        for mode, work_dir in work_dirs.items():
+            print(f"Reorganizing {subj_id} {sess_id} with {mode} defaced images into BIDS tree...\n")
+            with journal.stage(journal_path, unit_id, 'reorganize'), \
+                    tracing.span('reorganize_into_bids', subject=subj_id, session=sess_id, mode=mode):
+                reorganize_into_bids(input_bids_dir, subj_id, sess_id, primary_t1, work_dir, no_clean,
+                                     subj_level_logger, journal_path, input_index, qc_prep=scratch_dir is None,
+                                     duplicates=utils.get_mapping_entry(mapping_dict, subj_id, sess_id).get(
+                                         'duplicates'))
+
+        if scratch_dir is not None:
+            for mode, work_dir in work_dirs.items():
+                with journal.stage(journal_path, unit_id, 'publish'), \
+                        tracing.span('publish', subject=subj_id, session=sess_id, mode=mode):
+                    staging.publish(work_dir.joinpath(subj_id, sess_id),
+                                    bids_output_dirs[mode].joinpath(subj_id, sess_id), bids_output_dirs[mode].parent)
+                prepare_qc(input_bids_dir, subj_id, sess_id, bids_output_dirs[mode], journal_path, input_index)
+        subj_level_logger.info(materialize.summarize(materialize.get_stats()))
+    except Exception as err:
+        journal.record(journal_path, unit_id, 'unit', 'failed', error=str(err))
+        raise
+    finally:
+        if staging_dir is not None:
+            cleanup.discard([staging_dir], staging_dir.parent / cleanup.TRASH_DIRNAME)
+
+    if any(missing_refacer_outputs):
+        journal.record(journal_path, unit_id, 'unit', 'failed', error='AFNI refacer output missing')
     else:
-        log_filepath = bids_output_dir.parent / 'logs' / f'{subj_id}_{sess_id}_defacing.log'
-        primary_t1 = mapping_dict[subj_id][sess_id]['primary_t1']
-        others = [str(s) for s in mapping_dict[subj_id][sess_id]['others'] if s != primary_t1]
-
-    subj_level_logger = setup_logger(log_filepath)
-    subj_level_logger.info(f"Command logs at {log_filepath}\n")
-    missing_refacer_outputs.append(
-        run_afni_refacer(primary_t1, others, bids_input_dir, sess_id, bids_output_dir, mode, subj_level_logger))
+        journal.record(journal_path, unit_id, 'unit', 'finished')
 
-    # reorganizing the directory with defaced images into BIDS tree
-    reorganize_into_bids(input_bids_dir, subj_input_dir, sess_dir, primary_t1, output_dir, no_clean, subj_level_logger)
-    
     return missing_refacer_outputs
+
+
+def place_duplicate_unit(input_bids_dir, subj_id, sess_id, duplicate_of, output_dir, modes, journal_path=None,
+                         input_index=None):
+    """Fills in a subject or session whose scans all duplicate those of another, already defaced, subject or session
+    by placing the other's defaced images at its scans' locations; see dedupe.py.
+
+    :param dict duplicate_of: The 'duplicate_of' entry of the subject or session in the mapping dictionary.
+    :return list: No missing refacer outputs, like deface_primary_scan.
+    """
+    unit_id = utils.get_unit_id(subj_id, sess_id)
+    journal.record(journal_path, unit_id, 'unit', 'started')
+    try:
+        for mode_dir in utils.get_mode_output_dirs(output_dir, modes).values():
+            bids_defaced_outdir = mode_dir / 'bids_defaced'
+            with journal.stage(journal_path, unit_id, 'place_duplicates'), \
+                    tracing.span('place_duplicates', subject=subj_id, session=sess_id):
+                place_duplicates(input_bids_dir, duplicate_of['scans'], bids_defaced_outdir, bids_defaced_outdir)
+            prepare_qc(input_bids_dir, subj_id, sess_id, bids_defaced_outdir, journal_path, input_index)
+    except Exception as err:
+        journal.record(journal_path, unit_id, 'unit', 'failed', error=str(err))
+        raise
+    journal.record(journal_path, unit_id, 'unit', 'finished')
+    return [""]
@@ -14,11 +14,21 @@
 """
 
 import json
+import os
 import random
-import subprocess
+import re
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import dedupe
+import layout_index
+import tracing
+import utils
+
+ACQ_TIME_KEYS = ["AcquisitionTime", "AcquisitionDateTime"]
+ACQ_TIME_PATTERN = re.compile(r'"(AcquisitionTime|AcquisitionDateTime)"\s*:\s*"([^"]*)"')
+
 
 def run_command(cmdstr, logfile):
     """Runs the given command str as shell subprocess. If logfile object is provided, then the stdout and stderr of the
@@ -27,33 +37,52 @@ def run_command(cmdstr, logfile):
     :param str cmdstr: A shell command formatted as a string variable.
     :param io.TextIOWrapper logfile: optional, File object to log the stdout and stderr of the subprocess.
     """
-    if not logfile:
-        logfile = subprocess.PIPE
-    subprocess.run(cmdstr, stdout=logfile, stderr=subprocess.STDOUT, encoding='utf8', shell=True)
+    return utils.run_command(cmdstr, logfile)
+
+
+def read_acq_time(sidecar):
+    """Reads the acquisition time of a scan from its JSON sidecar.
+
+    Only the "AcquisitionTime" and "AcquisitionDateTime" fields are picked out of the raw text; the sidecar is
+    fully parsed only if one of them is present but not a plain string. "AcquisitionDateTime" takes precedence.
+
+    :param Path sidecar: Absolute path to a JSON sidecar.
+    :return: The acquisition time, or None if the sidecar has neither field.
+    """
+    with open(sidecar, 'r') as f:
+        text = f.read()
+
+    fields = dict(ACQ_TIME_PATTERN.findall(text))
+    if not fields and any(key in text for key in ACQ_TIME_KEYS):
+        data = json.loads(text)
+        fields = {key: data[key] for key in ACQ_TIME_KEYS if key in data}
+
+    for key in reversed(ACQ_TIME_KEYS):
+        if key in fields:
+            return fields[key]
+    return None
 
 
-def sort_by_acq_time(sidecars):
+def sort_by_acq_time(sidecars, logger, acq_times=None):
     """Sorting a list of scans' JSON sidecars based on their acquisition time.
 
     :param list sidecars: A list of JSON sidecars for all T1w scans in within a session.
+    :param logger: Logger object imported from main.py module.
+    :param dict acq_times: optional, Acquisition times already read from the sidecars, keyed by sidecar path.
     :return list acq_time_sorted_list: A list of JSON sidecar file paths sorted by acquisition time in descending order.
     """
-    sidecar_acq_time_map = dict()
-    acq_time_keys = ["AcquisitionTime", "AcquisitionDateTime"]
-    for sidecar in sidecars:
-        with open(sidecar, 'r') as f:
-            data = json.load(f)
-            for key in acq_time_keys:
-                if key in data.keys():
-                    sidecar_acq_time_map[sidecar] = data[key]
+    if acq_times is None:
+        acq_times = {sidecar: read_acq_time(sidecar) for sidecar in sidecars}
+    sidecar_acq_time_map = {sidecar: acq_times[sidecar] for sidecar in sidecars if acq_times[sidecar] is not None}
     sorted_map = sorted(sidecar_acq_time_map.items(), key=lambda key_val_tup: key_val_tup[1], reverse=True)
 
     if sorted_map:
         reordered_sidecars = [tup[0] for tup in sorted_map]
     else:
+        sidecar_list = '\n'.join([str(s) for s in sidecars])
         logger.info(
             f"'AcquisitionTime' or 'AcquisitionDateTime' field was not found in the following sidecar files:\n"
-            f"{'\n'.join([str(s) for s in sidecars])}. Picking a primary scan arbitrarily.")
+            f"{sidecar_list}. Picking a primary scan arbitrarily.")
         random.shuffle(sidecars)  # shuffles the list in place
         reordered_sidecars = sidecars
 
@@ -89,7 +118,7 @@ def get_anat_dir_paths(subj_path, logger):
     return anat_dirs, sess_exist
 
 
-def update_mapping_dict(mapping_dict, anat_dir, sess_exist, t1_sidecars, logger):
+def update_mapping_dict(mapping_dict, anat_dir, sess_exist, t1_sidecars, logger, niftis=None, acq_times=None):
     """Updates mapping dictionary for a given subject's or session's anatomical directory.
 
     :param defaultdict mapping_dict: A dictionary with primary to others mapping information.
@@ -97,26 +126,31 @@ def update_mapping_dict(mapping_dict, anat_dir, sess_exist, t1_sidecars, logger)
     :param boolean sess_exist: True if subject has 'ses' directories, else False.
     :param list t1_sidecars:Absolute paths to T1w JSON sidecars.
     :param logger: Logger object imported from main.py module.
+    :param list niftis: optional, Absolute paths to the NIfTI files in anat_dir, if already listed.
+    :param dict acq_times: optional, Acquisition times already read from t1_sidecars, keyed by sidecar path.
     :return defaultdict mapping_dict: An updated dictionary with primary to others mapping information.
     """
+    if niftis is None:
+        niftis = list(anat_dir.glob('*.nii*'))
+
     # sort and separate primary and other scans
     if t1_sidecars:
-        reordered_sidecars = sort_by_acq_time(t1_sidecars, logger)
+        reordered_sidecars = sort_by_acq_time(t1_sidecars, logger, acq_times)
 
         latest_sidecar = reordered_sidecars[0]  # latest T1w based on acquisition time
         nifti_name = latest_sidecar.name.split('.')[0] + '.nii.gz'
         nifti_path = latest_sidecar.parent / nifti_name
-        if not nifti_path.exists():
-            nifti_path = nifti_path.parent / reordered_sidecars[0].name.split('.')[0] + '.nii'
-            if not nifti_path.exists():
+        if nifti_path not in niftis:
+            nifti_path = nifti_path.parent / (reordered_sidecars[0].name.split('.')[0] + '.nii')
+            if nifti_path not in niftis:
                 logger.error(f"No associated '.nii.gz' or '.nii' file found for {latest_sidecar}.")
                 raise FileNotFoundError(f"Please ensure a nifti file corresponding to {latest_sidecar} is available.")
 
         primary_t1 = nifti_path
-        others = [str(s) for s in list(anat_dir.glob('*.nii*')) if s != primary_t1]
+        others = [str(s) for s in niftis if s != primary_t1]
     else:
         primary_t1 = ""
-        others = [str(s) for s in list(anat_dir.glob('*.nii*'))]
+        others = [str(s) for s in niftis]
 
     # updating mapping dict
     subj_id = [p for p in anat_dir.parts if p.startswith('sub-')][0]
@@ -135,8 +169,85 @@ def update_mapping_dict(mapping_dict, anat_dir, sess_exist, t1_sidecars, logger)
     return mapping_dict
 
 
-def crawl(input_dir, output_dir, logger):
-    """Crawls through the BIDS dataset and generates a mapping file for primary to other T1w scans."""
+def scan_anat_dir(anat_dir, snapshot=None, updates=None):
+    """Lists the NIfTI files and T1w sidecars of an anat directory and reads the sidecars' acquisition times.
+
+    A sidecar is only read again if its mtime differs from the one in the layout index.
+
+    :param Path anat_dir: Absolute path to an anat directory.
+    :param dict snapshot: optional, Layout index contents from layout_index.load_snapshot.
+    :param dict updates: optional, Collects changes to write back to the layout index.
+    :return tuple: (NIfTI paths, T1w sidecar paths, acquisition times keyed by sidecar path)
+    """
+    updates = layout_index.new_updates() if updates is None else updates
+    entries, _ = layout_index.list_dir(anat_dir, snapshot, updates)
+
+    niftis = [anat_dir / name for name, _ in entries if not name.startswith('.') and '.nii' in name]
+    t1_sidecars = [anat_dir / name for name, _ in entries if not name.startswith('.') and name.endswith('T1w.json')]
+
+    acq_times = {}
+    for sidecar in t1_sidecars:
+        cached = snapshot['sidecars'].get(str(sidecar)) if snapshot is not None else None
+        # stat'ed even in unchanged directories, since editing a sidecar in place doesn't change its directory's mtime
+        mtime_ns = os.stat(sidecar).st_mtime_ns
+        if cached is not None and cached[0] == mtime_ns:
+            acq_times[sidecar] = cached[1]
+        else:
+            acq_times[sidecar] = read_acq_time(sidecar)
+            updates['sidecars'][str(sidecar)] = (mtime_ns, acq_times[sidecar])
+
+    return niftis, t1_sidecars, acq_times
+
+
+def scan_subject(subj_path, snapshot=None):
+    """Finds a subject's anat directories and scans each of them.
+
+    Directories are listed with os.scandir, or taken from the layout index if their mtime hasn't changed.
+
+    :param Path subj_path: Absolute path to subject directory.
+    :param dict snapshot: optional, Layout index contents from layout_index.load_snapshot.
+    :return tuple: (sess_exist, list of (anat_dir, niftis, t1_sidecars, acq_times) tuples, directories without anat,
+        layout index updates)
+    """
+    with tracing.span('scan_subject', subject=subj_path.name):
+        updates = layout_index.new_updates()
+        subj_entries, _ = layout_index.list_dir(subj_path, snapshot, updates)
+        sess_paths = [subj_path / name for name, is_dir in subj_entries if name.startswith('ses-') and is_dir]
+        sess_exist = True if sess_paths else False
+
+        scanned, missing = [], []
+        for parent in (sess_paths if sess_exist else [subj_path]):
+            if parent != subj_path:
+                parent_entries, _ = layout_index.list_dir(parent, snapshot, updates)
+            else:
+                parent_entries = subj_entries
+
+            if ('anat', True) in parent_entries:
+                anat_dir = parent / 'anat'
+                scanned.append((anat_dir,) + scan_anat_dir(anat_dir, snapshot, updates))
+            else:
+                missing.append(parent)
+
+    return sess_exist, scanned, missing, updates
+
+
+def crawl(input_dir, output_dir, logger, n_threads=16, index_path=None, rescan=False, find_duplicates=True):
+    """Crawls through the BIDS dataset and generates a mapping file for primary to other T1w scans.
+
+    Subject directories are scanned and their T1w sidecars read on a thread pool, which hides the latency of network
+    filesystems; the mapping is then assembled in subject order. If a layout index is given, only directories that
+    changed since the last crawl are listed again.
+
+    :param Path input_dir: Absolute path to the input BIDS dataset.
+    :param Path output_dir: Absolute path to the output directory.
+    :param logger: Logger object imported from main.py module.
+    :param int n_threads: Number of subject directories scanned at the same time.
+    :param Path index_path: optional, Absolute path to the SQLite layout index; see layout_index.py.
+    :param bool rescan: If True, every directory is listed again and the layout index is rebuilt.
+    :param bool find_duplicates: If True, byte-identical scans are recorded in the mapping so that each is defaced
+        once; see dedupe.py.
+    :return defaultdict mapping_dict: A dictionary with primary to others mapping information.
+    """
     logger.info("Generating mapping file for primary (latest T1w in session) to other scans.")
 
     # make dir for log files and visualqc prep
@@ -144,17 +255,39 @@ def crawl(input_dir, output_dir, logger):
     for dir_name in dir_names:
         output_dir.joinpath(dir_name).mkdir(parents=True, exist_ok=True)
 
+    snapshot = None
+    if index_path is not None and not rescan:
+        snapshot = layout_index.load_snapshot(index_path)
+    updates = layout_index.new_updates()
+
     mapping_dict = defaultdict(dict)
-    subj_dirs = list(input_dir.glob('sub-*'))
+    root_entries, _ = layout_index.list_dir(input_dir, snapshot, updates)
+    subj_dirs = [input_dir / name for name, is_dir in root_entries if name.startswith('sub-') and is_dir]
     if not subj_dirs:
         logger.exception(f"No subject directories found in {input_dir}.")
         raise FileNotFoundError(
             f"Please verify the input directory contains at least one subject with anatomical scans.")
-    for subj_dir in subj_dirs:
-        anat_dirs, sess_exist = get_anat_dir_paths(subj_dir, logger)
-        for anat_dir in anat_dirs:
-            t1_sidecars = list(anat_dir.glob('*T1w.json'))
-            mapping_dict = update_mapping_dict(mapping_dict, anat_dir, sess_exist, t1_sidecars, logger)
+
+    with tracing.span('crawl', n_subjects=len(subj_dirs)):
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            scans = executor.map(scan_subject, subj_dirs, [snapshot] * len(subj_dirs))
+            for sess_exist, scanned, missing, subj_updates in scans:
+                layout_index.merge_updates(updates, subj_updates)
+                for parent in missing:
+                    logger.info(f"No 'anat' directory found in {parent}.")
+                for anat_dir, niftis, t1_sidecars, acq_times in scanned:
+                    mapping_dict = update_mapping_dict(mapping_dict, anat_dir, sess_exist, t1_sidecars, logger,
+                                                       niftis, acq_times)
+
+    if index_path is not None:
+        with tracing.span('layout_index_save'):
+            layout_index.save_updates(index_path, updates, input_dir)
+        logger.info(f"Layout index updated: {len(updates['dirs'])} of {len(updates['visited'])} directories "
+                    f"rescanned.")
+
+    if find_duplicates:
+        with tracing.span('deduplicate'):
+            dedupe.deduplicate(mapping_dict, output_dir, logger, n_threads)
 
     # write mapping dict to file
     with open(output_dir / 'primary_to_others_mapping.json', 'w') as f1:
@@ -0,0 +1,101 @@
+"""Append-only run journal used to resume interrupted pipeline runs.
+
+Every subject or session ("unit") writes one JSON line when it starts and finishes each stage of the pipeline: AFNI
+refacer, registration of other scans, reorganizing into the BIDS tree and VisualQC prep. Lines are written with a
+single O_APPEND write followed by fsync, so records from parallel workers do not interleave and survive a node crash.
+Replaying the journal gives the last known status of each unit.
+"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import cleanup
+import utils
+
+JOURNAL_FILENAME = 'defacing_journal.jsonl'
+
+
+def record(journal_path, unit_id, stage, status, **details):
+    """Appends a record to the journal. Does nothing if journal_path is None.
+
+    :param Path journal_path: Absolute path to the journal file.
+    :param str unit_id: Subject or subject/session identifier.
+    :param str stage: Name of the pipeline stage, or 'unit' for the unit as a whole.
+    :param str status: One of 'started', 'finished' or 'failed'.
+    """
+    if journal_path is None:
+        return
+    entry = {'time': time.time(), 'pid': os.getpid(), 'unit': unit_id, 'stage': stage, 'status': status}
+    entry.update(details)
+    fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(entry) + '\n').encode('utf8'))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def stage(journal_path, unit_id, stage_name):
+    """Records the start of a stage and whether it finished or raised an exception."""
+    record(journal_path, unit_id, stage_name, 'started')
+    try:
+        yield
+    except Exception as err:
+        record(journal_path, unit_id, stage_name, 'failed', error=str(err))
+        raise
+    record(journal_path, unit_id, stage_name, 'finished')
+
+
+def replay(journal_path):
+    """Reads the journal and returns the last known state of every unit.
+
+    A truncated last line, left behind by a process killed mid-write, is ignored and terminated so that records
+    appended by the resumed run start on a line of their own.
+
+    :param Path journal_path: Absolute path to the journal file.
+    :return dict: Maps unit ids to {'status': ..., 'stage': ...} where status is 'finished', 'failed' or 'started'
+        and stage is the last stage recorded for the unit.
+    """
+    states = {}
+    if not journal_path.exists():
+        return states
+
+    with open(journal_path, 'r') as f:
+        lines = f.readlines()
+    if lines and not lines[-1].endswith('\n'):
+        with open(journal_path, 'a') as f:
+            f.write('\n')
+
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        state = states.setdefault(entry['unit'], {'status': 'started', 'stage': None})
+        if entry['stage'] == 'unit':
+            state['status'] = entry['status']
+        else:
+            state['stage'] = entry['stage']
+            if entry['status'] == 'failed':
+                state['status'] = 'failed'
+
+    return states
+
+
+def remove_partial_outputs(output_dir, subj_id, sess_id, modes=None):
+    """Deletes whatever an interrupted or failed unit left in the 'bids_defaced' and 'defacing_QC' trees of every
+    mode. The directories are moved out of the trees at once and deleted in the background; see cleanup.py.
+
+    :return list: Directories that were removed.
+    """
+    removed = []
+    for mode_dir in utils.get_mode_output_dirs(output_dir, modes).values() if modes else [output_dir]:
+        for tree in ['bids_defaced', 'defacing_QC']:
+            unit_dir = mode_dir.joinpath(tree, subj_id, sess_id)
+            if unit_dir.exists():
+                cleanup.discard([unit_dir], mode_dir / cleanup.TRASH_DIRNAME)
+                removed.append(unit_dir)
+    return removed
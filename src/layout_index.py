@@ -0,0 +1,179 @@
+"""Persistent SQLite index of the input dataset's directory layout.
+
+The index stores the listing and mtime of every directory the mapping crawler visits (dataset root, subject, session
+and anat directories) along with the acquisition times parsed from T1w sidecars. A directory whose mtime is unchanged
+since it was indexed is not listed again, so re-running the pipeline after a few sessions were added only touches the
+new directories. Adding, removing or renaming files changes a directory's mtime; editing a sidecar in place does not,
+so T1w sidecars are stat'ed on every crawl and re-read when their own mtime changed.
+
+The same index answers the filename and directory lookups that QC prep and prepare_to_share.py would otherwise walk
+the dataset for, and keeps the SHA-256 digests of scans keyed by path, size and mtime, so that the result cache,
+deduplication and the transform store only read a scan again once it changed; see cache.hash_scans.
+"""
+
+import os
+import sqlite3
+from pathlib import Path
+
+INDEX_FILENAME = 'layout_index.sqlite'
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS entries (dir TEXT NOT NULL, name TEXT NOT NULL, is_dir INTEGER NOT NULL, "
+    "PRIMARY KEY (dir, name))",
+    "CREATE TABLE IF NOT EXISTS sidecars (path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, acq_time TEXT)",
+    "CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+    "sha256 TEXT NOT NULL)",
+]
+# worker processes and array tasks add digests to the index concurrently
+LOCK_TIMEOUT = 60
+
+
+def open_index(index_path):
+    conn = sqlite3.connect(index_path, timeout=LOCK_TIMEOUT)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+def load_snapshot(index_path):
+    """Reads the whole index into memory so that crawler threads can consult it without sharing a connection.
+
+    :param Path index_path: Absolute path to the SQLite index.
+    :return dict: {'dirs': {path: (mtime_ns, [(name, is_dir), ...])}, 'sidecars': {path: (mtime_ns, acq_time)}}
+    """
+    snapshot = {'dirs': {}, 'sidecars': {}}
+    conn = open_index(index_path)
+    try:
+        for path, mtime_ns in conn.execute("SELECT path, mtime_ns FROM dirs"):
+            snapshot['dirs'][path] = (mtime_ns, [])
+        for dir_path, name, is_dir in conn.execute("SELECT dir, name, is_dir FROM entries"):
+            if dir_path in snapshot['dirs']:
+                snapshot['dirs'][dir_path][1].append((name, bool(is_dir)))
+        for path, mtime_ns, acq_time in conn.execute("SELECT path, mtime_ns, acq_time FROM sidecars"):
+            snapshot['sidecars'][path] = (mtime_ns, acq_time)
+    finally:
+        conn.close()
+    return snapshot
+
+
+def new_updates():
+    return {'dirs': {}, 'sidecars': {}, 'visited': set()}
+
+
+def merge_updates(updates, other):
+    updates['dirs'].update(other['dirs'])
+    updates['sidecars'].update(other['sidecars'])
+    updates['visited'].update(other['visited'])
+
+
+def list_dir(dir_path, snapshot, updates):
+    """Lists a directory, reusing the indexed listing if the directory's mtime hasn't changed.
+
+    :param Path dir_path: Absolute path to the directory.
+    :param dict snapshot: Index contents from load_snapshot, or None to always list the directory.
+    :param dict updates: Collects listings that need to be written back to the index; see new_updates.
+    :return tuple: ([(name, is_dir), ...], changed) where changed is True if the directory was listed again.
+    """
+    key = str(dir_path)
+    mtime_ns = os.stat(dir_path).st_mtime_ns
+    updates['visited'].add(key)
+    if snapshot is not None and key in snapshot['dirs'] and snapshot['dirs'][key][0] == mtime_ns:
+        return snapshot['dirs'][key][1], False
+
+    with os.scandir(dir_path) as it:
+        entries = sorted((e.name, e.is_dir()) for e in it)
+    updates['dirs'][key] = (mtime_ns, entries)
+    return entries, True
+
+
+def save_updates(index_path, updates, root):
+    """Writes new listings and sidecar acquisition times, and drops directories under root that no longer exist."""
+    conn = open_index(index_path)
+    try:
+        with conn:
+            for path, (mtime_ns, entries) in updates['dirs'].items():
+                conn.execute("INSERT OR REPLACE INTO dirs (path, mtime_ns) VALUES (?, ?)", (path, mtime_ns))
+                conn.execute("DELETE FROM entries WHERE dir = ?", (path,))
+                conn.executemany("INSERT INTO entries (dir, name, is_dir) VALUES (?, ?, ?)",
+                                 [(path, name, int(is_dir)) for name, is_dir in entries])
+            conn.executemany("INSERT OR REPLACE INTO sidecars (path, mtime_ns, acq_time) VALUES (?, ?, ?)",
+                             [(path, mtime_ns, acq_time)
+                              for path, (mtime_ns, acq_time) in updates['sidecars'].items()])
+
+            root = str(root)
+            stale = [path for (path,) in conn.execute("SELECT path FROM dirs")
+                     if (path == root or path.startswith(root + os.sep)) and path not in updates['visited']]
+            for path in stale:
+                conn.execute("DELETE FROM dirs WHERE path = ?", (path,))
+                conn.execute("DELETE FROM entries WHERE dir = ?", (path,))
+                conn.execute("DELETE FROM sidecars WHERE path LIKE ?", (path + os.sep + '%',))
+                conn.execute("DELETE FROM digests WHERE path LIKE ?", (path + os.sep + '%',))
+    finally:
+        conn.close()
+
+
+def load_digests(index_path, stats):
+    """Looks up the digests of files whose size and mtime are unchanged since they were indexed.
+
+    :param Path index_path: Absolute path to the SQLite index.
+    :param list stats: (path, size, mtime_ns) of each file, the path as a string.
+    :return dict: SHA-256 hex digest keyed by the (path, size, mtime_ns) tuples found in the index.
+    """
+    conn = open_index(index_path)
+    try:
+        found = {}
+        for stat in stats:
+            row = conn.execute("SELECT sha256 FROM digests WHERE path = ? AND size = ? AND mtime_ns = ?",
+                               stat).fetchone()
+            if row:
+                found[stat] = row[0]
+    finally:
+        conn.close()
+    return found
+
+
+def save_digests(index_path, digests):
+    """Adds digests keyed by (path, size, mtime_ns), replacing those of earlier versions of the files."""
+    conn = open_index(index_path)
+    try:
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO digests (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)",
+                             [stat + (digest,) for stat, digest in digests.items()])
+    finally:
+        conn.close()
+
+
+def get_filename_index(index_path):
+    """Maps the filenames of NIfTI files in indexed anat directories to their absolute paths.
+
+    :param Path index_path: Absolute path to the SQLite index.
+    :return dict: Filename to absolute path, as strings.
+    """
+    conn = open_index(index_path)
+    try:
+        rows = conn.execute("SELECT dir, name FROM entries WHERE is_dir = 0 AND (name LIKE '%.nii' OR name LIKE "
+                            "'%.nii.gz')").fetchall()
+    finally:
+        conn.close()
+    return {name: os.path.join(dir_path, name) for dir_path, name in rows if Path(dir_path).name == 'anat'}
+
+
+def get_subdirs(index_path, root):
+    """Lists the indexed directories under root and their subdirectories, relative to root.
+
+    The crawler indexes subject, session and anat directories, so this covers every modality directory (anat, func,
+    dwi, fmap, ...) of the dataset without walking it.
+
+    :return list: Relative paths, parents before children.
+    """
+    root = str(root)
+    conn = open_index(index_path)
+    try:
+        rows = conn.execute("SELECT dir, name FROM entries WHERE is_dir = 1").fetchall()
+    finally:
+        conn.close()
+
+    subdirs = {Path(os.path.join(dir_path, name)).relative_to(root)
+               for dir_path, name in rows if dir_path == root or dir_path.startswith(root + os.sep)}
+    return sorted(subdirs, key=lambda p: (len(p.parts), str(p)))
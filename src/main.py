@@ -1,10 +1,28 @@
 import argparse
+import json
+import os
 import re
-from multiprocessing.pool import Pool
+import traceback
 from pathlib import Path
 import utils
+import cache
+import cleanup
+import cluster
+import commands
+import dedupe
 import deface
+import journal
+import layout_index
+import materialize
+import scheduler
 import generate_mappings
+import qc_montage
+import register
+import render
+import resources
+import staging
+import tracing
+import transforms
 import logging
 import logging.config
 import logging.handlers
@@ -22,6 +40,25 @@ def get_args():
     parser.add_argument('-n', '--n-cpus', type=int, default=1,
                         help='Number of parallel processes to run when there is more than one folder. '
                              'Defaults to 1, meaning "serial processing".')
+    parser.add_argument('--reg-threads', type=int, default=None,
+                        help='Number of "other" scans registered to the primary scan at the same time within a '
+                             'subject/session. Defaults to the number of CPUs on the machine divided by --n-cpus, so '
+                             'the machine is not oversubscribed.')
+    parser.add_argument('--mem-limit', type=scheduler.parse_memory, default=None,
+                        help='Memory available to the parallel subjects/sessions, e.g. 64G or 500M. A subject/session '
+                             'is only started while the projected peak memory of all running ones fits, estimated '
+                             'from image dimensions and calibrated against the peak memory of earlier runs.')
+    parser.add_argument('--executor', choices=cluster.EXECUTORS, default='pool',
+                        help="Where subjects/sessions are defaced. 'pool' runs them on this machine with --n-cpus "
+                             "processes. 'slurm' submits them as a SLURM job array and 'local' runs the same array "
+                             "tasks as local processes, --n-cpus at a time.")
+    parser.add_argument('--sessions-per-task', type=int, default=10,
+                        help="Number of subjects/sessions defaced one after another by each array task of the "
+                             "'slurm' and 'local' executors.")
+    parser.add_argument('--sbatch-args', type=str, default='',
+                        help="Extra sbatch options for the 'slurm' executor, e.g. \"--mem=16g --time=8:00:00\".")
+    parser.add_argument('--max-array-tasks', type=int, default=None,
+                        help="Maximum number of array tasks of the 'slurm' executor running at once.")
     parser.add_argument('-p', '--participant-label', nargs="+", type=str, default=None,
                         help='The label(s) of the participant(s) that should be defaced. The label '
                              'corresponds to sub-<participant_label> from the BIDS spec. '
@@ -32,12 +69,63 @@ def get_args():
                              'corresponds to ses-<session_id> from the BIDS spec. '
                              'If this parameter is not provided all subjects should be analyzed. Multiple '
                              'sessions can be specified with a space separated list.')
-    parser.add_argument('-m', '--mode', type=str, choices=['regular', 'aggressive'], default='regular',
+    parser.add_argument('-m', '--mode', type=str, nargs='+', choices=['regular', 'aggressive'], default=['regular'],
                         help=f"In the 'regular' mode, the pipeline runs AFNI refacer the default template and "
                              f"in the 'aggressive' mode, the pipeline runs AFNI refacer with  the alternative shell "
-                             f"that removes more of the chin, neck and brows. ")
+                             f"that removes more of the chin, neck and brows. With both modes, e.g. "
+                             f"'--mode regular aggressive', the crawl, AFNI refacer's alignment of the primary scan "
+                             f"and the flirt registration of other scans to the primary scan run once; only the "
+                             f"shell is applied per mode. Each mode's outputs are written to <output_dir>/<mode>/.")
+    parser.add_argument('--mask-backend', type=str, choices=register.MASK_BACKENDS, default='native',
+                        help="Engine used to generate and apply defacemasks. 'native' computes them in-process with "
+                             "nibabel and NumPy, 'fsl' runs the equivalent FSL commands.")
+    parser.add_argument('--timeouts', nargs='+', type=commands.parse_timeout, default=[], metavar='TOOL=SECONDS',
+                        help=f"Seconds after which a hung external tool is killed, e.g. 'flirt=3600 "
+                             f"@afni_refacer_run=21600'; 'default=SECONDS' applies to tools without their own "
+                             f"timeout and 0 turns a timeout off. Defaults: "
+                             f"{', '.join(f'{k}={v}' for k, v in commands.DEFAULT_TIMEOUTS.items() if v)}.")
+    parser.add_argument('--transform-store', type=Path, default=None,
+                        help='Directory where the registration transforms of "other" scans are kept and reused by '
+                             'later runs in either mode, keyed by the contents of the scans. Point runs of the same '
+                             'dataset with different output directories at one store to share it. Defaults to '
+                             f'<output_dir>/{transforms.TRANSFORM_STORE_DIRNAME}.')
+    parser.add_argument('--materialize', choices=list(materialize.POLICIES), default='auto',
+                        help="How sidecars and defaced images are placed in the output tree: 'auto' tries a "
+                             "copy-on-write reflink, then a hardlink, then a copy; 'reflink' and 'hardlink' fall back "
+                             "to a copy; 'copy' always copies. A hardlinked output shares its inode with the input "
+                             "sidecar or intermediate file, so edit outputs by replacing them, not in place.")
+    parser.add_argument('--scratch-dir', dest='scratch_dir', type=str, default=None,
+                        help="Node-local directory, e.g. local disk or tmpfs, where each subject's/session's AFNI "
+                             "workdirs, registrations and reorganization happen. Only final outputs, and the "
+                             "intermediates kept with --no-clean, are copied back to the output directory, then "
+                             "renamed into place. Environment variables are expanded where each unit runs, so "
+                             "'/lscratch/$SLURM_JOB_ID' works for cluster array tasks.")
     parser.add_argument('--no-clean', dest='no_clean', action='store_true', default=False,
                         help='If this argument is provided, then AFNI intermediate files are preserved.')
+    parser.add_argument('--no-dedupe', dest='no_dedupe', action='store_true', default=False,
+                        help='If this argument is provided, then byte-identical input scans are defaced separately. '
+                             'By default a subject/session whose scans all duplicate those of another one gets '
+                             'copies of its outputs, and a scan duplicating another scan of its subject/session gets '
+                             f'a copy of that scan\'s defaced image; see {dedupe.DUPLICATES_FILENAME} in the output '
+                             'directory.')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true', default=False,
+                        help='If this argument is provided, then the input dataset is fully rescanned, every scan '
+                             'is hashed again and every session is defaced again even if its input scans, mode and '
+                             'AFNI/FSL versions match a previous successful run.')
+    parser.add_argument('--resume', dest='resume', action='store_true', default=False,
+                        help='If this argument is provided, then the run journal in the output directory is replayed '
+                             'and only subjects/sessions that are unfinished or failed are defaced. Partial outputs '
+                             'of interrupted subjects/sessions are removed before they are defaced again.')
+    parser.add_argument('--qc-render', choices=['none', 'fsleyes', 'montage'], default='none',
+                        help="With 'fsleyes', 3D renders of every defaced image are written to the defacing_QC "
+                             "directory for VisualQC deface, using one long-lived fsleyes renderer per CPU. With "
+                             f"'montage', a 2D {qc_montage.MONTAGE_FILENAME} of surface views and sagittal slices of "
+                             "the original and defaced images is written instead, with nibabel and NumPy, as soon as "
+                             "each subject/session is defaced; it needs no OpenGL.")
+    parser.add_argument('--trace', action='store_true', default=False,
+                        help='If this argument is provided, then the time spent in every stage of every '
+                             'subject/session is recorded and merged into logs/trace.json, viewable in chrome://tracing or Perfetto, '
+                             'with per-stage percentiles in logs/trace_summary.tsv.')
     parser.add_argument('--nih-hpc', dest='nih_hpc', action='store_true', default=False,
                         help='While running the pipeline on NIH HPC, if this argument is provided, then the required \
                         AFNI and FSL modules are loaded into the environment.')
@@ -70,8 +158,101 @@ def setup_logger(log_filepath):
     return logger
 
 
-def construct_vqcdeface_cmd(qc_dir):
-    rel_paths_to_orig = [re.sub('/orig.nii.gz', '', str(o.relative_to(qc_dir))) for o in qc_dir.rglob('orig.nii.gz')]
+def get_subject_session(defaceable, logger):
+    subj_sess = defaceable.parts[-2:]
+
+    if subj_sess[0].startswith('sub-'):
+        subject = Path(subj_sess[0])
+    elif subj_sess[1].startswith('sub-'):
+        subject = Path(subj_sess[1])
+    else:
+        logger.error(f'Subject name not found in path.')
+        raise ValueError(f'Could not find subject name in path: {defaceable}')
+
+    if subj_sess[1].startswith('ses-'):
+        session = Path(subj_sess[1])
+    else:
+        session = None
+
+    return subject, session
+
+
+def get_unit_id(subject, session):
+    return utils.get_unit_id(subject.name, session.name if session else "")
+
+
+def check_result_cache(units, mapping_dict, mode, tool_versions, result_cache, output_dir, logger):
+    """Splits subject/session units into those that need defacing and those whose cached outputs are reusable.
+
+    :param dict tool_versions: AFNI and FSL versions from cache.get_tool_versions, all of them known.
+    :return tuple: (units to deface, cache entries of units to deface keyed by unit id, hit/miss reasons by unit id)
+    """
+    logger.debug(f"Tool versions used for the result cache: {tool_versions}")
+
+    input_files = {}
+    for subject, session in units:
+        sess_id = session.name if session else ""
+        try:
+            files = utils.get_session_inputs(mapping_dict, subject.name, sess_id)
+            duplicates = utils.get_mapping_entry(mapping_dict, subject.name, sess_id).get('duplicates', {})
+            files += [Path(d) for d in duplicates]
+        except KeyError:
+            continue
+        input_files[get_unit_id(subject, session)] = files
+    # hashed together on a thread pool rather than unit by unit; make_entry then reuses the digests
+    cache.hash_scans([f for files in input_files.values() for f in files])
+
+    to_run, entries, stats = [], {}, {}
+    for subject, session in units:
+        unit_id = get_unit_id(subject, session)
+        if unit_id not in input_files:
+            stats[unit_id] = (False, "not found in mapping file")
+            to_run.append((subject, session))
+            continue
+
+        entries[unit_id] = cache.make_entry(input_files[unit_id], mode, tool_versions)
+        stats[unit_id] = cache.lookup(result_cache, unit_id, entries[unit_id], output_dir)
+        if stats[unit_id][0]:
+            logger.info(f"Skipping {unit_id}, outputs from a previous run are up to date.")
+        else:
+            to_run.append((subject, session))
+
+    return to_run, entries, stats
+
+
+def select_unfinished_units(units, journal_path, output_dir, modes, logger):
+    """Replays the run journal and drops subject/session units that finished in an earlier run.
+
+    Units that were interrupted or failed have their partial outputs removed so they are redone from scratch.
+    """
+    states = journal.replay(journal_path)
+    to_run = []
+    for subject, session in units:
+        unit_id = get_unit_id(subject, session)
+        state = states.get(unit_id)
+        if state is None:
+            to_run.append((subject, session))
+        elif state['status'] == 'finished':
+            logger.info(f"Skipping {unit_id}, it finished in a previous run.")
+        else:
+            removed = journal.remove_partial_outputs(output_dir, subject.name, session.name if session else "",
+                                                     modes)
+            logger.info(f"Redoing {unit_id}, it was {'interrupted' if state['status'] == 'started' else 'failed'} "
+                        f"during the '{state['stage']}' stage. Removed partial outputs: {[str(r) for r in removed]}")
+            to_run.append((subject, session))
+
+    return to_run
+
+
+def construct_vqcdeface_cmd(qc_dir, filename_index=None):
+    qc_dir.mkdir(parents=True, exist_ok=True)
+    if filename_index is None:
+        rel_paths_to_orig = [re.sub('/orig.nii.gz', '', str(o.relative_to(qc_dir))) for o in
+                             qc_dir.rglob('orig.nii.gz')]
+    else:
+        # QC directories are named after the entities of the input scans, so check those instead of walking qc_dir
+        qc_subdirs = sorted({'/'.join(name.split('.')[0].split('_')) for name in filename_index})
+        rel_paths_to_orig = [d for d in qc_subdirs if (qc_dir / d / 'orig.nii.gz').is_symlink()]
     with open(qc_dir / 'defacing_id_list.txt', 'w') as f:
         f.write('\n'.join(rel_paths_to_orig))
 
@@ -85,7 +266,7 @@ def main():
     args = get_args()
     bids_input_dir = args.bids_dir.resolve()
     output_dir = args.output_dir.resolve()
-    mode = args.mode
+    modes = list(dict.fromkeys(args.mode))
     no_clean = args.no_clean
 
     pipeline_log = output_dir / 'logs' / 'defacing_pipeline.log'
@@ -93,6 +274,23 @@ def main():
         pipeline_log.parent.mkdir(parents=True, exist_ok=True)
     main_logger = setup_logger(pipeline_log)
 
+    # every external tool call records its CPU time, peak RSS and I/O
+    resource_log = output_dir / 'logs' / resources.RESOURCE_LOG_FILENAME
+    resources.configure(resource_log)
+    commands.configure(dict(args.timeouts))
+    materialize.configure(args.materialize)
+    if args.qc_render == 'montage':
+        qc_montage.configure()
+    if args.scratch_dir:
+        staging.configure(args.scratch_dir)
+        # staging directories whose deletion an interrupted run didn't finish; nothing if the directory names
+        # variables that only exist where units run
+        cleanup.empty_trash(staging.get_scratch_dir() / cleanup.TRASH_DIRNAME, main_logger)
+    if transforms.get_fsl_version():
+        transforms.configure((args.transform_store or output_dir / transforms.TRANSFORM_STORE_DIRNAME).resolve())
+    else:
+        main_logger.warning("Could not find the FSL version; the transform store is off for this run.")
+
     if args.nih_hpc:
         out, err = utils.run_command("module load afni ; module load fsl")
         if err:
@@ -112,14 +310,25 @@ def main():
     if args.session_id:
         session_labels = [s.split('-')[1] if s.startswith('ses-') else s for s in args.session_id]
 
+    trace_dir = output_dir / 'logs' / 'trace'
+    if args.trace:
+        tracing.configure(trace_dir)
+
     ## run generate mapping script
-    mapping_dict = generate_mappings.crawl(bids_input_dir, output_dir, main_logger)
+    index_path = output_dir / layout_index.INDEX_FILENAME
+    if not args.no_cache:
+        cache.configure_hash_index(index_path)
+    mapping_dict = generate_mappings.crawl(bids_input_dir, output_dir, main_logger, index_path=index_path,
+                                           rescan=args.no_cache, find_duplicates=not args.no_dedupe)
     main_logger.info(f"Mapping file at {str(output_dir / 'primary_to_others_mapping.json')} ")
     main_logger.info(f"Logs at {str(output_dir / 'logs')}\n")
 
-    # create a separate bids tree with only defaced scans
-    bids_output_dir = output_dir / 'bids_defaced'
-    bids_output_dir.mkdir(parents=True, exist_ok=True)
+    # create a separate bids tree with only defaced scans for each mode
+    mode_dirs = utils.get_mode_output_dirs(output_dir, modes)
+    for mode_dir in mode_dirs.values():
+        mode_dir.joinpath('bids_defaced').mkdir(parents=True, exist_ok=True)
+        cleanup.empty_trash(mode_dir / cleanup.TRASH_DIRNAME, main_logger)
+        staging.remove_leftovers(mode_dir, main_logger)
 
     afni_refacer_failures = []  # list to capture afni_refacer_run failures
 
@@ -142,11 +351,6 @@ def main():
             for s in session_labels:
                 to_deface.extend(list(bids_input_dir.joinpath(f'sub-{p}/ses-{s}/')))
 
-    elif not participant_labels and not session_labels:
-        # only for one subset of sessions
-        for s in session_labels:
-            to_deface = list(bids_input_dir.rglob(f'ses-{s}'))  # TODO: could match ses dirs within dot dirs. Fix this.
-
     elif args.participant_label is None and args.session_id is None:
         # for all subjects and all sessions
         session_list = list(bids_input_dir.rglob('ses-*'))  # TODO: could match ses dirs within dot dirs. Fix this.
@@ -159,86 +363,158 @@ def main():
     excl_patterns = ['.']
     to_deface = [d for d in to_deface if not str(d).startswith(tuple(excl_patterns))]
 
+    units = [get_subject_session(defaceable, main_logger) for defaceable in to_deface]
+
+    # every unit of work records its progress in the run journal
+    journal_path = output_dir / journal.JOURNAL_FILENAME
+    if args.resume:
+        units = select_unfinished_units(units, journal_path, output_dir, modes, main_logger)
+
+    # skip sessions whose inputs, mode and tool versions match a previous successful run
+    cache_path = output_dir / cache.CACHE_FILENAME
+    result_cache = cache.load_cache(cache_path)
+    cache_entries, cache_stats = {}, {}
+    tool_versions = cache.get_tool_versions()
+    unknown_versions = [tool.upper() for tool, version in tool_versions.items() if not version]
+    if not args.no_cache and unknown_versions:
+        # an upgrade of the tool couldn't be told apart from the version in the cache
+        main_logger.warning(f"Could not find the {' and '.join(unknown_versions)} version; the result cache is off "
+                            f"for this run.")
+    elif not args.no_cache:
+        units, cache_entries, cache_stats = check_result_cache(units, mapping_dict, '+'.join(sorted(modes)),
+                                                               tool_versions, result_cache, output_dir, main_logger)
+
+    results_path = output_dir / 'logs' / 'defacing_results.jsonl'
+    unit_names = {get_unit_id(subject, session): (subject.name, session.name if session else "")
+                  for subject, session in units}
+
+    failed_units = set()
+
+    def collect_result(unit_id, missing_refacer_out, error):
+        """Records each unit's outcome as soon as it completes."""
+        if error:
+            main_logger.error(f"Defacing {unit_id} failed:\n{error}")
+            failed_units.add(unit_id)
+        elif any(missing_refacer_out):
+            main_logger.error(f"Defacing {unit_id} failed, AFNI refacer outputs missing for "
+                              f"{[m for m in missing_refacer_out if m]}")
+            afni_refacer_failures.extend([m for m in missing_refacer_out if m])
+            failed_units.add(unit_id)
+        else:
+            main_logger.info(f"Defacing {unit_id} finished.")
+            if unit_id in cache_entries:
+                cache.record(result_cache, unit_id, cache_entries[unit_id], output_dir, *unit_names[unit_id], modes)
+                cache.save_cache(result_cache, cache_path)
+
+        with open(results_path, 'a') as f:
+            f.write(json.dumps({'unit': unit_id,
+                                'status': 'failed' if error or any(missing_refacer_out) else 'finished',
+                                'missing_refacer_outputs': [m for m in missing_refacer_out or [] if m],
+                                'error': error}) + '\n')
+
+    # share the machine's CPUs between parallel subjects/sessions and their registration chains
+    reg_threads = args.reg_threads or max(1, (os.cpu_count() or 1) // args.n_cpus)
+    main_logger.debug(f"Registering up to {reg_threads} other scan(s) at a time per subject/session.")
+    # each registration chain writes its masked scan through its own gzip writer
+    utils.configure_gzip_threads(max(1, (os.cpu_count() or 1) // (args.n_cpus * reg_threads)))
+
+    # subjects/sessions whose scans all duplicate those of another one get its outputs once it's defaced, unless it
+    # is neither defaced in this run nor was in an earlier one
+    duplicate_units = {}
+    for unit_id, (subj_id, sess_id) in unit_names.items():
+        duplicate_of = dedupe.get_duplicate_of(mapping_dict, subj_id, sess_id)
+        if duplicate_of and (duplicate_of['unit'] in unit_names or cache.get_session_outputs(
+                output_dir, *duplicate_of['unit'].partition('/')[::2], modes)):
+            duplicate_units[unit_id] = duplicate_of
+
+    tasks = [(get_unit_id(subject, session),
+              (bids_input_dir, subject, session, mapping_dict, output_dir, modes, no_clean, journal_path,
+               reg_threads, args.mask_backend))
+             for subject, session in units if get_unit_id(subject, session) not in duplicate_units]
+
+    # QC prep looks up input scans in the layout index instead of searching the input dataset for every image
+    filename_index = layout_index.get_filename_index(index_path)
+    shared_kwargs = {'input_index': filename_index}
+
+    # the measured peak memory of every finished unit calibrates the memory estimates of later units and runs
+    input_mb = {unit_id: scheduler.get_input_mb(mapping_dict, *unit_names[unit_id], main_logger)
+                for unit_id, _ in tasks}
+    calibration = scheduler.MemoryCalibration(output_dir / scheduler.MEMORY_CALIBRATION_FILENAME, resource_log,
+                                              input_mb, reg_threads)
+
+    def on_result(unit_id, missing_refacer_out, error):
+        calibration.unit_finished(unit_id)
+        collect_result(unit_id, missing_refacer_out, error)
+
     # running processing style
-    if args.n_cpus == 1:
+    if args.executor != 'pool':
+        main_logger.info(f"Defacing on the '{args.executor}' executor, {args.sessions_per_task} subject(s)/session(s) "
+                         f"per array task")
+        config = {'bids_input_dir': bids_input_dir, 'output_dir': output_dir,
+                  'mapping_path': output_dir / 'primary_to_others_mapping.json', 'index_path': index_path,
+                  'journal_path': journal_path, 'modes': modes, 'no_clean': no_clean, 'reg_threads': reg_threads,
+                  'mask_backend': args.mask_backend}
+        max_parallel = args.max_array_tasks if args.executor == 'slurm' else args.n_cpus
+        submitter = cluster.get_submitter(args.executor, args.sbatch_args, max_parallel)
+        cluster.run_array([(unit_id,) + unit_names[unit_id] for unit_id, _ in tasks], config, output_dir, submitter,
+                          args.sessions_per_task, on_result, main_logger,
+                          poll_interval=5 if args.executor == 'local' else 30)
+
+    elif args.n_cpus == 1:
         main_logger.info('Defacing in Serial, one at a time')
-        for defaceable in to_deface:
-            subj_sess = defaceable.parts[-2:]
-
-            if subj_sess[0].startswith('sub-'):
-                subject = Path(subj_sess[0])
-            elif subj_sess[1].startswith('sub-'):
-                subject = Path(subj_sess[1])
-            else:
-                main_logger.error(f'Subject name not found in path.')
-                raise ValueError(f'Could not find subject name in path: {defaceable}')
-
-            if subj_sess[1].startswith('ses-'):
-                session = Path(subj_sess[1])
-            else:
-                session = None
-
-            missing_refacer_out = deface.deface_primary_scan(
-                bids_input_dir,
-                subject,
-                session,
-                mapping_dict,
-                bids_output_dir,
-                mode,
-                no_clean
-            )
-
-            if missing_refacer_out is not None:
-                afni_refacer_failures.extend(missing_refacer_out)
+        scheduler.init_worker(shared_kwargs)
+        for unit_id, unit_args in tasks:
+            on_result(*scheduler.run_unit(unit_id, unit_args))
 
     elif args.n_cpus > 1:
-        main_logger.info(f'Defacing in Parallel with {args.n_cpus} cores')
-        # initialize pool
-        with Pool(processes=args.n_cpus) as p:
-
-            # run over defaceables subjects and sessions
-            subject_list = []
-            session_list = []
-            subj_sess_list = [defaceable.parts[-2:] for defaceable in to_deface]
-            for subj_sess in subj_sess_list:
-                if subj_sess[0].startswith('sub-'):
-                    subject_list.append(Path(subj_sess[0]))
-                elif subj_sess[1].startswith('sub-'):
-                    subject_list.append(Path(subj_sess[1]))
-                else:
-                    main_logger.error(f'Subject name not found in path.')
-                    raise ValueError(f'Could not find subject name in path: {defaceable}')
-
-                if subj_sess[1].startswith('ses-'):
-                    session_list.append(Path(subj_sess[1]))
-                else:
-                    session_list.append(None)
-
-            # parallel processing
-            missing_refacer_outs = p.starmap(deface.deface_primary_scan,
-                                             zip(
-                                                 [bids_input_dir] * len(subject_list),
-                                                 subject_list,
-                                                 session_list,
-                                                 [mapping_dict] * len(subject_list),
-                                                 [bids_output_dir] * len(subject_list),
-                                                 [mode] * len(subject_list),
-                                                 [no_clean] * len(subject_list)
-                                             ))
-
-        # collect failures
-        for missing_refacer_out in missing_refacer_outs:
-            if missing_refacer_out is not None:
-                afni_refacer_failures.extend(missing_refacer_out)
-
-        vqcdeface_cmd = construct_vqcdeface_cmd(output_dir / 'defacing_QC')
-        main_logger.info(f"Run the following command to start a VisualQC Deface session:\n\t{vqcdeface_cmd}\n")
-        with open(output_dir / 'defacing_qc_cmd', 'w') as f:
-            f.write(vqcdeface_cmd + '\n')
+        main_logger.info(f'Defacing in Parallel with {args.n_cpus} cores, longest jobs first')
+        if args.mem_limit:
+            largest = max((calibration.estimate(unit_id) for unit_id, _ in tasks), default=0)
+            main_logger.info(f"Admitting subjects/sessions while their projected peak memory fits in "
+                             f"{args.mem_limit:.0f} MB; the largest is projected at {largest:.0f} MB.")
+        scheduled = [(unit_id, scheduler.estimate_cost(mapping_dict, *unit_names[unit_id], main_logger), unit_args)
+                     for unit_id, unit_args in tasks]
+        scheduler.run_longest_first(scheduled, args.n_cpus, on_result, shared_kwargs, args.mem_limit,
+                                    calibration.estimate, main_logger)
 
     else:
         raise ValueError("Invalid processing type. Must be either 'serial' or 'parallel'.")
 
+    placed_units = []
+    for unit_id, duplicate_of in duplicate_units.items():
+        if duplicate_of['unit'] in failed_units:
+            collect_result(unit_id, None, f"{duplicate_of['unit']}, whose scans it duplicates, failed.")
+            continue
+        try:
+            collect_result(unit_id, deface.place_duplicate_unit(bids_input_dir, *unit_names[unit_id], duplicate_of,
+                                                                output_dir, modes, journal_path, filename_index),
+                           None)
+            placed_units.append(unit_id)
+        except Exception:
+            collect_result(unit_id, None, traceback.format_exc())
+    dedupe.report([unit_id for unit_id, _ in tasks], placed_units, duplicate_units, mapping_dict, main_logger)
+
+    for mode, mode_dir in mode_dirs.items():
+        vqcdeface_cmd = construct_vqcdeface_cmd(mode_dir / 'defacing_QC', filename_index)
+        main_logger.info(f"Run the following command to start a VisualQC Deface session of the {mode} mode outputs:"
+                         f"\n\t{vqcdeface_cmd}\n")
+        with open(mode_dir / 'defacing_qc_cmd', 'w') as f:
+            f.write(vqcdeface_cmd + '\n')
+
+        if args.qc_render == 'fsleyes':
+            render.render_queue(render.get_qc_render_jobs(mode_dir / 'defacing_QC'), args.n_cpus, main_logger,
+                                log_path=output_dir / 'logs' / 'render_server.log')
+        elif args.qc_render == 'montage':
+            # only subjects/sessions that weren't defaced in this run can still be missing their montage
+            qc_montage.montage_queue([d for _, d in render.get_qc_render_jobs(mode_dir / 'defacing_QC')], args.n_cpus,
+                                     main_logger)
+
+    cache.report(cache_stats, main_logger)
+    resources.report(resource_log, main_logger)
+
+    if args.trace:
+        tracing.report(trace_dir, output_dir / 'logs', main_logger)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,123 @@
+"""Materializes files of the output trees without copying their bytes where the filesystem allows it.
+
+Each file is placed with the first strategy of the policy that works:
+
+    reflink    a copy-on-write clone (FICLONE); shares blocks with the source until either file is changed
+    hardlink   a second name for the source's inode
+    copy       a byte copy with shutil.copy2
+
+Reflinks need a filesystem like XFS or Btrfs and hardlinks need source and destination on the same filesystem. A
+strategy that fails between two filesystems is not tried again between them. A hardlinked output *is* its source, so
+whatever rewrites an output must replace it, as prepare_to_share does when scrubbing sidecars, rather than write into
+it.
+
+The policy is set with configure and exported in the environment so that worker processes pick it up. Files and bytes
+materialized by each strategy are counted per process.
+"""
+
+import errno
+import fcntl
+import os
+import shutil
+import threading
+from pathlib import Path
+
+POLICY_ENV = 'DEFACING_MATERIALIZE_POLICY'
+POLICIES = {'auto': ['reflink', 'hardlink', 'copy'],
+            'reflink': ['reflink', 'copy'],
+            'hardlink': ['hardlink', 'copy'],
+            'copy': ['copy']}
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+# errors meaning a strategy isn't supported between two filesystems, rather than a problem with one file
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EPERM, errno.ENOSYS}
+
+_lock = threading.Lock()
+_unsupported = set()  # (strategy, source device, destination device)
+_stats = {}
+
+
+def configure(policy):
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown materialization policy: {policy}")
+    os.environ[POLICY_ENV] = policy
+
+
+def get_policy():
+    return os.environ.get(POLICY_ENV, 'auto')
+
+
+def _reflink(src, tmp):
+    with open(src, 'rb') as f_src, open(tmp, 'wb') as f_dst:
+        fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+    shutil.copystat(src, tmp)
+
+
+def _place(strategy, src, dst):
+    """Materializes src at a temporary name next to dst and renames it into place, replacing any existing dst."""
+    tmp = dst.with_name(f'.{dst.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        if strategy == 'reflink':
+            _reflink(src, tmp)
+        elif strategy == 'hardlink':
+            os.link(src, tmp)
+        else:
+            shutil.copy2(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        # also left behind when tmp and dst are links to the same inode, which rename() leaves alone
+        tmp.unlink(missing_ok=True)
+
+
+def materialize(src, dst, policy=None):
+    """Places a file at dst with the same contents as src, without copying bytes where possible.
+
+    :param src: Path to the source file.
+    :param dst: Path to the destination file; its parent directory must exist.
+    :param str policy: optional, One of POLICIES; the configured policy by default.
+    :return str: The strategy that was used.
+    """
+    src, dst = Path(src), Path(dst)
+    size = os.stat(src).st_size
+    devices = (os.stat(src).st_dev, os.stat(dst.parent).st_dev)
+    strategies = POLICIES[policy or get_policy()]
+    for strategy in strategies:
+        if strategy != 'copy' and (strategy, *devices) in _unsupported:
+            continue
+        try:
+            _place(strategy, src, dst)
+        except OSError as err:
+            if strategy == 'copy' or err.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            with _lock:
+                _unsupported.add((strategy, *devices))
+            continue
+        with _lock:
+            files, n_bytes = _stats.get(strategy, (0, 0))
+            _stats[strategy] = (files + 1, n_bytes + size)
+        return strategy
+
+
+def copytree(src, dst, policy=None):
+    """Like shutil.copytree, materializing every file with materialize."""
+    return shutil.copytree(src, dst, copy_function=lambda s, d: materialize(s, d, policy))
+
+
+def get_stats():
+    """Files and bytes materialized by each strategy in this process, as {strategy: (files, bytes)}."""
+    with _lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _lock:
+        _stats.clear()
+
+
+def summarize(stats):
+    """One line describing the strategies used and the bytes they saved over copying."""
+    if not stats:
+        return "No files materialized."
+    saved = sum(n_bytes for strategy, (_, n_bytes) in stats.items() if strategy != 'copy')
+    used = ', '.join(f"{strategy}: {files} file(s), {n_bytes / 1e6:.1f} MB"
+                     for strategy, (files, n_bytes) in sorted(stats.items()))
+    return f"Materialized files with {used}; {saved / 1e6:.1f} MB not copied."
@@ -0,0 +1,108 @@
+"""Defaces the primary scan in further defacing modes with the alignment of a single @afni_refacer_run.
+
+Nearly all of @afni_refacer_run's time goes into the affine alignment of the scan to the MNI template. A mode only
+changes the shell that is then moved into the scan's space to mark the voxels to remove. With several modes the
+refacer runs in the first mode only, with -no_clean, so its work directory keeps the affine matrices it computed.
+
+find_alignment picks the matrix that moves the template into the scan by applying each matrix of the work directory
+to the first mode's shell and checking that it reproduces the refacer's own shell mask, so nothing depends on the
+refacer's internal file names. deface_mode then moves another mode's shell into the scan with 3dAllineate and masks
+the primary scan with it in-process, like the "other" scans, into a work directory laid out like the refacer's.
+
+If no matrix reproduces the mask, e.g. with a refacer version that works differently, every mode runs the refacer.
+"""
+
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+from nibabel.filebasedimages import ImageFileError
+
+import register
+import utils
+
+SHELLS = {'regular': 'afni_refacer_shell_sym_1.0.nii.gz', 'aggressive': 'afni_refacer_shell_sym_2.0.nii.gz'}
+FACEMASK_FILENAME = 'tmp.05.sh_t2a_thr.nii'
+RESULT_FILENAME = 'tmp.99.result.deface.nii'
+# overlap with the refacer's shell mask a matrix must reproduce; nearest neighbour resampling only differs from the
+# refacer's own resampling at the edge of the mask
+MIN_DICE = 0.95
+
+
+def find_shell(shell):
+    """Absolute path to a refacer shell in the AFNI installation, or None if it can't be found."""
+    out, err = utils.run_command(f"module load afni 2>/dev/null; @FindAfniDsetPath {shell}",
+                                 tool='@FindAfniDsetPath')
+    if err or not out or not out.strip():
+        return None
+    return Path(out.strip().splitlines()[-1]) / shell
+
+
+def warp_shell(matrix, shell_path, primary, out_path, log_fileobj=None):
+    """Moves a shell into the space of the primary scan with an affine matrix, resampling it nearest neighbour.
+
+    :return str: Error message, or None if 3dAllineate succeeded.
+    """
+    cmd = (f"module load afni 2>/dev/null; 3dAllineate -1Dmatrix_apply {matrix} -source {shell_path} "
+           f"-master {primary} -final NN -prefix {out_path}")
+    _, err = utils.run_command(cmd, log_fileobj, tool='3dAllineate', scan=primary)
+    return err
+
+
+def get_removed_voxels(facemask_path):
+    """Voxels a shell mask in the scan's space removes: the nonzero voxels of its second volume."""
+    return np.asanyarray(nib.load(facemask_path).dataobj[..., 1]) != 0
+
+
+def get_dice(a, b):
+    total = int(a.sum()) + int(b.sum())
+    return 1.0 if total == 0 else 2 * int(np.logical_and(a, b).sum()) / total
+
+
+def find_alignment(workdir, primary, mode, log_fileobj=None):
+    """Finds the matrix in a refacer work directory that moves the template into the primary scan.
+
+    :param Path workdir: Work directory of an @afni_refacer_run with -no_clean on the primary scan.
+    :param Path primary: Absolute path to the primary scan.
+    :param str mode: Mode the refacer ran in, which determines its shell.
+    :param io.TextIOWrapper log_fileobj: optional, File object the commands' output is written to.
+    :return Path: The matrix, or None if no matrix reproduces the refacer's shell mask.
+    """
+    shell_path = find_shell(SHELLS[mode])
+    reference = workdir / FACEMASK_FILENAME
+    if shell_path is None or not reference.exists():
+        return None
+    removed = get_removed_voxels(reference)
+
+    for matrix in sorted(workdir.glob('*.1D')):
+        check = workdir / f'check.{matrix.stem}.nii'
+        try:
+            if warp_shell(matrix, shell_path, primary, check, log_fileobj) is not None:
+                continue  # not an affine matrix
+            candidate = get_removed_voxels(check)
+            if candidate.shape == removed.shape and get_dice(candidate, removed) >= MIN_DICE:
+                return matrix
+        except (OSError, ValueError, IndexError, ImageFileError):
+            continue
+        finally:
+            check.unlink(missing_ok=True)
+    return None
+
+
+def deface_mode(matrix, primary, mode, mode_workdir, subj_logger, log_fileobj=None):
+    """Defaces the primary scan in a mode with the matrix from find_alignment, writing the shell mask and the defaced
+    scan into mode_workdir under the names the refacer gives them.
+
+    :return str: Error message, or None on success.
+    """
+    shell_path = find_shell(SHELLS[mode])
+    if shell_path is None:
+        return f"{SHELLS[mode]} not found in the AFNI installation"
+    mode_workdir.mkdir(parents=True, exist_ok=True)
+    facemask = mode_workdir / FACEMASK_FILENAME
+    err = warp_shell(matrix, shell_path, primary, facemask, log_fileobj)
+    if err:
+        return err
+    defacemask = register.preprocess_facemask_native(facemask, subj_logger)
+    register.apply_mask_native(primary, defacemask, mode_workdir / RESULT_FILENAME)
+    return None
@@ -4,10 +4,15 @@ import argparse
 import subprocess
 from pathlib import Path
 import time
-import shutil
 import json
 import os
-import filecmp
+from concurrent.futures import ThreadPoolExecutor
+
+import layout_index
+import materialize
+
+MANIFEST_FILENAME = 'share_manifest.json'
+IDENTIFYING_FIELDS = ['AcquisitionDateTime', 'AcquisitionTime']
 
 
 def get_args():
@@ -20,6 +25,19 @@ def get_args():
     parser.add_argument('defaced_bids_dir', type=Path,
                         help='The directory with the output dataset '
                              'formatted according to the BIDS standard containing defaced anatomical images.')
+    parser.add_argument('--materialize', choices=list(materialize.POLICIES), default='auto',
+                        help="How files of the original dataset are placed in the shareable tree: 'auto' tries a "
+                             "copy-on-write reflink, then a hardlink, then a copy; 'reflink' and 'hardlink' fall back "
+                             "to a copy; 'copy' always copies.")
+    parser.add_argument('-n', '--n-threads', type=int, default=16,
+                        help='Number of threads listing directories, materializing files and scrubbing sidecars.')
+    parser.add_argument('--manifest', type=Path, default=None,
+                        help=f'Where to record what was shared and scrubbed, so that a re-run only touches new or '
+                             f'changed files. Defaults to {MANIFEST_FILENAME} next to defaced_bids_dir.')
+    parser.add_argument('--layout-index', type=Path, default=None,
+                        help=f'Path to the {layout_index.INDEX_FILENAME} written by the defacing pipeline. The '
+                             f'subdirectories of the input dataset are then read from the index instead of walking '
+                             f'the dataset.')
 
     return parser.parse_args()
 
@@ -30,45 +48,159 @@ def run_command(cmdstr, logfile):
     subprocess.run(cmdstr, stdout=logfile, stderr=subprocess.STDOUT, encoding='utf8', shell=True)
 
 
-def scrub_identifiers(bids_defaced_dir):
-    sidecar_fields_to_rm = ['AcquisitionDateTime', 'AcquisitionTime']
-    sidecars = bids_defaced_dir.rglob('*.json')
-    for sidecar in sidecars:
-        with open(sidecar, 'r') as f:
-            data = json.load(f)
+def scrub_sidecar(sidecar):
+    """Removes identifying fields from a JSON sidecar.
+
+    Sidecars without any are left untouched; the fields are looked for in the raw text before the JSON is parsed. A
+    sidecar that is rewritten is replaced rather than written into, since it may be a hardlink to the original
+    dataset's sidecar.
+
+    :return bool: True if the sidecar was rewritten.
+    """
+    with open(sidecar, 'rb') as f:
+        raw = f.read()
+    if not any(field.encode('utf8') in raw for field in IDENTIFYING_FIELDS):
+        return False
+
+    data = json.loads(raw)
+    to_rm = [field for field in IDENTIFYING_FIELDS if field in data.keys()]
+    if not to_rm:
+        return False
+    for field in to_rm:
+        del data[field]
+
+    tmp = sidecar.with_name(f'.{sidecar.name}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp, sidecar)
+    return True
+
+
+def get_original_subdirs(bids_dir, index_path=None):
+    """Lists the subdirectories of the original BIDS tree relative to its root, parents before children."""
+    if index_path is not None and index_path.exists():
+        return layout_index.get_subdirs(index_path, bids_dir.resolve())
+    return [Path(x[0]).relative_to(bids_dir) for x in os.walk(bids_dir)]
+
+
+def scan_tree(root, tops, executor):
+    """Lists the files under some directories of a tree, walking each directory on its own thread.
+
+    :param Path root: Root of the tree.
+    :param list tops: Directories to walk, relative to root.
+    :return tuple: ({relative file path: (size, mtime_ns)}, set of relative directory paths)
+    """
+    def walk(top):
+        files, dirs = {}, set()
+        for dirpath, _, filenames in os.walk(root / top):
+            dirs.add(str(Path(dirpath).relative_to(root)))
+            for name in filenames:
+                stat = os.stat(os.path.join(dirpath, name))
+                files[str(Path(dirpath, name).relative_to(root))] = (stat.st_size, stat.st_mtime_ns)
+        return files, dirs
+
+    files, dirs = {}, set()
+    for top_files, top_dirs in executor.map(walk, tops):
+        files.update(top_files)
+        dirs.update(top_dirs)
+    return files, dirs
+
+
+def list_top_level_files(root):
+    """Lists the files directly in root, as {name: (size, mtime_ns)}."""
+    with os.scandir(root) as entries:
+        return {e.name: (e.stat().st_size, e.stat().st_mtime_ns) for e in entries if e.is_file()}
+
+
+def load_manifest(manifest_path, bids_dir):
+    if manifest_path.exists():
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest['original_bids_dir'] == str(bids_dir.resolve()):
+            return manifest
+    return {'original_bids_dir': str(bids_dir.resolve()), 'dirs': [], 'files': {}, 'scrubbed': {}}
 
-        for field in sidecar_fields_to_rm:
-            if field in data.keys():
-                del data[field]
 
-        with open(sidecar, 'w') as f:
-            json.dump(data, f, indent=4)
+def save_manifest(manifest, manifest_path):
+    """Writes the manifest atomically so an interrupted run cannot leave a truncated file behind."""
+    tmp_path = manifest_path.with_name(manifest_path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
 
 
 def main():
     args = get_args()
-    bids_dir = args.bids_dir
-    bids_defaced_dir = args.output_dir
-
-    # copy over all non-anat subdirectories in original BIDS tree
-    bids_subdirs = [Path(x[0]).relative_to(bids_dir) for x in os.walk(bids_dir)]
-    bids_defaced_subdirs = [Path(y[0]).relative_to(bids_defaced_dir) for y in os.walk(bids_defaced_dir)]
-    diff_subdirs = set(bids_subdirs).difference(bids_defaced_subdirs)
-    for subdir in diff_subdirs:
-        shutil.copytree(bids_dir / subdir, bids_defaced_dir / subdir)
-
-    # remove JSON sidecar fields with identifying information
-    scrub_identifiers(bids_defaced_dir)
-
-    # remove defacing pipeline log files
-    logfiles = bids_defaced_dir.rglob('defacing_pipeline.log')
-    for logfile in logfiles:
-        logfile.unlink(missing_ok=True)
-
-    # copy over top-level (modality agnostic) files from original BIDS tree
-    dcmp = filecmp.dircmp(bids_dir, bids_defaced_dir)
-    for toplevel_file in dcmp.left_only:
-        shutil.copy2(bids_dir / toplevel_file, bids_defaced_dir / toplevel_file)
+    materialize.configure(args.materialize)
+    bids_dir = args.original_bids_dir
+    bids_defaced_dir = args.defaced_bids_dir
+    manifest_path = args.manifest or bids_defaced_dir.parent / MANIFEST_FILENAME
+    manifest = load_manifest(manifest_path, bids_dir)
+
+    with ThreadPoolExecutor(max_workers=args.n_threads) as executor:
+        defaced_files, defaced_dirs = scan_tree(bids_defaced_dir, [
+            e.name for e in os.scandir(bids_defaced_dir) if e.is_dir()], executor)
+        defaced_files.update(list_top_level_files(bids_defaced_dir))
+
+        # share the non-anat subdirectories of the original BIDS tree that the defacing pipeline didn't write, along
+        # with those shared by a previous run
+        shared = set(manifest['dirs'])
+        tops = []
+        for subdir in get_original_subdirs(bids_dir, args.layout_index):
+            if subdir == Path('.'):
+                continue
+            if str(subdir) in shared or str(subdir) not in defaced_dirs:
+                if not any(str(parent) in shared for parent in subdir.parents):
+                    tops.append(subdir)
+                shared.add(str(subdir))
+        original_files, original_dirs = scan_tree(bids_dir, tops, executor)
+
+        # top-level (modality agnostic) files the pipeline didn't write
+        shared_top_level = {name: stat for name, stat in list_top_level_files(bids_dir).items()
+                            if name in manifest['files'] or name not in defaced_files}
+        original_files.update(shared_top_level)
+
+        # recorded before anything is written so that an interrupted run picks up its half-shared directories
+        manifest['dirs'] = sorted(shared | original_dirs)
+        save_manifest(manifest, manifest_path)
+
+        # files of the original tree that are new or changed since the last run
+        for rel_dir in sorted(original_dirs, key=lambda d: len(Path(d).parts)):
+            (bids_defaced_dir / rel_dir).mkdir(parents=True, exist_ok=True)
+        to_share = [rel for rel, stat in original_files.items()
+                    if manifest['files'].get(rel) != list(stat) or rel not in defaced_files]
+        list(executor.map(lambda rel: materialize.materialize(bids_dir / rel, bids_defaced_dir / rel), to_share))
+        for rel in to_share:
+            manifest['files'][rel] = list(original_files[rel])
+            stat = os.stat(bids_defaced_dir / rel)
+            defaced_files[rel] = (stat.st_size, stat.st_mtime_ns)
+
+        # files shared by a previous run that are gone from the original tree
+        removed = [rel for rel in manifest['files'] if rel not in original_files]
+        for rel in removed:
+            (bids_defaced_dir / rel).unlink(missing_ok=True)
+            del manifest['files'][rel]
+            defaced_files.pop(rel, None)
+            manifest['scrubbed'].pop(rel, None)
+
+        # remove defacing pipeline log files
+        for rel in [rel for rel in defaced_files if rel.endswith('defacing_pipeline.log')]:
+            (bids_defaced_dir / rel).unlink(missing_ok=True)
+            del defaced_files[rel]
+
+        # remove JSON sidecar fields with identifying information from sidecars that are new or changed
+        sidecars = [rel for rel, stat in defaced_files.items()
+                    if rel.endswith('.json') and manifest['scrubbed'].get(rel) != list(stat)]
+        rewritten = sum(executor.map(lambda rel: scrub_sidecar(bids_defaced_dir / rel), sidecars))
+        for rel in sidecars:
+            stat = os.stat(bids_defaced_dir / rel)
+            manifest['scrubbed'][rel] = [stat.st_size, stat.st_mtime_ns]
+
+    save_manifest(manifest, manifest_path)
+    print(f"Shared {len(to_share)} new or changed file(s) of {len(original_files)}, removed {len(removed)}. Checked "
+          f"{len(sidecars)} new or changed sidecar(s) of {sum(r.endswith('.json') for r in defaced_files)}, "
+          f"rewrote {rewritten}. Manifest at {manifest_path}")
+    print(materialize.summarize(materialize.get_stats()))
 
 
 if __name__ == "__main__":
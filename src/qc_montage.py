@@ -0,0 +1,198 @@
+"""2D QC montages of defaced images, made with nibabel and NumPy instead of fsleyes.
+
+A montage shows the original image above the defaced one. Each row has a lateral and a frontal view of the head
+surface, then sagittal slices. The surface views shade the first voxel above a threshold seen along the viewing axis
+by its depth and slope, so a removed face shows up without OpenGL. Both rows are scaled with the original image's
+intensities, so the two can be compared directly.
+
+The montage is written as defaced_montage.png into each defacing_QC/<entities> directory that vqcdeface_prep builds.
+With the montage option configured, worker processes write it as soon as a subject/session is linked for QC.
+Montages that are still missing can be made in bulk, many images per process:
+
+    python qc_montage.py --qc-dir defacing_QC -n 8
+    python qc_montage.py defacing_QC/sub-01/ses-01/T1w
+"""
+
+import argparse
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+from PIL import Image
+
+MONTAGE_FILENAME = 'defaced_montage.png'
+MONTAGE_ENV = 'DEFACING_QC_MONTAGE'
+SLICE_FRACTIONS = (0.35, 0.5, 0.65)  # positions of the sagittal slices, from right to left
+SURFACE_THRESHOLD = 0.1  # fraction of the robust maximum intensity taken as the head surface
+ROBUST_PERCENTILE = 99.5
+GAP = 4  # pixels between panels
+
+
+def configure():
+    """Turns on montages in deface.vqcdeface_prep; exported in the environment so that worker processes pick it up."""
+    os.environ[MONTAGE_ENV] = '1'
+
+
+def is_enabled():
+    return os.environ.get(MONTAGE_ENV) == '1'
+
+
+def load_ras(img_path):
+    """Loads the first volume of an image as float32 in RAS+ orientation, with its voxel sizes."""
+    img = nib.as_closest_canonical(nib.load(img_path))
+    data = np.asarray(img.dataobj[(Ellipsis,) + (0,) * (len(img.shape) - 3)], dtype=np.float32)
+    return data, tuple(float(z) for z in img.header.get_zooms()[:3])
+
+
+def get_robust_max(data):
+    """High percentile of the nonzero intensities, from every fourth voxel along each axis."""
+    sample = data[::4, ::4, ::4]
+    sample = sample[sample > 0]
+    return float(np.percentile(sample, ROBUST_PERCENTILE)) if sample.size else 1.0
+
+
+def surface_view(data, threshold, axis):
+    """Shades the first voxel above threshold seen from the positive end of an axis by its depth and slope.
+
+    :return np.ndarray: 2D shading in [0, 1] over the two remaining axes, in their original order.
+    """
+    mask = np.flip(data > threshold, axis)
+    hit = mask.any(axis=axis)
+    depth = np.argmax(mask, axis=axis).astype(np.float32)
+    grad_a, grad_b = np.gradient(depth)
+    lambert = 1 / np.sqrt(1 + grad_a ** 2 + grad_b ** 2)
+    shading = 0.6 * lambert + 0.4 * (1 - depth / mask.shape[axis])
+    shading[~hit] = 0
+    return shading
+
+
+def to_panel(plane, zooms):
+    """Converts a (horizontal, superior-inferior) plane with values in [0, 1] into an 8-bit image, superior at the
+    top, stretched to the aspect ratio of its voxels."""
+    pixels = (np.clip(np.flipud(plane.T), 0, 1) * 255).astype(np.uint8)
+    panel = Image.fromarray(pixels)
+    scale = min(zooms)
+    size = (round(plane.shape[0] * zooms[0] / scale), round(plane.shape[1] * zooms[1] / scale))
+    return panel.resize(size, Image.BILINEAR) if size != panel.size else panel
+
+
+def get_panels(data, zooms, robust_max):
+    """Lateral and frontal surface views followed by sagittal slices of an image."""
+    threshold = SURFACE_THRESHOLD * robust_max
+    panels = [to_panel(surface_view(data, threshold, 0), (zooms[1], zooms[2])),  # from the right, anterior to the right
+              to_panel(np.flipud(surface_view(data, threshold, 1)), (zooms[0], zooms[2]))]  # from the front
+    for fraction in SLICE_FRACTIONS:
+        x = min(data.shape[0] - 1, int(data.shape[0] * (1 - fraction)))
+        panels.append(to_panel(data[x] / robust_max, (zooms[1], zooms[2])))
+    return panels
+
+
+def make_montage(qc_unit_dir, outfile=None):
+    """Writes the montage of the orig.nii.gz and defaced.nii.gz images of a defacing_QC/<entities> directory.
+
+    :param Path qc_unit_dir: Directory with the orig.nii.gz and defaced.nii.gz links.
+    :param Path outfile: optional, Where to write the PNG; MONTAGE_FILENAME in qc_unit_dir by default.
+    :return Path: The montage written.
+    """
+    qc_unit_dir = Path(qc_unit_dir)
+    outfile = outfile or qc_unit_dir / MONTAGE_FILENAME
+    orig, orig_zooms = load_ras(qc_unit_dir / 'orig.nii.gz')
+    defaced, defaced_zooms = load_ras(qc_unit_dir / 'defaced.nii.gz')
+    robust_max = get_robust_max(orig)
+    rows = [get_panels(orig, orig_zooms, robust_max), get_panels(defaced, defaced_zooms, robust_max)]
+
+    widths = [sum(p.width for p in row) + GAP * (len(row) - 1) for row in rows]
+    heights = [max(p.height for p in row) for row in rows]
+    montage = Image.new('L', (max(widths), sum(heights) + GAP * (len(rows) - 1)))
+    top = 0
+    for row, height in zip(rows, heights):
+        left = 0
+        for panel in row:
+            montage.paste(panel, (left, top))
+            left += panel.width + GAP
+        top += height + GAP
+
+    # written next to outfile and renamed into place, so a half-written montage is never mistaken for a complete one
+    tmp = outfile.with_name(f'.{outfile.name}.{os.getpid()}.tmp')
+    montage.save(tmp, format='PNG')
+    os.replace(tmp, outfile)
+    return outfile
+
+
+def make_montage_safely(qc_unit_dir):
+    """Runs make_montage, returning (qc_unit_dir, formatted traceback or None) instead of raising."""
+    try:
+        make_montage(qc_unit_dir)
+        return qc_unit_dir, None
+    except Exception:
+        return qc_unit_dir, traceback.format_exc()
+
+
+def montage_queue(qc_unit_dirs, n_procs, logger):
+    """Makes the missing montages of many defacing_QC/<entities> directories, batching them over n_procs processes.
+
+    :param list qc_unit_dirs: Directories with orig.nii.gz and defaced.nii.gz links.
+    :param int n_procs: Number of processes.
+    :param logger: Logger object imported from main.py module.
+    :return dict: Number of montages made, failures and seconds taken.
+    """
+    pending = [d for d in qc_unit_dirs if not Path(d, MONTAGE_FILENAME).exists()]
+    start = time.perf_counter()
+    if n_procs > 1 and len(pending) > 1:
+        chunksize = max(1, len(pending) // (4 * n_procs))
+        with ProcessPoolExecutor(max_workers=min(n_procs, len(pending))) as executor:
+            results = list(executor.map(make_montage_safely, pending, chunksize=chunksize))
+    else:
+        results = [make_montage_safely(d) for d in pending]
+    seconds = time.perf_counter() - start
+
+    failures = [(d, error) for d, error in results if error]
+    for qc_unit_dir, error in failures:
+        logger.error(f"Error in making the QC montage of {qc_unit_dir}:\n{error}")
+    stats = {'montages': len(results) - len(failures), 'failures': len(failures), 'seconds': seconds}
+    if results:
+        logger.info(f"Made {stats['montages']} QC montage(s) in {seconds:.1f} s "
+                    f"({seconds * 1000 / len(results):.0f} ms per image), {len(failures)} failure(s).")
+    else:
+        logger.info("All QC montages already exist.")
+    return stats
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Make 2D QC montages of defaced images next to the originals.')
+    parser.add_argument('qc_unit_dirs', type=Path, nargs='*',
+                        help='defacing_QC/<entities> directories with orig.nii.gz and defaced.nii.gz links.')
+    parser.add_argument('--qc-dir', type=Path, default=None,
+                        help='Make montages for every image listed in the defacing_id_list.txt of this defacing_QC '
+                             'directory.')
+    parser.add_argument('-n', '--n-procs', type=int, default=1, help='Number of processes making montages.')
+    parser.add_argument('--overwrite', action='store_true', default=False,
+                        help='Remake montages that exist already.')
+    args = parser.parse_args()
+    if not args.qc_dir and not args.qc_unit_dirs:
+        parser.error('either qc_unit_dirs or --qc-dir is required')
+    return args
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    logger = logging.getLogger('qc_montage')
+
+    qc_unit_dirs = list(args.qc_unit_dirs)
+    if args.qc_dir:
+        with open(args.qc_dir / 'defacing_id_list.txt', 'r') as f:
+            qc_unit_dirs.extend(args.qc_dir / line.strip() for line in f if line.strip())
+    if args.overwrite:
+        for qc_unit_dir in qc_unit_dirs:
+            qc_unit_dir.joinpath(MONTAGE_FILENAME).unlink(missing_ok=True)
+    montage_queue(qc_unit_dirs, args.n_procs, logger)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,50 @@
+import asyncio
+import os
+import shutil
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+import cache
+import commands
+import tracing
+import transforms
 import utils
 
+MASK_BACKENDS = ['native', 'fsl']
+REGISTRATION_OPTIONS = '-dof 6 -cost mutualinfo -searchcost mutualinfo'
+
+
+def preprocess_facemask_native(fmask_path, subj_logger):
+    """Generates the binarized, inverted defacemask in-process with nibabel and NumPy.
+
+    Produces the same voxels as `fslroi <facemask> <prefix> 1 1; fslmaths <prefix> -abs -binv <defacemask>` without
+    FSL and without writing the intermediate single volume to disk. Only the second volume of the 4D facemask is
+    read, through nibabel's array proxy.
+
+    :param Path fmask_path: Absolute path to the AFNI refacer's 4D facemask, 'tmp.05.sh_t2a_thr.nii'.
+    :param subj_logger: Subject or session level logger object.
+    :return Path: Absolute path to 'afni_defacemask.nii.gz'.
+    """
+    defacemask = fmask_path.parent.joinpath('afni_defacemask.nii.gz')
+
+    subj_logger.info(f"Generating a defacemask\n")
+    facemask_img = nib.load(fmask_path)
+    facemask = np.asanyarray(facemask_img.dataobj[..., 1])
+
+    # -abs -binv: voxels that are zero become one, every other voxel becomes zero
+    inverted = (facemask == 0).astype(facemask_img.get_data_dtype())
+
+    defacemask_img = nib.Nifti1Image(inverted, facemask_img.affine, facemask_img.header)
+    utils.save_nifti(defacemask_img, defacemask)
+    return defacemask
+
+
+def preprocess_facemask(fmask_path, subj_logger, backend='native'):
+    if backend == 'native':
+        return preprocess_facemask_native(fmask_path, subj_logger)
 
-def preprocess_facemask(fmask_path, subj_logger):
     prefix = fmask_path.parent.joinpath('afni_facemask')
     defacemask = fmask_path.parent.joinpath('afni_defacemask.nii.gz')
 
@@ -11,8 +54,7 @@ def preprocess_facemask(fmask_path, subj_logger):
     # arithmetic on the result from above
     c2 = f"fslmaths {prefix}.nii.gz -abs -binv {defacemask}"
     subj_logger.info(f"Generating a defacemask\n")
-    out, err = utils.run_command('; '.join([c1, c2]))
-    subj_logger.info(out)
+    _, err = utils.run_command('; '.join([c1, c2]), tool='fslroi+fslmaths', scan=fmask_path, logger=subj_logger)
     if err:
         subj_logger.error(err)
         raise Exception(f"Error in generating deface mask: {err}")
@@ -26,6 +68,58 @@ def preprocess_facemask(fmask_path, subj_logger):
         raise
 
 
+def apply_mask_native(scan_path, mask_path, out_path, slab_thickness=8):
+    """Masks a 3D or 4D scan in-process, one slab of slices at a time.
+
+    Equivalent to `fslmaths <scan> -mas <mask> <out>`. The scan is read through nibabel's array proxy, memory-mapped
+    for '.nii' files and through indexed_gzip, when installed, for '.nii.gz' files. Each slab is multiplied by the
+    binarized mask and streamed straight to the output file, so only a few slabs of the scan are held in memory at a
+    time instead of the whole volume.
+
+    :param Path scan_path: Absolute path to the scan to mask.
+    :param Path mask_path: Absolute path to a 3D mask in the same space as the scan; voxels > 0 are kept.
+    :param Path out_path: Absolute path to the masked output, '.nii' or '.nii.gz'.
+    :param int slab_thickness: Number of slices along the third axis read and written at a time.
+    :return Path: Absolute path to the masked output.
+    """
+    scan_img = nib.load(scan_path, mmap=True, keep_file_open=True)
+    mask = np.asanyarray(nib.load(mask_path).dataobj) > 0
+    shape = scan_img.shape
+
+    out_header = scan_img.header.copy()
+    out_dtype = out_header.get_data_dtype()
+    slope, inter = out_header.get_slope_inter()
+    if slope not in (None, 1) or inter not in (None, 0):
+        # the proxy returns scaled values; store them as they are rather than rescaling
+        out_header.set_data_dtype(np.float32)
+        out_header.set_slope_inter(1, 0)
+        out_dtype = out_header.get_data_dtype()
+    out_header.set_data_offset(0)  # recomputed from the extensions when the header is written
+
+    # written next to out_path and renamed into place once complete, so a failure halfway leaves no output behind
+    tmp_path = Path(out_path).with_name(Path(out_path).name + '.part')
+    opener = utils.ParallelGzipWriter(tmp_path) if str(out_path).endswith('.gz') else open(tmp_path, 'wb')
+    try:
+        with opener as f_out:
+            out_header.write_to(f_out)
+            f_out.write(b'\x00' * (out_header.get_data_offset() - f_out.tell()))
+
+            # NIfTI data is stored in Fortran order, so slabs along the third axis are written volume by volume
+            for reversed_idx in np.ndindex(*shape[:2:-1]):
+                volume_idx = reversed_idx[::-1]
+                for z_start in range(0, shape[2], slab_thickness):
+                    z_slice = slice(z_start, min(z_start + slab_thickness, shape[2]))
+                    slab = np.asanyarray(scan_img.dataobj[(slice(None), slice(None), z_slice) + volume_idx])
+                    slab = np.where(mask[:, :, z_slice], slab, 0).astype(out_dtype)
+                    f_out.write(slab.tobytes(order='F'))
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    return out_path
+
+
 def get_intermediate_filenames(outdir, prefix):
     mat = f"{outdir / prefix}_reg.mat"
     reg_out = f"{outdir / prefix}_registered.nii.gz"
@@ -34,39 +128,123 @@ def get_intermediate_filenames(outdir, prefix):
     return mat, reg_out, mask, defaced_out
 
 
-def register_to_primary_scan(subj_dir, afni_workdir, primary_scan, other_scans_list, subj_logger):
-    modality = "anat"
-
-    # preprocess facemask
-    raw_facemask_volumes = afni_workdir.joinpath('tmp.05.sh_t2a_thr.nii')
-    t1_mask = preprocess_facemask(raw_facemask_volumes, subj_logger)
-
-    if other_scans_list:
-        for other in other_scans_list:
-            entities = other.split('_')
-
-            # changing other scan name to other scan full path
-            other = subj_dir.joinpath(entities[1], modality, other)
-            other_prefix = other.name.split('.')[0]  # filename without the extension
-            other_outdir = afni_workdir.joinpath(other_prefix)
-
-            matrix, reg_out, other_mask, other_defaced = get_intermediate_filenames(other_outdir, other_prefix)
-
-            other_outdir.mkdir(parents=True, exist_ok=True)
-            cp_cmd = f"cp {other} {other_outdir / other_prefix}"
-
-            flirt_cmd = f"flirt -dof 6 -cost mutualinfo -searchcost mutualinfo -in {primary_scan} -ref {other} -omat {matrix} -out {reg_out}"
+async def run_chain_command(tool, cmd, other, primary_scan, subj_logger):
+    """Runs one command of a registration chain, raising if it fails."""
+    with tracing.span(tool, 'command', **tracing.scan_tags(other)):
+        result = await commands.run(cmd, logger=subj_logger, tool=tool, scan=other)
+    err = commands.describe_failure(cmd, result)
+    if err:
+        subj_logger.error(f"{tool} {err}")
+        raise Exception(f"Error in registering {other.name} to {primary_scan.name}: {tool} {err}")
 
-            # t1 mask can be found in the afni work directory
-            applyxfm_cmd = f"flirt -interp nearestneighbour -applyxfm -init {matrix} -in {t1_mask} -ref {other} -out {other_mask}"
 
-            mask_cmd = f"fslmaths {other} -mas {other_mask} {other_defaced}"
+async def register_other_scan(subj_dir, afni_workdirs, primary_scan, other, t1_masks, subj_logger, backend='native',
+                              use_store=False):
+    """Registers one "other" scan to the primary scan and applies the registered defacemask of every mode to it.
 
-            full_cmd = " ; ".join([cp_cmd, flirt_cmd, applyxfm_cmd, mask_cmd]) + '\n'
+    The transform doesn't depend on the mode, so it is computed, or taken from the transform store when use_store is
+    set, once in the first work directory and copied to the others. Only applying the defacemask runs per mode.
+    """
+    modality = "anat"
+    entities = other.split('_')
+
+    # changing other scan name to other scan full path
+    other = subj_dir.joinpath(entities[1], modality, other)
+    other_prefix = other.name.split('.')[0]  # filename without the extension
+    tags = tracing.scan_tags(other)
+
+    first_matrix = None
+    for afni_workdir, t1_mask in zip(afni_workdirs, t1_masks):
+        other_outdir = afni_workdir.joinpath(other_prefix)
+        matrix, reg_out, other_mask, other_defaced = get_intermediate_filenames(other_outdir, other_prefix)
+
+        other_outdir.mkdir(parents=True, exist_ok=True)
+        cp_cmd = f"cp {other} {other_outdir / other_prefix}"
+
+        flirt_cmd = f"flirt {REGISTRATION_OPTIONS} -in {primary_scan} -ref {other} -omat {matrix} -out {reg_out}"
+
+        # t1 mask can be found in the afni work directory
+        applyxfm_cmd = f"flirt -interp nearestneighbour -applyxfm -init {matrix} -in {t1_mask} -ref {other} -out {other_mask}"
+
+        mask_cmd = f"fslmaths {other} -mas {other_mask} {other_defaced}"
+
+        await run_chain_command('cp', cp_cmd, other, primary_scan, subj_logger)
+        if first_matrix is None:
+            # the transform doesn't depend on the mode, so a previous run may have stored it already
+            transform_key = None
+            if use_store:
+                transform_key = await asyncio.to_thread(transforms.get_key, primary_scan, other, REGISTRATION_OPTIONS)
+            if transform_key is not None and await asyncio.to_thread(transforms.fetch, transform_key, matrix):
+                subj_logger.info(f"Reusing the stored transform of {other.name} to {primary_scan.name} and applying "
+                                 f"defacemask...")
+            else:
+                subj_logger.info(f"Registering {other.name} to {primary_scan.name} and applying defacemask...")
+                await run_chain_command('flirt', flirt_cmd, other, primary_scan, subj_logger)
+                if transform_key is not None:
+                    await asyncio.to_thread(transforms.store, transform_key, matrix)
+            first_matrix = matrix
+        else:
+            shutil.copyfile(first_matrix, matrix)
+
+        # each command runs on its own so that it gets its own trace span
+        await run_chain_command('flirt_applyxfm', applyxfm_cmd, other, primary_scan, subj_logger)
+        if backend == 'fsl':
+            await run_chain_command('fslmaths', mask_cmd, other, primary_scan, subj_logger)
+        else:
+            with tracing.span('apply_mask_native', **tags):
+                await asyncio.to_thread(apply_mask_native, other, Path(other_mask), Path(other_defaced))
+
+
+async def register_other_scans(subj_dir, afni_workdirs, primary_scan, other_scans_list, t1_masks, subj_logger,
+                               n_threads=1, backend='native', use_store=False):
+    """Runs the registration chains of "other" scans on one event loop, up to n_threads at a time.
+
+    :return list: None or the exception raised for each scan of other_scans_list.
+    """
+    slots = asyncio.Semaphore(max(1, n_threads))
+    if use_store:
+        await asyncio.to_thread(cache.hash_scan, primary_scan)  # once, rather than in every chain
+
+    async def register(other):
+        async with slots:
+            await register_other_scan(subj_dir, afni_workdirs, primary_scan, other, t1_masks, subj_logger, backend,
+                                      use_store)
+
+    return await asyncio.gather(*[register(other) for other in other_scans_list], return_exceptions=True)
+
+
+def register_to_primary_scan(subj_dir, afni_workdirs, primary_scan, other_scans_list, subj_logger, n_threads=1,
+                             backend='native'):
+    """Registers every "other" scan to the primary scan and applies the defacemask of every mode to it.
+
+    The registration chains of "other" scans are independent of each other, so up to n_threads of them run at the
+    same time. A failing chain doesn't stop the others; all failures are reported together once every chain is done.
+
+    :param Path subj_dir: Absolute path to the subject's input directory.
+    :param list afni_workdirs: Absolute paths to the renamed AFNI refacer work directories of the primary scan, one
+        per defacing mode.
+    :param Path primary_scan: Absolute path to the primary scan.
+    :param list other_scans_list: Paths to the "other" scans of the session.
+    :param subj_logger: Subject or session level logger object.
+    :param int n_threads: Maximum number of registration chains running at once.
+    :param str backend: 'native' to generate and apply defacemasks in-process, 'fsl' to use fslroi and fslmaths.
+    """
+    # preprocess facemask
+    t1_masks = []
+    for afni_workdir in afni_workdirs:
+        raw_facemask_volumes = afni_workdir.joinpath('tmp.05.sh_t2a_thr.nii')
+        with tracing.span('preprocess_facemask', **tracing.scan_tags(primary_scan)):
+            t1_masks.append(preprocess_facemask(raw_facemask_volumes, subj_logger, backend))
 
-            subj_logger.info(f"Registering {other.name} to {primary_scan.name} and applying defacemask...")
-            out, err = utils.run_command(full_cmd)
-            subj_logger.info(out)
-            if err:
-                subj_logger.error(err)
-                raise Exception(f"Error in registering {other.name} to {primary_scan.name}: {err}")
+    if other_scans_list:
+        # checked before the event loop starts: the first check in a worker process queries the FSL version
+        use_store = transforms.is_enabled()
+        outcomes = asyncio.run(register_other_scans(subj_dir, afni_workdirs, primary_scan, other_scans_list, t1_masks,
+                                                    subj_logger, n_threads, backend, use_store))
+        failures = {other: err for other, err in zip(other_scans_list, outcomes) if isinstance(err, Exception)}
+
+        if failures:
+            for other, err in failures.items():
+                subj_logger.error(f"Registration of {other} failed: {err}")
+            raise Exception(f"Error in registering {len(failures)} of {len(other_scans_list)} scan(s) to "
+                            f"{primary_scan.name}: {', '.join(str(Path(o).name) for o in failures)}")
@@ -1,8 +1,303 @@
-from deface import generate_3d_renders
-from pathlib import Path
+"""3D renders of defaced images for VisualQC deface.
+
+Running ``fsleyes render`` once per view pays for Python, wx and OpenGL startup and for loading the volume on every
+call. A BatchRenderer instead keeps one offscreen fsleyes renderer running for as long as it's needed. That renderer
+loads each image once and renders every rotation of it. If the renderer can't be started, or fails on an image, the
+views are rendered with ``fsleyes render`` as before.
+
+    python render.py defaced.nii.gz render_outdir
+    python render.py --qc-dir defacing_QC -n 4
+"""
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import queue
+import shlex
+import subprocess
 import sys
+import threading
+import time
+import traceback
+from pathlib import Path
+
+import utils
+
+ROTATIONS = [(45, 5, 10), (-45, 5, 10)]
+OVERLAY_OPTIONS = ['--displayRange', '20', '250', '--interpolation', 'spline', '--cmap', 'render1', '--blendFactor',
+                   '0.3', '-r', '100', '--numSteps', '500']
+
+
+def get_render_outfile(render_outdir, idx):
+    return render_outdir.joinpath('defaced_render_0' + str(idx) + '.png')
+
+
+def get_render_args(defaced_img, outfile, rotation):
+    """Arguments to ``fsleyes render`` for one view of a defaced image."""
+    yaw, pitch, roll = rotation
+    return ['--scene', '3d', '-rot', str(yaw), str(pitch), str(roll), '--outfile', str(outfile),
+            str(defaced_img)] + OVERLAY_OPTIONS
+
+
+def get_missing_views(render_outdir):
+    """Lists the (outfile, rotation) views that haven't been rendered yet."""
+    views = []
+    for idx, rotation in enumerate(ROTATIONS):
+        outfile = get_render_outfile(render_outdir, idx)
+        if not outfile.exists():
+            views.append((outfile, rotation))
+    return views
+
+
+def render_with_cli(defaced_img, views, logger):
+    """Renders each view with its own ``fsleyes render`` process."""
+    for outfile, rotation in views:
+        render_args = shlex.join(get_render_args(defaced_img, outfile, rotation))
+        fsleyes_render_cmd = f"module load fsl; fsleyes render {render_args}"
+        logger.debug(fsleyes_render_cmd)
+        out, err = utils.run_command(fsleyes_render_cmd)
+        if not outfile.exists():
+            logger.error(f"Error in rendering {defaced_img.name} with fsleyes.\n{err or out}")
+
+
+def get_server_command():
+    """Command that starts the render server under a Python interpreter that can import fsleyes."""
+    script = Path(__file__).resolve()
+    if importlib.util.find_spec('fsleyes') is not None:
+        return [sys.executable, str(script), '--serve']
+    # FSL ships fsleyes with its own interpreter
+    return f'module load fsl 2>/dev/null; exec "$FSLDIR/bin/fslpython" {shlex.quote(str(script))} --serve'
+
+
+class BatchRenderer:
+    """Client of one long-lived render server process. Use as a context manager, one per worker thread or process.
+
+    :param logger: Logger object imported from main.py module.
+    :param log_fileobj: optional, File object the render server's output is written to. Discarded by default.
+    :param command: optional, Command that starts the render server; see get_server_command.
+    """
+
+    def __init__(self, logger, log_fileobj=None, command=None):
+        self.logger = logger
+        self.log_fileobj = log_fileobj
+        self.command = command or get_server_command()
+        self.proc = None
+        self.n_images = 0
+        self.n_views = 0
+        self.n_fallbacks = 0
+
+    def start(self):
+        """Starts the render server and waits until it has an OpenGL context. Returns False if it couldn't start."""
+        try:
+            self.proc = subprocess.Popen(self.command, shell=isinstance(self.command, str), stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=self.log_fileobj or subprocess.DEVNULL,
+                                         encoding='utf8', bufsize=1)
+        except OSError as err:
+            self.logger.warning(f"Could not start the fsleyes render server, rendering with fsleyes render: {err}")
+            self.proc = None
+            return False
+
+        if self._receive().get('ready'):
+            return True
+        self.logger.warning("The fsleyes render server exited during startup, rendering with fsleyes render.")
+        self.close()
+        return False
+
+    def _receive(self):
+        line = self.proc.stdout.readline()
+        return json.loads(line) if line else {}
+
+    def render(self, defaced_img, render_outdir):
+        """Renders every view of defaced_img that doesn't exist in render_outdir yet.
+
+        :return list: Paths to the views that were rendered.
+        """
+        views = get_missing_views(render_outdir)
+        if not views:
+            return []
+
+        response = None
+        if self.proc is not None:
+            try:
+                self.proc.stdin.write(json.dumps({'image': str(defaced_img),
+                                                  'views': [[str(o), r] for o, r in views]}) + '\n')
+                response = self._receive()
+            except (BrokenPipeError, ValueError):
+                response = {}
+            if not response:
+                self.logger.warning("The fsleyes render server exited, rendering with fsleyes render.")
+                self.close()
+            elif response['error']:
+                self.logger.warning(f"The fsleyes render server failed on {defaced_img}, rendering with fsleyes "
+                                    f"render.\n{response['error']}")
+
+        if not response or response['error']:
+            self.n_fallbacks += 1
+            render_with_cli(defaced_img, views, self.logger)
+
+        self.n_images += 1
+        self.n_views += len(views)
+        return [outfile for outfile, _ in views if outfile.exists()]
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self.proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_qc_render_jobs(qc_dir):
+    """Lists the (defaced image, render directory) pairs of a VisualQC deface directory."""
+    with open(qc_dir / 'defacing_id_list.txt', 'r') as f:
+        unit_dirs = [qc_dir / line.strip() for line in f if line.strip()]
+    return [(d / 'defaced.nii.gz', d) for d in unit_dirs]
+
+
+def render_queue(jobs, n_renderers, logger, log_path=None):
+    """Renders a queue of defaced images with n_renderers render servers working in parallel.
+
+    Images whose views all exist already are skipped. Render throughput is logged so that QC prep jobs can be sized.
+
+    :param list jobs: (defaced image, render directory) pairs.
+    :param int n_renderers: Number of render servers.
+    :param logger: Logger object imported from main.py module.
+    :param Path log_path: optional, File the render servers' output is appended to.
+    :return dict: Number of images and views rendered, images that fell back to fsleyes render, and seconds taken.
+    """
+    pending = queue.Queue()
+    for job in jobs:
+        if get_missing_views(job[1]):
+            pending.put(job)
+    n_renderers = max(1, min(n_renderers, pending.qsize()))
+    renderers = []
+    log_fileobj = open(log_path, 'a') if log_path else None
+
+    def work():
+        with BatchRenderer(logger, log_fileobj) as renderer:
+            renderers.append(renderer)
+            while True:
+                try:
+                    defaced_img, render_outdir = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    renderer.render(defaced_img, render_outdir)
+                except Exception:
+                    logger.error(f"Error in rendering {defaced_img}:\n{traceback.format_exc()}")
+
+    start = time.perf_counter()
+    try:
+        if not pending.empty():
+            threads = [threading.Thread(target=work) for _ in range(n_renderers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        if log_fileobj:
+            log_fileobj.close()
+    seconds = time.perf_counter() - start
+
+    stats = {'images': sum(r.n_images for r in renderers), 'views': sum(r.n_views for r in renderers),
+             'fallbacks': sum(r.n_fallbacks for r in renderers), 'seconds': seconds}
+    if stats['images']:
+        logger.info(f"Rendered {stats['views']} view(s) of {stats['images']} image(s) in {seconds:.1f} s with "
+                    f"{len(renderers)} renderer(s): {stats['images'] * 60 / seconds:.1f} images/min, "
+                    f"{stats['fallbacks']} image(s) rendered with fsleyes render.")
+    else:
+        logger.info("All QC renders already exist.")
+    return stats
+
+
+def serve():
+    """Runs an offscreen fsleyes renderer that reads render requests from stdin, one JSON object per line.
+
+    Requests are {"image": path, "views": [[outfile, [yaw, pitch, roll]], ...]} and each is answered on stdout with
+    {"image": path, "error": null or traceback}. The server exits when stdin is closed.
+    """
+    # fsleyes and its dependencies may print to stdout, so keep the original stdout for responses only
+    responses = open(os.dup(sys.stdout.fileno()), 'w', buffering=1)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    def respond(response):
+        responses.write(json.dumps(response) + '\n')
+
+    import fsl.utils.idle as idle
+    import fsleyes
+    import fsleyes.gl as fslgl
+    import fsleyes.render as fsrender
+    import matplotlib.image as mplimg
+
+    fsleyes.initialise()
+    fslgl.getGLContext(offscreen=True, createApp=True)
+    fslgl.bootstrap()
+    respond({'ready': True})
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            views = request['views']
+            namespace = fsrender.parseArgs(get_render_args(request['image'], *views[0]))
+            overlay_list, display_ctx, scene_opts = fsrender.makeDisplayContext(namespace)
+            try:
+                # the volume stays loaded while the camera is rotated for each view
+                for outfile, rotation in views:
+                    namespace.outfile = outfile
+                    scene_opts.cameraRotation = rotation
+                    with idle.idleLoop.synchronous():
+                        bitmap = fsrender.render(namespace, overlay_list, display_ctx, scene_opts)
+                    mplimg.imsave(outfile, bitmap)
+            finally:
+                overlay_list.clear()
+                display_ctx.destroy()
+            respond({'image': request['image'], 'error': None})
+        except Exception:
+            respond({'image': request['image'], 'error': traceback.format_exc()})
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Render 3D views of defaced images for VisualQC deface.')
+    parser.add_argument('defaced_img', type=Path, nargs='?', help='Defaced image to render.')
+    parser.add_argument('render_outdir', type=Path, nargs='?', help='Directory to write the renders to.')
+    parser.add_argument('--qc-dir', type=Path, default=None,
+                        help='Render every image listed in the defacing_id_list.txt of this defacing_QC directory.')
+    parser.add_argument('-n', '--n-renderers', type=int, default=1,
+                        help='Number of render servers to run in parallel.')
+    parser.add_argument('--serve', action='store_true', default=False, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if not args.serve and not args.qc_dir and not (args.defaced_img and args.render_outdir):
+        parser.error('either defaced_img and render_outdir, or --qc-dir is required')
+    return args
+
+
+def main():
+    args = get_args()
+    if args.serve:
+        serve()
+        return
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    logger = logging.getLogger('render')
+    jobs = get_qc_render_jobs(args.qc_dir) if args.qc_dir else [(args.defaced_img, args.render_outdir)]
+    render_queue(jobs, args.n_renderers, logger)
 
-defaced_img = Path(sys.argv[1])
-render_outdir = Path(sys.argv[2])
 
-generate_3d_renders(defaced_img, render_outdir)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""Resource accounting of external tool calls.
+
+The command engine in commands.py reaps every command with wait4, which returns the CPU time and peak resident set size
+of the shell and every process it waited for. Before reaping, on Linux, it reads the bytes read from and written to
+storage from /proc/<pid>/io. Each call is appended as one JSON line to a per-run file in the logs directory. The file is summarized
+by tool and by scan type at the end of a run, so the memory request and --n-cpus of a job can be chosen from the peak
+RSS of the tools it runs.
+
+The worker process's own share of each subject/session, e.g. reading images and masking them in-process, is recorded
+the same way as a call of the tool 'worker', with its peak RSS read from VmHWM after resetting it at the unit's start.
+
+Accounting is off until configure is called. The file's path is also exported in the environment so that worker
+processes started with the "spawn" method pick it up.
+"""
+
+import json
+import os
+import resource
+import shlex
+import time
+
+RESOURCE_LOG_ENV = 'DEFACING_RESOURCE_LOG'
+RESOURCE_LOG_FILENAME = 'resource_usage.jsonl'
+REPORT_FILENAME = 'resource_report.tsv'
+WORKER_TOOL = 'worker'
+
+
+def configure(log_path):
+    """Turns accounting on, starting a new record file at log_path."""
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    log_path.unlink(missing_ok=True)
+    os.environ[RESOURCE_LOG_ENV] = str(log_path)
+
+
+def get_tool_name(cmd_str):
+    """Name of the tool a shell command runs, skipping any leading 'module load' commands."""
+    lexer = shlex.shlex(cmd_str, posix=True, punctuation_chars=';&|')
+    lexer.wordchars += '@+'  # AFNI scripts start with '@'
+    try:
+        tokens = list(lexer)
+    except ValueError:
+        return 'shell'
+    commands = [[]]
+    for token in tokens:
+        if set(token) <= set(';&|'):
+            commands.append([])
+        else:
+            commands[-1].append(token)
+    for words in reversed(commands):
+        if words and words[0] != 'module':
+            return os.path.basename(words[0])
+    return 'shell'
+
+
+def get_scan_type(scan):
+    """BIDS suffix of a scan, e.g. 'T1w' for 'sub-01_ses-01_acq-mprage_T1w.nii.gz'."""
+    if not scan:
+        return ''
+    return os.path.basename(str(scan)).split('.')[0].split('_')[-1]
+
+
+def read_proc_io(pid):
+    """Bytes read from and written to storage by a process and the children it waited for, or None off Linux.
+
+    Must be called before the process is reaped.
+    """
+    try:
+        with open(f'/proc/{pid}/io', 'r') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+    except (OSError, ValueError):
+        return None
+    return int(fields['read_bytes']), int(fields['write_bytes'])
+
+
+def record(cmd_str, tool, scan, wall, rusage, io_bytes, returncode):
+    """Appends the resource usage of one command to the run's record file. Does nothing unless configured.
+
+    :param str cmd_str: The shell command.
+    :param str tool: Tool name; taken from the command if None.
+    :param scan: optional, Path or filename of the scan the command worked on.
+    :param float wall: Wall time in seconds.
+    :param rusage: resource.struct_rusage from os.wait4.
+    :param tuple io_bytes: (bytes read, bytes written) from read_proc_io, or None.
+    :param int returncode: The command's return code.
+    """
+    if os.environ.get(RESOURCE_LOG_ENV) is None:
+        return
+    append({'tool': tool or get_tool_name(cmd_str), 'scan': os.path.basename(str(scan)) if scan else '',
+            'scan_type': get_scan_type(scan), 'pid': os.getpid(), 'wall': round(wall, 3),
+            'user': round(rusage.ru_utime, 3), 'sys': round(rusage.ru_stime, 3),
+            # ru_maxrss is in KiB on Linux
+            'max_rss_mb': round(rusage.ru_maxrss / 1024, 1),
+            'read_mb': round(io_bytes[0] / 1e6, 1) if io_bytes else None,
+            'write_mb': round(io_bytes[1] / 1e6, 1) if io_bytes else None,
+            'returncode': returncode, 'cmd': cmd_str})
+
+
+def reset_peak_rss():
+    """Resets this process's peak RSS, VmHWM, on Linux. Elsewhere the peak stays the one over the process's life."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def read_peak_rss_mb():
+    """Peak RSS of this process in MB since the last reset_peak_rss, without its children."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def start_self_usage():
+    """Starts measuring this process's own usage; returns what record_self_usage needs to take the difference."""
+    reset_peak_rss()
+    return time.perf_counter(), resource.getrusage(resource.RUSAGE_SELF)
+
+
+def record_self_usage(started, scan):
+    """Appends this process's own usage since start_self_usage as a call of WORKER_TOOL. Does nothing unless
+    configured.
+
+    :param tuple started: The return value of start_self_usage.
+    :param scan: Path or filename of a scan of the subject/session the process worked on.
+    """
+    if os.environ.get(RESOURCE_LOG_ENV) is None:
+        return
+    start_wall, start_rusage = started
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    append({'tool': WORKER_TOOL, 'scan': os.path.basename(str(scan)) if scan else '',
+            'scan_type': get_scan_type(scan), 'pid': os.getpid(), 'wall': round(time.perf_counter() - start_wall, 3),
+            'user': round(rusage.ru_utime - start_rusage.ru_utime, 3),
+            'sys': round(rusage.ru_stime - start_rusage.ru_stime, 3),
+            'max_rss_mb': round(read_peak_rss_mb(), 1), 'read_mb': None, 'write_mb': None, 'returncode': None,
+            'cmd': ''})
+
+
+def append(entry):
+    """Appends one record to the run's record file in a single write, so records of parallel processes don't mix."""
+    fd = os.open(os.environ[RESOURCE_LOG_ENV], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(entry) + '\n').encode('utf8'))
+    finally:
+        os.close(fd)
+
+
+def load_records(log_path):
+    records = []
+    if not log_path.exists():
+        return records
+    with open(log_path, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def aggregate(records, key):
+    """Sums and maxima of resource usage grouped by a record field, most wall time first."""
+    groups = {}
+    for r in records:
+        group = groups.setdefault(r[key] or '-', {key: r[key] or '-', 'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+                                                  'max_wall': 0.0, 'max_rss_mb': 0.0, 'read_mb': 0.0,
+                                                  'write_mb': 0.0})
+        group['calls'] += 1
+        group['wall'] += r['wall']
+        group['cpu'] += r['user'] + r['sys']
+        group['max_wall'] = max(group['max_wall'], r['wall'])
+        group['max_rss_mb'] = max(group['max_rss_mb'], r['max_rss_mb'])
+        group['read_mb'] += r['read_mb'] or 0
+        group['write_mb'] += r['write_mb'] or 0
+    return sorted(groups.values(), key=lambda g: g['wall'], reverse=True)
+
+
+def report(log_path, logger):
+    """Writes the per-tool and per-scan-type tables next to the record file and logs them."""
+    records = load_records(log_path)
+    if not records:
+        return
+
+    columns = ['calls', 'wall', 'cpu', 'max_wall', 'max_rss_mb', 'read_mb', 'write_mb']
+    lines, tables = [], []
+    for key in ['tool', 'scan_type']:
+        rows = aggregate(records, key)
+        lines.append('\t'.join([key] + columns))
+        lines += ['\t'.join([str(r[key])] + [f'{r[c]:.1f}' if c != 'calls' else str(r[c]) for c in columns])
+                  for r in rows]
+        lines.append('')
+
+        table = [f"{key:<20}{'calls':>7}{'wall s':>10}{'cpu s':>10}{'max wall s':>12}{'peak RSS MB':>13}"
+                 f"{'read MB':>10}{'written MB':>12}"]
+        table += [f"{r[key]:<20}{r['calls']:>7}{r['wall']:>10.1f}{r['cpu']:>10.1f}{r['max_wall']:>12.1f}"
+                  f"{r['max_rss_mb']:>13.1f}{r['read_mb']:>10.1f}{r['write_mb']:>12.1f}" for r in rows]
+        tables.append('\n'.join(table))
+
+    with open(log_path.parent / REPORT_FILENAME, 'w') as f:
+        f.write('\n'.join(lines))
+
+    largest = max(records, key=lambda r: r['max_rss_mb'])
+    logger.info(f"Resource usage of {len(records)} external command(s) and subject/session worker(s) at "
+                f"{log_path}\n" + '\n\n'.join(tables)
+                + f"\nLargest peak RSS: {largest['max_rss_mb']:.1f} MB, {largest['tool']} on "
+                  f"{largest['scan'] or 'no scan'}\n")
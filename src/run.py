@@ -146,8 +146,8 @@ def main():
                 subject,
                 session,
                 mapping_dict,
-                bids_defaced_outdir,
-                mode,
+                output,
+                [mode],
                 no_clean
 
             )
@@ -184,10 +184,13 @@ def main():
                                                  subject_list,
                                                  session_list,
                                                  [mapping_dict] * len(subject_list),
-                                                 [bids_defaced_outdir] * len(subject_list),
-                                                 [mode] * len(subject_list),
+                                                 [output] * len(subject_list),
+                                                 [[mode]] * len(subject_list),
                                                  [no_clean] * len(subject_list)
                                              ))
+            # let workers finish their background deletions before the pool is terminated on exit
+            p.close()
+            p.join()
 
         # collect failures
         for missing_refacer_out in missing_refacer_outs:
@@ -0,0 +1,324 @@
+"""Longest-job-first scheduling of subject/session units over a pool of worker processes.
+
+Each unit's cost is estimated from the NIfTI headers of its scans, so no image data is read. Units are dispatched
+most expensive first, one at a time as workers become free, which keeps large multi-echo or high resolution sessions
+from piling up on one worker at the end of a run.
+
+With a memory limit, a unit is only admitted while the projected peak memory of all running units fits in the limit.
+A unit's peak memory is estimated from the size of its largest scan with a linear model that is calibrated against
+the peak RSS that resources.py measures for every tool call and for the worker process itself, across runs.
+"""
+
+import json
+import multiprocessing
+import os
+import queue
+import re
+import traceback
+from multiprocessing.pool import Pool
+
+import nibabel as nib
+import numpy as np
+from nibabel.filebasedimages import ImageFileError
+
+import deface
+import resources
+import tracing
+import utils
+
+
+def get_voxel_count(nifti_path):
+    """Returns the number of voxels in a NIfTI image, reading only its header."""
+    return int(np.prod(nib.load(nifti_path).header.get_data_shape()))
+
+
+def estimate_cost(mapping_dict, subj_id, sess_id, logger):
+    """Estimates the relative cost of defacing a subject or session.
+
+    The refacer runs once on the primary scan and every "other" scan is registered to the primary scan, so the cost
+    is the number of voxels in all scans plus the primary scan's voxels once per "other" scan.
+
+    :param dict mapping_dict: A dictionary with primary to others mapping information.
+    :param str subj_id: Subject directory name.
+    :param str sess_id: Session directory name, empty if the subject has no sessions.
+    :param logger: Logger object imported from main.py module.
+    :return int: Estimated cost in voxels.
+    """
+    try:
+        scans = utils.get_session_inputs(mapping_dict, subj_id, sess_id)
+        voxels = [get_voxel_count(s) for s in scans]
+    except (KeyError, OSError, ImageFileError) as err:
+        logger.warning(f"Could not estimate cost of {utils.get_unit_id(subj_id, sess_id)}: {err}")
+        return 0
+
+    if not voxels:
+        return 0
+    return sum(voxels) + voxels[0] * (len(voxels) - 1)
+
+
+MEMORY_CALIBRATION_FILENAME = 'memory_calibration.json'
+# AFNI and FSL hold images as float32, plus the worker's own Python, nibabel and defacemask memory
+DEFAULT_MEMORY_MODEL = {'intercept_mb': 500.0, 'slope': 12.0, 'margin_mb': 0.0}
+MEMORY_SAFETY_FACTOR = 1.1
+MAX_CALIBRATION_SAMPLES = 500
+# commands of the registration chains, up to reg_threads of which run at the same time within a unit
+REGISTRATION_TOOLS = ['cp', 'flirt', 'flirt_applyxfm', 'fslmaths']
+
+
+def parse_memory(value):
+    """Parses a memory size such as '64G', '512M' or '2T' into MB. Plain numbers are taken as GB."""
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?)B?\s*', value.upper())
+    if not match:
+        raise ValueError(f"Invalid memory size: {value}")
+    number, unit = float(match.group(1)), match.group(2) or 'G'
+    return number * {'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 ** 2}[unit]
+
+
+def get_input_mb(mapping_dict, subj_id, sess_id, logger):
+    """Size in MB of the largest scan of a subject or session as float32, read from the NIfTI headers only."""
+    try:
+        voxels = [get_voxel_count(s) for s in utils.get_session_inputs(mapping_dict, subj_id, sess_id)]
+    except (KeyError, OSError, ImageFileError) as err:
+        logger.warning(f"Could not estimate memory of {utils.get_unit_id(subj_id, sess_id)}: {err}")
+        return 0.0
+    return max(voxels, default=0) * 4 / 2 ** 20
+
+
+def fit_memory_model(samples):
+    """Fits peak MB = intercept + slope * input MB to (input MB, peak MB) samples of finished units.
+
+    With too few distinct input sizes for a fit, the default model is scaled to the worst observed unit. The margin
+    lifts the line above every sample, so no calibrated unit is underestimated.
+    """
+    if not samples:
+        return dict(DEFAULT_MEMORY_MODEL)
+
+    xs, ys = [x for x, _ in samples], [y for _, y in samples]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if len(samples) >= 3 and var_x > 0:
+        slope = max(0.0, sum((x - mean_x) * (y - mean_y) for x, y in samples) / var_x)
+        model = {'intercept_mb': mean_y - slope * mean_x, 'slope': slope}
+    else:
+        default = DEFAULT_MEMORY_MODEL
+        scale = max(y / (default['intercept_mb'] + default['slope'] * x) for x, y in samples)
+        model = {'intercept_mb': default['intercept_mb'] * scale, 'slope': default['slope'] * scale}
+    model['margin_mb'] = max(0.0, max(y - model['intercept_mb'] - model['slope'] * x for x, y in samples))
+    return model
+
+
+class MemoryCalibration:
+    """Estimates the peak memory of units and refines the estimates as units finish.
+
+    :param Path calibration_path: JSON file the (input MB, peak MB) samples are kept in across runs.
+    :param Path resource_log: The run's resources.py record file.
+    :param dict input_mb: Unit id to the size of its largest scan; see get_input_mb.
+    :param int reg_threads: Number of registration chains a unit runs at the same time.
+    """
+
+    def __init__(self, calibration_path, resource_log, input_mb, reg_threads=1):
+        self.calibration_path = calibration_path
+        self.resource_log = resource_log
+        self.input_mb = input_mb
+        self.reg_threads = reg_threads
+        self.samples = []
+        if calibration_path.exists():
+            with open(calibration_path, 'r') as f:
+                self.samples = json.load(f)['samples']
+        self.model = fit_memory_model(self.samples)
+        self.offset = 0
+        self.records = {}  # unit id to the rss of its tool calls, by tool kind
+
+    def estimate(self, unit_id):
+        """Projected peak memory of a unit in MB."""
+        model = self.model
+        peak = model['intercept_mb'] + model['slope'] * self.input_mb.get(unit_id, 0.0) + model['margin_mb']
+        return peak * MEMORY_SAFETY_FACTOR
+
+    def read_new_records(self):
+        if not self.resource_log.exists():
+            return
+        with open(self.resource_log, 'r') as f:
+            f.seek(self.offset)
+            lines = f.readlines()
+        for line in lines:
+            if not line.endswith('\n'):
+                break  # written by a worker right now; read it next time
+            self.offset += len(line.encode('utf8'))
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if not record['scan']:
+                continue
+            tags = tracing.scan_tags(record['scan'])
+            unit_id = utils.get_unit_id(tags['subject'], tags['session'])
+            if record['tool'] == resources.WORKER_TOOL:
+                kind = 'worker'
+            else:
+                kind = 'registration' if record['tool'] in REGISTRATION_TOOLS else 'other'
+            self.records.setdefault(unit_id, {'registration': [], 'other': [], 'worker': []})[kind].append(
+                record['max_rss_mb'])
+
+    def measured_peak(self, unit_id):
+        """Peak memory of a finished unit: its largest tool call, or its largest registration calls running at once,
+        on top of the peak of the worker process itself, which stays resident while its tools run."""
+        records = self.records.get(unit_id)
+        if not records:
+            return None
+        concurrent = sum(sorted(records['registration'], reverse=True)[:self.reg_threads])
+        return max(max(records['other'], default=0.0), concurrent) + max(records['worker'], default=0.0)
+
+    def unit_finished(self, unit_id):
+        """Adds a finished unit's measured peak memory to the samples and refits the model."""
+        self.read_new_records()
+        peak = self.measured_peak(unit_id)
+        if peak is None or unit_id not in self.input_mb:
+            return
+        self.samples = (self.samples + [[self.input_mb[unit_id], peak]])[-MAX_CALIBRATION_SAMPLES:]
+        self.model = fit_memory_model(self.samples)
+        with open(self.calibration_path, 'w') as f:
+            json.dump({'model': self.model, 'samples': self.samples}, f, indent=4)
+
+
+# keyword arguments shared by every unit, set once per worker process instead of being pickled with every unit
+_shared_kwargs = {}
+# queue a pool worker announces each unit it starts on, with its pid, so that the units of dead workers can be found
+_started_queue = None
+# seconds between checks for pool workers that died while running a unit
+WORKER_CHECK_INTERVAL = 5
+
+
+def init_worker(shared_kwargs, started_queue=None):
+    """Sets the keyword arguments passed to deface.deface_primary_scan for every unit run by this process."""
+    global _started_queue
+    _shared_kwargs.clear()
+    _shared_kwargs.update(shared_kwargs)
+    _started_queue = started_queue
+
+
+def run_unit(unit_id, args):
+    """Runs deface.deface_primary_scan on a unit, capturing any exception so one failure doesn't stop the run.
+
+    :return tuple: (unit_id, missing refacer outputs or None, formatted traceback or None)
+    """
+    if _started_queue is not None:
+        _started_queue.put((unit_id, os.getpid()))
+    subject, session = args[1], args[2]
+    scan = get_unit_scan(args[3], subject.name, session.name if session else '')
+    usage = resources.start_self_usage()
+    try:
+        with tracing.span('unit', subject=subject.name, session=session.name if session else ''):
+            return unit_id, deface.deface_primary_scan(*args, **_shared_kwargs), None
+    except Exception:
+        return unit_id, None, traceback.format_exc()
+    finally:
+        # the worker's own memory, which the tool calls' records don't include, for MemoryCalibration
+        resources.record_self_usage(usage, scan)
+
+
+def get_unit_scan(mapping_dict, subj_id, sess_id):
+    """The first input scan of a subject or session, which its resource records are tagged with; empty if it has
+    none or isn't in the mapping, e.g. a session without an anat directory."""
+    try:
+        scans = utils.get_session_inputs(mapping_dict, subj_id, sess_id)
+    except KeyError:
+        return ''
+    return scans[0] if scans else ''
+
+
+def find_lost_units(running, started_queue):
+    """Finds running units whose pool worker died, e.g. killed by the OOM killer, which the pool never reports.
+
+    :param dict running: Unit id to the pid of the worker running it, or None until the worker announces it; updated
+        from started_queue.
+    :return list: (unit id, error message) of the lost units.
+    """
+    while not started_queue.empty():
+        unit_id, pid = started_queue.get()
+        if unit_id in running:
+            running[unit_id] = pid
+
+    alive = {p.pid for p in multiprocessing.active_children()}
+    return [(unit_id, f"The worker process (pid {pid}) defacing {unit_id} died without reporting a result, e.g. it "
+                      f"was killed by the OOM killer; consider --mem-limit or fewer --n-cpus.")
+            for unit_id, pid in running.items() if pid is not None and pid not in alive]
+
+
+def run_longest_first(tasks, n_procs, on_result, shared_kwargs=None, mem_limit_mb=None, estimate_memory=None,
+                      logger=None):
+    """Runs units over a process pool, most expensive first, handing out one unit per free worker.
+
+    :param list tasks: (unit_id, cost, args) tuples where args are the arguments to deface.deface_primary_scan.
+    :param int n_procs: Number of worker processes.
+    :param on_result: Called in the parent process with (unit_id, missing refacer outputs, traceback) as soon as each
+        unit completes.
+    :param dict shared_kwargs: optional, Keyword arguments to deface.deface_primary_scan shared by all units. They
+        are sent to each worker process once.
+    :param float mem_limit_mb: optional, Memory the running units may use together. The most expensive unit that
+        fits is admitted when a worker is free; a unit that doesn't fit even on an idle node runs on its own.
+    :param estimate_memory: Called with a unit id to project its peak memory in MB; required with mem_limit_mb.
+        It's called at admission time, so it may refine its estimates as units finish.
+    :param logger: optional, Logger object imported from main.py module.
+    """
+    pending = sorted(tasks, key=lambda task: task[1], reverse=True)
+    completed = queue.Queue()
+    reserved = {}  # unit id to the memory reserved for it while it runs
+
+    def next_task():
+        if mem_limit_mb is None:
+            return pending.pop(0)
+        free_mb = mem_limit_mb - sum(reserved.values())
+        for idx, (unit_id, _, _) in enumerate(pending):
+            estimate = estimate_memory(unit_id)
+            if estimate <= free_mb or not reserved:
+                if estimate > mem_limit_mb and logger:
+                    logger.warning(f"{unit_id} is projected to need {estimate:.0f} MB, more than the memory limit "
+                                   f"of {mem_limit_mb:.0f} MB; running it on its own.")
+                reserved[unit_id] = estimate
+                return pending.pop(idx)
+        return None
+
+    def failed(unit_id):
+        def put_error(err):
+            completed.put((unit_id, None, ''.join(traceback.format_exception(err))))
+        return put_error
+
+    # written to synchronously, so a worker killed right after starting a unit has still announced it
+    started_queue = multiprocessing.SimpleQueue()
+    pool = Pool(processes=n_procs, initializer=init_worker, initargs=(shared_kwargs or {}, started_queue))
+    lost = False
+    try:
+        running = {}  # unit id to the pid of the worker running it, once the worker has announced it
+        while pending or running:
+            while pending and len(running) < n_procs:
+                task = next_task()
+                if task is None:
+                    break
+                unit_id, _, args = task
+                # args or a result that can't be pickled end up in the error callback
+                pool.apply_async(run_unit, (unit_id, args), callback=completed.put, error_callback=failed(unit_id))
+                running[unit_id] = None
+
+            try:
+                unit_id, result, error = completed.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                for unit_id, error in find_lost_units(running, started_queue):
+                    completed.put((unit_id, None, error))
+                    lost = True
+                continue
+            if unit_id not in running:
+                continue  # already reported as lost
+            reserved.pop(unit_id, None)
+            del running[unit_id]
+            on_result(unit_id, result, error)
+    except BaseException:
+        pool.terminate()
+        raise
+    if lost:
+        # the pool keeps waiting for the results of lost units, so join would never return
+        pool.terminate()
+        return
+    # workers are shut down rather than terminated, so they finish the deletions they queued; see cleanup.py
+    pool.close()
+    pool.join()
@@ -0,0 +1,72 @@
+"""Node-local scratch staging of each subject's/session's working directories.
+
+With a scratch directory configured, a unit's refacer run, registrations and reorganization into the BIDS tree all
+happen in its own directory on scratch, e.g. node-local disk or tmpfs, instead of on shared storage. Once the unit is
+done, only its final outputs, plus the intermediates kept with --no-clean, are copied into a STAGING_DIRNAME directory
+next to the mode's bids_defaced tree and renamed into place, so bids_defaced never holds a half-copied unit. Earlier
+outputs of the unit are first renamed into the mode's trash directory and deleted in the background; see cleanup.py.
+Copies left in STAGING_DIRNAME by a crash are deleted at the start of the next run.
+
+The scratch directory is exported in the environment so that worker processes and cluster array tasks pick it up.
+Environment variables in it are expanded by each process, so '/lscratch/$SLURM_JOB_ID' names the local scratch of
+whichever job a unit runs in.
+"""
+
+import os
+import shutil
+from pathlib import Path
+
+import cleanup
+import materialize
+
+SCRATCH_DIR_ENV = 'DEFACING_SCRATCH_DIR'
+STAGING_DIRNAME = '.staging'
+
+
+def configure(scratch_dir):
+    """Turns staging on; scratch_dir may contain environment variables, expanded where units run."""
+    os.environ[SCRATCH_DIR_ENV] = scratch_dir
+
+
+def get_scratch_dir():
+    scratch_dir = os.environ.get(SCRATCH_DIR_ENV)
+    return Path(os.path.expandvars(scratch_dir)) if scratch_dir else None
+
+
+def make_unit_dir(scratch_dir, unit_id):
+    """Creates an empty staging directory for a unit, removing one left behind by an earlier attempt."""
+    unit_dir = scratch_dir / f"defacing_{unit_id.replace('/', '_')}_{os.getpid()}"
+    shutil.rmtree(unit_dir, ignore_errors=True)
+    unit_dir.mkdir(parents=True)
+    return unit_dir
+
+
+def publish(staged_dir, final_dir, mode_dir):
+    """Copies a staged directory into the mode's staging directory, then renames it into place, replacing any earlier
+    final_dir.
+
+    :param Path staged_dir: The unit's directory on scratch.
+    :param Path final_dir: Where the directory belongs in the output tree.
+    :param Path mode_dir: The directory holding the mode's bids_defaced tree, on the same filesystem as final_dir.
+    """
+    final_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp = mode_dir / STAGING_DIRNAME / f"{'_'.join(final_dir.relative_to(mode_dir).parts)}.{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.parent.mkdir(exist_ok=True)
+    materialize.copytree(staged_dir, tmp)
+
+    trash_dir = mode_dir / cleanup.TRASH_DIRNAME
+    trash_dir.mkdir(exist_ok=True)
+    replaced = trash_dir / tmp.name
+    try:
+        os.rename(final_dir, replaced)
+    except FileNotFoundError:
+        replaced = None
+    os.replace(tmp, final_dir)
+    if replaced is not None:
+        cleanup.discard([replaced], trash_dir)
+
+
+def remove_leftovers(mode_dir, logger=None):
+    """Queues the deletion of copies that an interrupted run left in the mode's staging directory."""
+    cleanup.empty_trash(mode_dir / STAGING_DIRNAME, logger)
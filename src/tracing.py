@@ -0,0 +1,153 @@
+"""Per-stage timing spans exported in the Chrome trace-event format.
+
+Each span is written as one "complete" trace event, tagged with subject, session and scan where known, to a
+per-process JSON lines file in the trace directory. A single O_APPEND write per event keeps events from threads of
+the same process intact. Once the run is over the files of all pool workers are merged into one trace that
+chrome://tracing and https://ui.perfetto.dev can open, along with a table of per-stage duration percentiles.
+
+Tracing is off until configure is called. The trace directory is also exported in the environment so that worker
+processes started with the "spawn" method pick it up.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+TRACE_DIR_ENV = 'DEFACING_TRACE_DIR'
+TRACE_FILENAME = 'trace.json'
+SUMMARY_FILENAME = 'trace_summary.tsv'
+PERCENTILES = [50, 90, 99]
+
+
+def configure(trace_dir):
+    """Turns tracing on, writing events to trace_dir, and removes events left over from a previous run."""
+    trace_dir.mkdir(parents=True, exist_ok=True)
+    for stale in trace_dir.glob('trace-*.jsonl'):
+        stale.unlink()
+    os.environ[TRACE_DIR_ENV] = str(trace_dir)
+
+
+def get_trace_dir():
+    return os.environ.get(TRACE_DIR_ENV)
+
+
+def scan_tags(scan):
+    """Subject, session and scan tags taken from the BIDS entities of a scan's filename."""
+    name = os.path.basename(str(scan))
+    entities = name.split('.')[0].split('_')
+    return {'subject': next((e for e in entities if e.startswith('sub-')), ''),
+            'session': next((e for e in entities if e.startswith('ses-')), ''), 'scan': name}
+
+
+def write_event(event):
+    trace_dir = get_trace_dir()
+    if trace_dir is None:
+        return
+    fd = os.open(os.path.join(trace_dir, f'trace-{os.getpid()}.jsonl'), os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                 0o644)
+    try:
+        os.write(fd, (json.dumps(event) + '\n').encode('utf8'))
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def span(name, category='stage', **tags):
+    """Times the enclosed block as one trace event. Does nothing unless tracing was configured.
+
+    :param str name: Name of the stage, e.g. 'flirt'.
+    :param str category: Trace event category, e.g. 'command' for external tools.
+    :param tags: Tags such as subject, session and scan; empty values are left out.
+    """
+    if get_trace_dir() is None:
+        yield
+        return
+
+    start = time.time()
+    status = 'finished'
+    try:
+        yield
+    except BaseException:
+        status = 'failed'
+        raise
+    finally:
+        end = time.time()
+        args = {k: str(v) for k, v in tags.items() if v}
+        args['status'] = status
+        write_event({'name': name, 'cat': category, 'ph': 'X', 'ts': int(start * 1e6),
+                     'dur': int((end - start) * 1e6), 'pid': os.getpid(), 'tid': threading.get_native_id(),
+                     'args': args})
+
+
+def merge(trace_dir, trace_path):
+    """Merges the per-process event files into one Chrome trace file.
+
+    :param Path trace_dir: Directory with the per-process event files.
+    :param Path trace_path: Absolute path to the merged trace.
+    :return list: The merged span events, oldest first.
+    """
+    events = []
+    for events_file in sorted(trace_dir.glob('trace-*.jsonl')):
+        with open(events_file, 'r') as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue  # cut short by a killed worker
+    events.sort(key=lambda e: e['ts'])
+
+    main_pid = os.getpid()
+    metadata = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+                 'args': {'name': 'main' if pid == main_pid else f'worker {pid}'}}
+                for pid in sorted({e['pid'] for e in events})]
+    with open(trace_path, 'w') as f:
+        json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, f)
+    return events
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an ascending list."""
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(events):
+    """Computes count, total and percentile durations in seconds for each stage, most total time first.
+
+    :return list: One dict per stage with 'stage', 'count', 'failed', 'total', 'max' and a 'p<N>' key per percentile.
+    """
+    durations, failures = {}, {}
+    for event in events:
+        durations.setdefault(event['name'], []).append(event['dur'] / 1e6)
+        if event['args'].get('status') == 'failed':
+            failures[event['name']] = failures.get(event['name'], 0) + 1
+
+    rows = []
+    for name, values in durations.items():
+        values.sort()
+        row = {'stage': name, 'count': len(values), 'failed': failures.get(name, 0), 'total': sum(values),
+               'max': values[-1]}
+        row.update({f'p{pct}': percentile(values, pct) for pct in PERCENTILES})
+        rows.append(row)
+    return sorted(rows, key=lambda r: r['total'], reverse=True)
+
+
+def report(trace_dir, logs_dir, logger):
+    """Merges the trace, writes the per-stage summary table next to it and logs the table."""
+    events = merge(trace_dir, logs_dir / TRACE_FILENAME)
+    rows = summarize(events)
+
+    columns = ['stage', 'count', 'failed', 'total'] + [f'p{pct}' for pct in PERCENTILES] + ['max']
+    lines = ['\t'.join(columns)]
+    lines += ['\t'.join(str(r[c]) if c in ('stage', 'count', 'failed') else f'{r[c]:.3f}' for c in columns)
+              for r in rows]
+    with open(logs_dir / SUMMARY_FILENAME, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    table = [f"{'stage':<28}{'count':>7}{'failed':>7}{'total s':>10}"
+             + ''.join(f"{f'p{pct} s':>9}" for pct in PERCENTILES) + f"{'max s':>9}"]
+    table += [f"{r['stage']:<28}{r['count']:>7}{r['failed']:>7}{r['total']:>10.1f}"
+              + ''.join(f"{r[f'p{pct}']:>9.2f}" for pct in PERCENTILES) + f"{r['max']:>9.2f}" for r in rows]
+    logger.info(f"Trace of {len(events)} span(s) at {logs_dir / TRACE_FILENAME}\n" + '\n'.join(table) + '\n')
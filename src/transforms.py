@@ -0,0 +1,77 @@
+"""Persistent store of the transforms that register "other" scans to their primary scan.
+
+The ``flirt -dof 6`` transform of an "other" scan depends only on the primary and the other scan, not on the defacing
+mode, so it is stored under a key derived from the SHA-256 hashes of both scans, the registration options and the FSL
+version. A later run of the same dataset, in either mode, copies the stored matrix into its work directory and goes
+straight to applying the defacemask.
+
+The store is off until configure is called, and whenever the FSL version can't be found. Its directory is also
+exported in the environment so that worker processes and cluster array tasks pick it up.
+"""
+
+import hashlib
+import os
+import shutil
+from pathlib import Path
+
+import cache
+
+TRANSFORM_STORE_ENV = 'DEFACING_TRANSFORM_STORE'
+TRANSFORM_STORE_DIRNAME = 'transforms'
+
+
+def configure(store_dir):
+    """Turns the store on, keeping transforms in store_dir."""
+    store_dir.mkdir(parents=True, exist_ok=True)
+    os.environ[TRANSFORM_STORE_ENV] = str(store_dir)
+
+
+def get_store_dir():
+    store_dir = os.environ.get(TRANSFORM_STORE_ENV)
+    return Path(store_dir) if store_dir else None
+
+
+def get_fsl_version():
+    """Version of the FSL the pipeline runs flirt from; empty if it can't be found. See cache.get_tool_versions."""
+    return cache.get_tool_versions()['fsl']
+
+
+def is_enabled():
+    """True once the store is configured, as long as the FSL version is known: transforms of different FLIRT builds
+    must not be mixed."""
+    return get_store_dir() is not None and bool(get_fsl_version())
+
+
+def get_key(primary_scan, other_scan, options):
+    """Key of the transform that registers primary_scan to other_scan with the given flirt options."""
+    key_material = '\n'.join([cache.hash_scan(primary_scan), cache.hash_scan(other_scan), options, get_fsl_version()])
+    return hashlib.sha256(key_material.encode('utf8')).hexdigest()
+
+
+def get_transform_path(key):
+    return get_store_dir() / key[:2] / f'{key}.mat'
+
+
+def fetch(key, matrix_path):
+    """Copies a stored transform to matrix_path.
+
+    :return bool: True if the transform was in the store.
+    """
+    if not is_enabled():
+        return False
+    try:
+        shutil.copyfile(get_transform_path(key), matrix_path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def store(key, matrix_path):
+    """Adds a transform to the store, atomically, so that concurrent runs never read half a matrix."""
+    if not is_enabled():
+        return
+    transform_path = get_transform_path(key)
+    transform_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = transform_path.with_name(f'.{transform_path.name}.{os.getpid()}.tmp')
+    shutil.copyfile(matrix_path, tmp)
+    os.replace(tmp, transform_path)
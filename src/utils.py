@@ -1,11 +1,37 @@
-import subprocess
+import io
+import os
+import shutil
+import struct
 import json
-import gzip
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
+import commands
 
-def run_command(cmd_str):
-    result = subprocess.run(cmd_str, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding='utf8', shell=True)
-    return result.stdout, result.stderr
+GZIP_LEVEL = 6
+GZIP_BLOCK_SIZE = 1024 * 1024
+GZIP_THREADS_ENV = 'DEFACING_GZIP_THREADS'
+
+
+def run_command(cmd_str, log_fileobj=None, tool=None, scan=None, logger=None, timeout=None):
+    """Runs a shell command with the command engine in commands.py, streaming its stdout and stderr to log_fileobj
+    and/or logger as they arrive. Its wall time, CPU time, peak RSS and I/O are recorded; see resources.py.
+
+    :param str cmd_str: A shell command formatted as a string variable.
+    :param io.TextIOWrapper log_fileobj: optional, File object the command's stdout and stderr are written to.
+    :param str tool: optional, Tool name used for the timeout and resource accounting; taken from the command by default.
+    :param scan: optional, Path or filename of the scan the command works on.
+    :param logger: optional, Logger the command's stdout and stderr are logged to at debug level.
+    :param float timeout: optional, Seconds before the command is killed; looked up by tool name by default.
+    :return tuple: (stdout of the command or None if streamed to log_fileobj or logger, error message with the exit
+        code and the end of stderr or None if the command succeeded)
+    """
+    capture = log_fileobj is None and logger is None
+    result = commands.run_sync(cmd_str, log_fileobj=log_fileobj, logger=logger, tool=tool, scan=scan,
+                               timeout=timeout, capture=capture)
+    return result.stdout if capture else None, commands.describe_failure(cmd_str, result)
 
 
 def write_to_file(file_content, filepath):
@@ -17,14 +43,193 @@ def write_to_file(file_content, filepath):
             f.writelines(file_content)
 
 
-def compress_to_gz(input_file, output_file):
+def configure_gzip_threads(n_threads):
+    """Sets the number of threads each ParallelGzipWriter compresses with; exported in the environment so that worker
+    processes and array tasks pick it up."""
+    os.environ[GZIP_THREADS_ENV] = str(n_threads)
+
+
+def get_gzip_threads():
+    return max(1, int(os.environ.get(GZIP_THREADS_ENV, 1)))
+
+
+def _deflate_block(block, zdict, level, last):
+    """Compresses one block into raw deflate data that can be concatenated with the neighbouring blocks.
+
+    Priming the compressor with the tail of the previous block keeps the compression ratio close to that of a single
+    stream. Blocks other than the last end on a byte boundary with a sync flush.
+    """
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                      zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """Writable binary file object that compresses fixed-size blocks on a thread pool.
+
+    The output is a standard single-member gzip stream, readable by gzip, nibabel, AFNI and FSL. zlib releases the
+    GIL while compressing, so blocks are compressed concurrently and written out in order.
+
+    :param int n_threads: optional, Number of compressing threads; the budget set with configure_gzip_threads, or one,
+        by default. Several writers may run at once in a process, so this is a share of the process's CPUs.
+    """
+
+    def __init__(self, filepath, level=GZIP_LEVEL, n_threads=None, block_size=GZIP_BLOCK_SIZE):
+        super().__init__()
+        self.level = level
+        self.block_size = block_size
+        self.n_threads = n_threads or get_gzip_threads()
+        self.filepath = Path(filepath)
+        self._fileobj = open(filepath, 'wb')
+        self._executor = ThreadPoolExecutor(max_workers=self.n_threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._zdict = b''
+        self._crc = 0
+        self._size = 0
+
+        # mtime is left at zero so identical inputs produce identical outputs
+        xfl = 2 if level == 9 else 4 if level == 1 else 0
+        self._fileobj.write(struct.pack('<4sIBB', b'\x1f\x8b\x08\x00', 0, xfl, 255))
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def tell(self):
+        return self._size
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """Only forward seeks are supported; like gzip.GzipFile, the gap is filled with zeros."""
+        if whence == io.SEEK_CUR:
+            offset += self._size
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Can only seek relative to the start or current position.")
+        if offset < self._size:
+            raise io.UnsupportedOperation("Negative seek in write mode.")
+        self.write(b'\x00' * (offset - self._size))
+        return self._size
+
+    def _submit(self, block, last=False):
+        self._pending.append(self._executor.submit(_deflate_block, block, self._zdict, self.level, last))
+        self._zdict = block[-32768:]
+        # bound the number of blocks held in memory
+        while len(self._pending) > 2 * self.n_threads:
+            self._fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().result())
+            self._fileobj.write(struct.pack('<II', self._crc & 0xffffffff, self._size & 0xffffffff))
+        finally:
+            self._executor.shutdown()
+            self._fileobj.close()
+            super().close()
+
+    def abort(self):
+        """Closes the writer without finishing the gzip stream and deletes the file, so that a write that failed
+        halfway never leaves a file that looks complete."""
+        if self.closed:
+            return
+        try:
+            self._pending.clear()
+            self._executor.shutdown(cancel_futures=True)
+            self._fileobj.close()
+            self.filepath.unlink(missing_ok=True)
+        finally:
+            super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def compress_to_gz(input_file, output_file, level=GZIP_LEVEL, n_threads=None, chunk_size=GZIP_BLOCK_SIZE):
+    """Gzip compresses a file with ParallelGzipWriter, streaming it in fixed-size chunks.
+
+    The compressed file is written next to output_file and renamed into place once complete, so an interrupted run
+    never leaves a truncated output_file behind. Nothing is done if output_file already exists.
+    """
+    output_file = Path(output_file)
     if not output_file.exists():
+        tmp_file = output_file.with_name(output_file.name + '.part')
         with open(input_file, 'rb') as f_input:
-            with gzip.open(output_file, 'wb') as f_output:
-                f_output.writelines(f_input)
+            with ParallelGzipWriter(tmp_file, level, n_threads, chunk_size) as f_output:
+                shutil.copyfileobj(f_input, f_output, chunk_size)
+        os.replace(tmp_file, output_file)
+
+
+def save_nifti(img, output_file, level=GZIP_LEVEL, n_threads=None):
+    """Saves a nibabel NIfTI image, writing '.nii.gz' files through ParallelGzipWriter without an uncompressed copy.
+
+    Like compress_to_gz, the image is written next to output_file and renamed into place once complete.
+    """
+    output_file = Path(output_file)
+    tmp_file = output_file.with_name(output_file.name + '.part')
+    try:
+        if output_file.name.endswith('.gz'):
+            with ParallelGzipWriter(tmp_file, level, n_threads) as f_output:
+                img.to_stream(f_output)
+        else:
+            with open(tmp_file, 'wb') as f_output:
+                img.to_stream(f_output)
+        os.replace(tmp_file, output_file)
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
 
 
 def get_sess_dirs(subj_dir_path, mapping_dict):
     sess_dirs = [subj_dir_path / key if key.startswith('ses-') else "" for key in
                  mapping_dict[subj_dir_path.name].keys()]
     return sess_dirs
+
+
+def get_unit_id(subj_id, sess_id):
+    return f"{subj_id}/{sess_id}" if sess_id else subj_id
+
+
+def get_mode_output_dirs(output_dir, modes):
+    """Directories holding the 'bids_defaced' and 'defacing_QC' trees of each defacing mode.
+
+    A single mode writes them directly into the output directory; several modes each get an <output_dir>/<mode>
+    directory.
+
+    :return dict: Absolute path keyed by mode.
+    """
+    if len(modes) == 1:
+        return {modes[0]: output_dir}
+    return {mode: output_dir / mode for mode in modes}
+
+
+def get_mapping_entry(mapping_dict, subj_id, sess_id):
+    """The 'primary_t1' and 'others' entry of a subject or session in the mapping dictionary."""
+    return mapping_dict[subj_id][sess_id] if sess_id else mapping_dict[subj_id]
+
+
+def get_session_inputs(mapping_dict, subj_id, sess_id):
+    """Lists the input NIfTI files of a subject or session from the mapping dictionary, primary scan first."""
+    scans = get_mapping_entry(mapping_dict, subj_id, sess_id)
+    inputs = [scans['primary_t1']] if scans['primary_t1'] else []
+    inputs.extend([s for s in scans['others'] if s != scans['primary_t1']])
+    return [Path(s) for s in inputs]
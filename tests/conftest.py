@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules in src import each other as top-level modules, as when main.py is run from there
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
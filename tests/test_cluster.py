@@ -0,0 +1,24 @@
+import logging
+
+import pytest
+
+import cluster
+
+LOGGER = logging.getLogger('test_cluster')
+
+
+class FailingSubmitter:
+    def submit(self, manifest_path, n_tasks, log_dir):
+        raise AssertionError('nothing should be submitted')
+
+
+def test_run_array_without_units_submits_nothing(tmp_path):
+    report = cluster.run_array([], {}, tmp_path, FailingSubmitter(), 1, None, LOGGER)
+
+    assert report == {'finished': 0, 'failed': {}, 'lost': {}}
+    assert not (tmp_path / cluster.CLUSTER_DIRNAME).exists()
+
+
+def test_slurm_submit_rejects_empty_array(tmp_path):
+    with pytest.raises(ValueError):
+        cluster.SlurmSubmitter().submit(tmp_path / cluster.MANIFEST_FILENAME, 0, tmp_path)
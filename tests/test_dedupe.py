@@ -0,0 +1,40 @@
+import dedupe
+
+
+def test_find_duplicate_groups(tmp_path):
+    contents = {'a.nii.gz': b'x' * 100, 'b.nii.gz': b'x' * 100, 'c.nii.gz': b'x' * 99 + b'y', 'd.nii.gz': b'z'}
+    for name, content in contents.items():
+        (tmp_path / name).write_bytes(content)
+    scans = [str(tmp_path / name) for name in contents]
+
+    groups, sizes = dedupe.find_duplicate_groups(scans, n_threads=2)
+
+    # c has the size of a and b but not their contents
+    assert groups == [[str(tmp_path / 'a.nii.gz'), str(tmp_path / 'b.nii.gz')]]
+    assert sizes == {scan: len(content) for scan, content in zip(scans, contents.values())}
+
+
+def test_fold_into_mapping():
+    # ses-02 is a copy of ses-01, which holds one of its "other" scans twice; sub-02 shares nothing
+    mapping_dict = {
+        'sub-01': {'ses-01': {'primary_t1': '/in/A1', 'others': ['/in/B1', '/in/B1x']},
+                   'ses-02': {'primary_t1': '/in/A2', 'others': ['/in/B2', '/in/B2x']}},
+        'sub-02': {'primary_t1': '/in/C', 'others': ['/in/D']},
+    }
+    groups = [['/in/A1', '/in/A2'], ['/in/B1', '/in/B1x', '/in/B2', '/in/B2x']]
+    sizes = {'/in/A1': 10, '/in/A2': 10, '/in/B1': 3, '/in/B1x': 3, '/in/B2': 3, '/in/B2x': 3, '/in/C': 7, '/in/D': 5}
+
+    summary = dedupe.fold_into_mapping(mapping_dict, groups, sizes)
+
+    ses_01, ses_02 = mapping_dict['sub-01']['ses-01'], mapping_dict['sub-01']['ses-02']
+    assert ses_02['duplicate_of'] == {'unit': 'sub-01/ses-01',
+                                      'scans': {'/in/A2': '/in/A1', '/in/B2': '/in/B1', '/in/B2x': '/in/B1x'}}
+    assert dedupe.get_duplicate_of(mapping_dict, 'sub-01', 'ses-02') == ses_02['duplicate_of']
+    assert dedupe.get_duplicate_of(mapping_dict, 'sub-01', 'ses-01') is None
+    assert (ses_01['others'], ses_01['duplicates']) == (['/in/B1'], {'/in/B1x': '/in/B1'})
+    assert mapping_dict['sub-02'] == {'primary_t1': '/in/C', 'others': ['/in/D']}
+
+    assert summary['duplicate_units'] == {'sub-01/ses-02': 'sub-01/ses-01'}
+    # duplicate scans of a duplicate subject/session are counted with it
+    assert summary['duplicate_scans'] == {'/in/B1x': '/in/B1'}
+    assert summary['bytes_not_defaced'] == 10 + 3 + 3 + 3
@@ -0,0 +1,30 @@
+import json
+
+import journal
+
+
+def test_replay_ignores_and_terminates_truncated_last_line(tmp_path):
+    journal_path = tmp_path / journal.JOURNAL_FILENAME
+    journal.record(journal_path, 'sub-01', 'unit', 'started')
+    journal.record(journal_path, 'sub-01', 'refacer', 'started')
+    journal.record(journal_path, 'sub-01', 'refacer', 'finished')
+    journal.record(journal_path, 'sub-01', 'unit', 'finished')
+    journal.record(journal_path, 'sub-02', 'unit', 'started')
+    # a worker killed halfway through writing its record
+    with open(journal_path, 'a') as f:
+        f.write('{"time": 1.0, "pid": 1, "unit": "sub-02", "stage": "regis')
+
+    states = journal.replay(journal_path)
+
+    assert states == {'sub-01': {'status': 'finished', 'stage': 'refacer'},
+                      'sub-02': {'status': 'started', 'stage': None}}
+
+    # the resumed run's records start on a line of their own and are replayed
+    journal.record(journal_path, 'sub-02', 'unit', 'finished')
+    lines = journal_path.read_text().splitlines()
+    assert json.loads(lines[-1])['status'] == 'finished'
+    assert journal.replay(journal_path)['sub-02']['status'] == 'finished'
+
+
+def test_replay_without_journal(tmp_path):
+    assert journal.replay(tmp_path / journal.JOURNAL_FILENAME) == {}
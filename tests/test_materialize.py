@@ -0,0 +1,68 @@
+import errno
+import os
+
+import pytest
+
+import materialize
+
+
+@pytest.fixture
+def src(tmp_path, monkeypatch):
+    monkeypatch.setattr(materialize, '_unsupported', set())
+    monkeypatch.setattr(materialize, '_stats', {})
+    path = tmp_path / 'src.nii.gz'
+    path.write_bytes(b'defaced scan')
+    return path
+
+
+def refuse(err_no, calls, strategy):
+    def fail(*args):
+        calls.append(strategy)
+        raise OSError(err_no, os.strerror(err_no))
+    return fail
+
+
+def test_falls_back_to_hardlink_without_reflinks(tmp_path, src, monkeypatch):
+    calls = []
+    monkeypatch.setattr(materialize, '_reflink', refuse(errno.EOPNOTSUPP, calls, 'reflink'))
+
+    assert materialize.materialize(src, tmp_path / 'a.nii.gz', 'auto') == 'hardlink'
+    assert materialize.materialize(src, tmp_path / 'b.nii.gz', 'auto') == 'hardlink'
+
+    assert os.stat(tmp_path / 'a.nii.gz').st_ino == os.stat(src).st_ino
+    assert calls == ['reflink']  # not tried again between the same filesystems
+    assert materialize.get_stats() == {'hardlink': (2, 2 * len(b'defaced scan'))}
+
+
+def test_falls_back_to_copy_without_reflinks_or_hardlinks(tmp_path, src, monkeypatch):
+    calls = []
+    monkeypatch.setattr(materialize, '_reflink', refuse(errno.EOPNOTSUPP, calls, 'reflink'))
+    monkeypatch.setattr(os, 'link', refuse(errno.EXDEV, calls, 'hardlink'))
+    dst = tmp_path / 'dst.nii.gz'
+
+    assert materialize.materialize(src, dst, 'auto') == 'copy'
+
+    assert calls == ['reflink', 'hardlink']
+    assert dst.read_bytes() == src.read_bytes()
+    assert os.stat(dst).st_ino != os.stat(src).st_ino
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['dst.nii.gz', 'src.nii.gz']
+
+
+def test_policy_limits_strategies(tmp_path, src, monkeypatch):
+    calls = []
+    monkeypatch.setattr(materialize, '_reflink', refuse(errno.EOPNOTSUPP, calls, 'reflink'))
+
+    assert materialize.materialize(src, tmp_path / 'dst.nii.gz', 'reflink') == 'copy'
+    assert materialize.materialize(src, tmp_path / 'dst.nii.gz', 'copy') == 'copy'
+    assert calls == ['reflink']
+
+
+def test_other_errors_are_raised(tmp_path, src, monkeypatch):
+    calls = []
+    monkeypatch.setattr(materialize, '_reflink', refuse(errno.ENOSPC, calls, 'reflink'))
+
+    with pytest.raises(OSError):
+        materialize.materialize(src, tmp_path / 'dst.nii.gz', 'auto')
+
+    assert calls == ['reflink']
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['src.nii.gz']
@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+
+import pytest
+
+import materialize
+import prepare_to_share
+
+
+@pytest.fixture
+def trees(tmp_path):
+    """An original BIDS tree with anat and func scans, and the pipeline's defaced tree holding only the anat scan."""
+    original, defaced = tmp_path / 'bids', tmp_path / 'output' / 'bids_defaced'
+    for root, t1w in [(original, b'face'), (defaced, b'no face')]:
+        (root / 'sub-01' / 'anat').mkdir(parents=True)
+        (root / 'sub-01' / 'anat' / 'sub-01_T1w.nii.gz').write_bytes(t1w)
+    (original / 'sub-01' / 'func').mkdir()
+    (original / 'sub-01' / 'func' / 'sub-01_task-rest_bold.nii.gz').write_bytes(b'bold')
+    write_sidecar(original / 'sub-01' / 'func' / 'sub-01_task-rest_bold.json', RepetitionTime=2.0)
+    write_sidecar(original / 'dataset_description.json', Name='test')
+    return original, defaced
+
+
+def write_sidecar(path, **fields):
+    with open(path, 'w') as f:
+        json.dump(dict(fields, AcquisitionTime='10:00:00'), f)
+
+
+def share(original, defaced, monkeypatch):
+    """Runs prepare_to_share.py and returns the files it materialized, relative to the original tree."""
+    shared = []
+
+    def copy(src, dst, policy=None):
+        shared.append(str(src.relative_to(original)))
+        dst.write_bytes(src.read_bytes())
+        return 'copy'
+
+    monkeypatch.setattr(materialize, 'materialize', copy)
+    monkeypatch.setattr(sys, 'argv', ['prepare_to_share.py', str(original), str(defaced), '--materialize', 'copy',
+                                      '-n', '2'])
+    prepare_to_share.main()
+    return sorted(shared)
+
+
+def test_rerun_only_shares_new_or_changed_files(trees, monkeypatch):
+    original, defaced = trees
+    bold_json = original / 'sub-01' / 'func' / 'sub-01_task-rest_bold.json'
+    func_files = ['sub-01/func/sub-01_task-rest_bold.json', 'sub-01/func/sub-01_task-rest_bold.nii.gz']
+
+    assert share(original, defaced, monkeypatch) == ['dataset_description.json'] + func_files
+    assert (defaced / 'sub-01' / 'anat' / 'sub-01_T1w.nii.gz').read_bytes() == b'no face'
+    assert 'AcquisitionTime' not in json.loads((defaced / 'sub-01' / 'func' / bold_json.name).read_text())
+
+    assert share(original, defaced, monkeypatch) == []
+
+    write_sidecar(bold_json, RepetitionTime=2.5)
+    stat = os.stat(bold_json)
+    os.utime(bold_json, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert share(original, defaced, monkeypatch) == ['sub-01/func/sub-01_task-rest_bold.json']
+    assert json.loads((defaced / 'sub-01' / 'func' / bold_json.name).read_text()) == {'RepetitionTime': 2.5}
+
+    manifest = json.loads((defaced.parent / prepare_to_share.MANIFEST_FILENAME).read_text())
+    assert sorted(manifest['files']) == ['dataset_description.json'] + func_files
@@ -0,0 +1,62 @@
+import logging
+import os
+import subprocess
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+import register
+
+LOGGER = logging.getLogger('test_register')
+FSL_BIN = Path(os.environ.get('FSLDIR', '/nonexistent'), 'bin')
+
+
+def write_facemask(path, dtype):
+    """Writes a small 4D facemask whose volumes hold negative, zero and positive values."""
+    rng = np.random.default_rng(0)
+    data = rng.choice([-3, -1, 0, 0, 1, 2], size=(6, 7, 5, 3)).astype(dtype)
+    data[0, 0, 0, 1] = 0
+    data[1, 0, 0, 1] = -1
+    data[2, 0, 0, 1] = 1
+    affine = np.diag([1.2, 1.0, 0.9, 1.0])
+    affine[:3, 3] = [-3, 4, 10]
+    nib.save(nib.Nifti1Image(data, affine), path)
+    return data, affine
+
+
+def expected_defacemask(data):
+    """`fslroi <facemask> <prefix> 1 1; fslmaths <prefix> -abs -binv` in NumPy."""
+    return (np.abs(data[..., 1]) == 0).astype(np.float64)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.int16])
+def test_preprocess_facemask_native(tmp_path, dtype):
+    fmask_path = tmp_path / 'tmp.05.sh_t2a_thr.nii'
+    data, affine = write_facemask(fmask_path, dtype)
+
+    defacemask = register.preprocess_facemask_native(fmask_path, LOGGER)
+
+    assert defacemask == tmp_path / 'afni_defacemask.nii.gz'
+    img = nib.load(defacemask)
+    assert img.shape == data.shape[:3]
+    np.testing.assert_array_equal(img.get_fdata(), expected_defacemask(data))
+    np.testing.assert_allclose(img.affine, affine)
+
+
+@pytest.mark.skipif(not (FSL_BIN / 'fslmaths').exists(), reason='FSL not installed')
+def test_preprocess_facemask_native_matches_fsl(tmp_path):
+    fmask_path = tmp_path / 'tmp.05.sh_t2a_thr.nii'
+    write_facemask(fmask_path, np.float32)
+    fsl_dir = tmp_path / 'fsl'
+    fsl_dir.mkdir()
+    env = dict(os.environ, FSLOUTPUTTYPE='NIFTI_GZ')
+    subprocess.run([FSL_BIN / 'fslroi', fmask_path, fsl_dir / 'afni_facemask', '1', '1'], check=True, env=env)
+    subprocess.run([FSL_BIN / 'fslmaths', fsl_dir / 'afni_facemask.nii.gz', '-abs', '-binv',
+                    fsl_dir / 'afni_defacemask.nii.gz'], check=True, env=env)
+
+    defacemask = register.preprocess_facemask_native(fmask_path, LOGGER)
+
+    np.testing.assert_array_equal(nib.load(defacemask).get_fdata(),
+                                  nib.load(fsl_dir / 'afni_defacemask.nii.gz').get_fdata())
@@ -0,0 +1,66 @@
+import json
+import multiprocessing
+import os
+import signal
+from pathlib import Path
+
+import deface
+import resources
+import scheduler
+
+
+def deface_or_die(bids_input_dir, subject, session, *args, **kwargs):
+    """Stands in for deface.deface_primary_scan; the worker running 'sub-lost' is killed like by the OOM killer."""
+    if subject.name == 'sub-lost':
+        os.kill(os.getpid(), signal.SIGKILL)
+    return []
+
+
+def test_run_unit_reports_unmapped_unit_as_failed(tmp_path, monkeypatch):
+    log_path = tmp_path / resources.RESOURCE_LOG_FILENAME
+    monkeypatch.setenv(resources.RESOURCE_LOG_ENV, str(log_path))
+    args = (tmp_path / 'bids', Path('sub-01'), Path('ses-noanat'), {'sub-01': {}}, tmp_path / 'out', ['regular'],
+            False, None, 1, 'native')
+
+    unit_id, missing_refacer_out, error = scheduler.run_unit('sub-01/ses-noanat', args)
+
+    assert (unit_id, missing_refacer_out) == ('sub-01/ses-noanat', None)
+    assert error.startswith('Traceback') and 'KeyError' in error
+    with open(log_path, 'r') as f:
+        records = [json.loads(line) for line in f]
+    assert [(r['tool'], r['scan']) for r in records] == [(resources.WORKER_TOOL, '')]
+
+
+def test_get_unit_scan():
+    mapping_dict = {'sub-01': {'primary_t1': '/in/sub-01_run-2_T1w.nii.gz', 'others': ['/in/sub-01_run-1_T1w.nii.gz']},
+                    'sub-02': {'ses-01': {'primary_t1': '', 'others': []}}}
+    assert scheduler.get_unit_scan(mapping_dict, 'sub-01', '') == Path('/in/sub-01_run-2_T1w.nii.gz')
+    assert scheduler.get_unit_scan(mapping_dict, 'sub-02', 'ses-01') == ''
+    assert scheduler.get_unit_scan(mapping_dict, 'sub-02', 'ses-02') == ''
+
+
+def test_find_lost_units():
+    started_queue = multiprocessing.SimpleQueue()
+    started_queue.put(('sub-01', os.getpid()))  # not a child of this process, so not alive as a pool worker
+    running = {'sub-01': None, 'sub-02': None}
+
+    lost = scheduler.find_lost_units(running, started_queue)
+
+    assert running == {'sub-01': os.getpid(), 'sub-02': None}
+    assert [unit_id for unit_id, _ in lost] == ['sub-01']
+    assert f'pid {os.getpid()}' in lost[0][1]
+
+
+def test_run_longest_first_reports_lost_worker(monkeypatch):
+    monkeypatch.setattr(deface, 'deface_primary_scan', deface_or_die)
+    monkeypatch.setattr(scheduler, 'WORKER_CHECK_INTERVAL', 1)
+    monkeypatch.delenv(resources.RESOURCE_LOG_ENV, raising=False)
+    tasks = [(unit_id, cost, (None, Path(unit_id), None, {}, None, ['regular'], False, None, 1, 'native'))
+             for unit_id, cost in [('sub-lost', 2), ('sub-ok', 1)]]
+    results = {}
+
+    scheduler.run_longest_first(tasks, 2, lambda unit_id, result, error: results.update({unit_id: (result, error)}))
+
+    assert results['sub-ok'] == ([], None)
+    result, error = results['sub-lost']
+    assert result is None and 'died without reporting a result' in error
@@ -0,0 +1,59 @@
+import gzip
+
+import numpy as np
+import pytest
+
+import utils
+
+
+def make_payload(size):
+    """Compressible bytes with some noise, so that blocks differ and back-references cross block boundaries."""
+    rng = np.random.default_rng(0)
+    return (np.arange(size) % 251).astype(np.uint8).tobytes() + rng.bytes(size // 4)
+
+
+@pytest.mark.parametrize('n_threads', [1, 4])
+def test_parallel_gzip_writer_round_trip(tmp_path, n_threads):
+    payload = make_payload(300 * 1024)
+    out_path = tmp_path / 'out.nii.gz'
+
+    with utils.ParallelGzipWriter(out_path, n_threads=n_threads, block_size=64 * 1024) as f:
+        f.write(payload[:1000])
+        f.seek(f.tell() + 10)  # forward seeks are filled with zeros
+        f.write(payload[1010:])
+
+    assert gzip.decompress(out_path.read_bytes()) == payload[:1000] + b'\x00' * 10 + payload[1010:]
+
+
+def test_parallel_gzip_writer_output_is_deterministic(tmp_path):
+    payload = make_payload(300 * 1024)
+    outputs = []
+    for n_threads in [1, 4]:
+        out_path = tmp_path / f'out_{n_threads}.gz'
+        with utils.ParallelGzipWriter(out_path, n_threads=n_threads, block_size=64 * 1024) as f:
+            f.write(payload)
+        outputs.append(out_path.read_bytes())
+    assert outputs[0] == outputs[1]
+
+
+def test_parallel_gzip_writer_aborts_on_error(tmp_path):
+    out_path = tmp_path / 'out.nii.gz'
+
+    with pytest.raises(RuntimeError):
+        with utils.ParallelGzipWriter(out_path, n_threads=2, block_size=1024) as f:
+            f.write(make_payload(10 * 1024))
+            raise RuntimeError("failed halfway")
+
+    assert not out_path.exists()
+    assert f.closed
+
+
+def test_compress_to_gz(tmp_path):
+    payload = make_payload(100 * 1024)
+    in_path = tmp_path / 'scan.nii'
+    in_path.write_bytes(payload)
+
+    utils.compress_to_gz(in_path, tmp_path / 'scan.nii.gz', n_threads=2, chunk_size=16 * 1024)
+
+    assert gzip.decompress((tmp_path / 'scan.nii.gz').read_bytes()) == payload
+    assert not (tmp_path / 'scan.nii.gz.part').exists()